@@ -1,3 +1,13 @@
-from src.server import server
+import os
+import sys
 
-server.launch()
+# Any command line arguments but --metrics select the headless runner, otherwise the browser interface is launched.
+# --metrics has it serve live performance metrics too, as setting EGYPT_METRICS=1 does
+if len(sys.argv) > 1 and sys.argv[1:] != ["--metrics"]:
+    from src.run import main
+    sys.exit(main())
+else:
+    if sys.argv[1:] == ["--metrics"]:
+        os.environ["EGYPT_METRICS"] = "1"
+    from src.server import server
+    server.launch()
\ No newline at end of file
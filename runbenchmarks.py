@@ -0,0 +1,6 @@
+import unittest
+
+import src.benchmarks as benchmarks
+
+runner = unittest.TextTestRunner()
+runner.run(benchmarks.suite())
@@ -3,6 +3,13 @@ import random
 import numpy as np
 from mesa import Agent
 
+from src.events import CLAIM, DEATH, EXTINCTION, FISSION, GROWTH, HARVEST, RELEASE, RENT
+from src.ids import FARM, HOUSEHOLD, idLabel
+
+# The most times genChangeover redraws a new generation's ambition or competency before keeping the old value. Only
+# reached when no draw can land outside (minimum, 1], a value in the middle of it with a small generationalVariation
+MAX_GENERATION_REDRAWS = 1000
+
 
 # Class to setup the agents for the model:
 # Tile: A psudeo agent used primarily as a container for data, can be a river, settlement or field
@@ -32,6 +39,11 @@ class Tile(Agent):
         super().__init__(unique_id, model)
         self.pos = pos
 
+    @property
+    def label(self):
+        """ Readable label of the agent's id, for display """
+        return idLabel(self.unique_id)
+
     def step(self):
         pass
 
@@ -52,19 +64,59 @@ class River(Tile):
         super().__init__(unique_id, model, pos)
 
 
+class FieldState:
+    """
+    Descriptor for a Field attribute that is stored in one of the model's field state arrays.
+
+    Keeping the state of every field in arrays indexed by Field.index lets households farm and age their fields with
+    array operations, while each Field still reads and writes its own values like ordinary attributes.
+    """
+
+    def __init__(self, array: str):
+        self.array = array
+
+    def __get__(self, field, owner):
+        if field is None:
+            return self
+        return getattr(field.model, self.array)[field.index]
+
+    def __set__(self, field, value):
+        getattr(field.model, self.array)[field.index] = value
+
+
+class FieldOwnerState(FieldState):
+    """
+    Descriptor for Field.owner, stored as the owning household's id in the model's fieldOwner array, -1 for none.
+
+    Ids rather than the households themselves, the garbage collector does not look inside NumPy object arrays and
+    households referring back to the model through one would keep every model alive for the life of the process.
+    """
+
+    def __get__(self, field, owner):
+        if field is None:
+            return self
+        return field.model.schedule.household(field.model.fieldOwner[field.index])
+
+    def __set__(self, field, value):
+        field.model.fieldOwner[field.index] = -1 if value is None else value.unique_id
+
+
 class Field(Tile):
     """
     Field agent, can be farmed by households and have changing fertility values and owners
     """
 
     # Variable declarations for non python programmer sanity
-    fertility = 0.0
-    avf = 0.0
-    yearsFallow = 0
-    harvested = False
-    owner = None
-
-    def __init__(self, unique_id, model, pos: tuple = (0, 0), fertility: float = 0.0):
+    index = 0 # Position of the field in the model's field state arrays
+    avf = FieldState("fieldAvf")
+    fertility = FieldState("fieldFertility")
+    harvested = FieldState("fieldHarvested")
+    yearsFallow = FieldState("fieldYearsFallow")
+    owned = FieldState("fieldOwned")
+    owner = FieldOwnerState("fieldOwner")
+    settlementTerritory = FieldState("fieldTerritory")
+
+    def __init__(self, unique_id, model, pos: tuple = (0, 0), fertility: float = 0.0, index: int = 0):
         '''
         Create a new Field
 
@@ -72,13 +124,17 @@ class Field(Tile):
             pos: Tuple representing the position of the agent on a grid
             model: The model in which the agent is being used
             fertility: The starting fertility of the field
+            index: The position of the field in the model's field state arrays
         '''
         super().__init__(unique_id, model, pos)
+        self.index = index
         self.fertility = fertility
         self.avf = fertility
         self.yearsFallow = 0
         self.harvested = False
+        self.owned = False
         self.owner = None
+        self.settlementTerritory = False
 
     def flood(self):
         """
@@ -107,8 +163,11 @@ class Settlement(Tile):
     population = 0
     noHouseholds = 0
     color = "#000000"
+    haulCost = None # Raster of the cost to haul grain back from each cell, shared by the settlement's households
+    fieldsInReach = None # Indices of the fields within the knowledge radius, the candidates for claiming
+    territory = None # Fields and river cells around the settlement that cannot be farmed while it lives
 
-    def __init__(self, unique_id, model, pos: tuple, population: int, noHouseholds: int, uid, color: str):
+    def __init__(self, unique_id, model, pos: tuple, population: int, noHouseholds: int, color: str):
         '''
         Create a new Settlement
 
@@ -122,21 +181,55 @@ class Settlement(Tile):
         self.population = population
         self.noHouseholds = noHouseholds
         self.color = color
+        # Settlements never move, so what their households can see and the cost of hauling from it is computed once
+        self.haulCost = self.haulCostRaster()
+        self.fieldsInReach = self.findFieldsInReach()
+        self.territory = []
 
+    def haulCostRaster(self):
+        """
+        Computes the cost of hauling a harvest from every cell of the grid back to the settlement, indexed [x, y].
+        Covers the whole grid rather than the knowledge radius as rented fields can lie anywhere.
+        """
+        return self.model.landscape.haulDistance(self.pos) * self.model.distanceCost
+
+    def findFieldsInReach(self):
+        """
+        Finds the indices of the fields within the knowledge radius of the settlement, in the order the grid lists the
+        neighbourhood. The order decides which of several equally fertile fields is claimed. Read from the landscape,
+        which lists them for every cell.
+        """
+        return self.model.landscape.fieldsInReach(self.pos)
+
+    def claimTerritory(self):
+        """
+        Marks the cells around the settlement as its territory, remembering the fields and river cells to release when it dies
+        """
+        local = self.model.grid.get_neighbors(self.pos, moore=True, include_center=True, radius=1)
+        for a in local:
+            a.settlementTerritory = True
+        self.territory = [a for a in local if type(a) is Field or type(a) is River]
+
+    def teardown(self):
+        """
+        Releases the territory of a dead settlement and removes it from the simulation.
+        Called by the scheduler for the settlements queued by Household.consumeGrain rather than polled every step.
+        """
+        # Mark the land as available for farming. River included for an extension that includes fishing.
+        # Can be extended by having a timer where the area is not able to be cultivated.
+        for a in self.territory:
+            a.settlementTerritory = False
+        if self.model.events is not None:
+            self.model.events.record(self.model.currentTime, EXTINCTION, other=self.unique_id)
+        # Remove from consideration
+        self.model.schedule.remove(self)
+        self.model.grid.remove_agent(self)
 
     def step(self):
         """ Actions to take on a step"""
         # Check if settlement is dead
         if self.population == 0:
-            local = self.model.grid.get_neighbors(self.pos, moore=True, include_center=True, radius=1)
-            # Mark the land as available for farming. River included for an extension that includes fishing.
-            # Can be extended by having a timer where the area is not able to be cultivated.
-            for a in local:
-                if type(a) is Field or type(a) is River:
-                    a.settlementTerritory = False
-            # Remove from consideration
-            self.model.schedule.remove(self)
-            self.model.grid.remove_agent(self)
+            self.teardown()
 
 
 class Household(Agent):
@@ -153,8 +246,10 @@ class Household(Agent):
     competency = 0.0
     workersWorked = 0
     generationCountdown = 0
-    fields = []
-    farms = {} # Dict of farms for visualisation purposes
+    fields = None # Indices of the owned fields in the model's field state arrays, in farming order
+    farms = {} # Dict of farms for visualisation purposes, keyed by field index
+    seq = 0 # Position in the scheduler's order of addition, breaks ties when ordering households
+    wealthRank = 0 # Position in the current step's wealth order, breaks ties in the ambition order
 
     def __init__(self, unique_id, model, settlement: Settlement, pos: tuple, grain: int,
                  workers: int, ambition: float, competency: float,
@@ -177,10 +272,15 @@ class Household(Agent):
         self.ambition = ambition
         self.competency = competency
         self.generationCountdown = generationCountdown
-        self.fields = []
+        self.fields = np.empty(0, dtype=int)
         # For visualisation
         self.farms = {}
 
+    @property
+    def label(self):
+        """ Readable label of the household's id, for display """
+        return idLabel(self.unique_id)
+
     def claimFields(self):
         """
         This method allows households to *decide* whether or not to claim fields that fall within their knowledge-radii.
@@ -188,80 +288,134 @@ class Household(Agent):
         """
         chance = np.random.uniform(0, 1)
         if (chance > self.ambition and self.workers > len(self.fields)) or (len(self.fields) <= 1):
-            bestFertility = 0
-            bestField = None
-
-            # Iterate through fields on the grid
-            neighbours = self.model.grid.get_neighbors(pos = self.pos, moore = False, include_center =  False, radius = self.model.knowledgeRadius)
-            for a in neighbours:
-                if (type(a) is Field and a.fertility > bestFertility 
-                        and a.owned == False and a.settlementTerritory == False):
-                    bestFertility = a.fertility
-                    bestField = a
+            # Find the most fertile free field within the knowledge radius of the settlement, the first one if tied
+            best = self.model.kernels.bestClaim(self.settlement.fieldsInReach, self.model.fieldFertility,
+                                                self.model.fieldOwned, self.model.fieldTerritory)
 
             # Make claim
-            if bestField != None:
-                # Redundancy checks
-                if (type(bestField) is Field and bestField.owned == False
-                        and bestField.settlementTerritory == False):
-                    # Redundancy Removal of farms
-                    if (len(self.model.grid.get_cell_list_contents(bestField.pos)) != 1):
-                        for a in self.model.grid.get_cell_list_contents(bestField.pos):
-                            if type(a) is Farm:
-                                self.model.grid.remove_agent(a)
-
-                    bestField.owned = True
-                    bestField.owner = self
-                    bestField.harvested = False
-                    bestField.yearsFallow = 0
-                    self.fields.append(bestField)
-
-                    # Make farm for visualisation
-                    farm = Farm(self.model.next_id(), self.model, bestField.pos, self.settlement.color, False)
-                    self.model.grid.place_agent(farm, bestField.pos)
-                    self.farms[bestField.pos] = farm
+            if best >= 0:
+                bestField = self.model.fieldAgents[best]
+                # Redundancy Removal of farms
+                if (len(self.model.grid.get_cell_list_contents(bestField.pos)) != 1):
+                    for a in self.model.grid.get_cell_list_contents(bestField.pos):
+                        if type(a) is Farm:
+                            self.model.grid.remove_agent(a)
+
+                bestField.owned = True
+                bestField.owner = self
+                bestField.harvested = False
+                bestField.yearsFallow = 0
+                self.model.fieldFarmed[bestField.index] = False
+                self.fields = np.append(self.fields, bestField.index)
+                if self.model.events is not None:
+                    self.model.events.record(self.model.currentTime, CLAIM, self.unique_id, field=bestField.index)
+
+                # Make farm for visualisation
+                farm = Farm(self.model.ids.allocate(FARM), self.model, bestField.pos, self.settlement.color, bestField.index)
+                self.model.grid.place_agent(farm, bestField.pos)
+                self.farms[bestField.index] = farm
 
     def farm(self, fields, rental):
-        """ Farms fields that the Household owns ifthe chance is met"""
-        totalHarvest = 0
+        """
+        Farms fields that the Household owns ifthe chance is met
+
+        Equivalent to repeatedly taking the chance on the most fertile unharvested field, once per pair of free workers,
+        but the harvests of all candidate fields are computed as an array and the chances are drawn in vectors. Exactly
+        as many chances are drawn as the one field at a time loop would draw, so seeded runs are unchanged.
+
+        Args:
+            fields: Array of field indices to farm, sorted in place into farming order
+            rental: If the fields are being rented from other households
+        """
         maxYield = 2475
         loops = ((self.workers - self.workersWorked)// 2) # Protection against loop breaking with changes
-        
-        # Sorting functor, sorts on fertility unless field is harvested
-        def fert(field):
-            if not field.harvested:
-                return field.fertility
+        model = self.model
+        kernels = model.kernels
+
+        # Sort fields on fertility, harvested fields last. The sort must be stable and in place, equally fertile fields
+        # are farmed in array order and the array is shared between the households renting from it
+        unharvested = kernels.farmingOrder(fields, model.fieldFertility, model.fieldHarvested)
+
+        # The unharvested fields are now at the front of the array, in the order they would be farmed
+        candidates = fields[:unharvested]
+        owners = model.fieldOwner[candidates]
+        harvests = kernels.harvestYields(candidates, model.fieldFertility, model.fieldX, model.fieldY,
+                                         self.settlement.haulCost, self.competency, maxYield).tolist()
+
+        taken = self.takeChances(owners, harvests, loops, rental)
+
+        totalHarvest = 0
+        model.fieldHarvested[candidates[:taken]] = True
+        for owner, harvest in zip(owners[:taken].tolist(), harvests[:taken]):
+            if rental and owner >= 0:
+                totalHarvest += round((harvest * (1 - (model.rentalRate)))) - 300 #Renter farms and re-seeds
+                model.schedule.household(owner).grain += round(harvest * (model.rentalRate)) # Renter pays rental fee
+                model.totalGrain += round(harvest * (model.rentalRate)) # Add to total grain
             else:
-                return -1
-
-        fields.sort(key = fert, reverse = True) # Sort fields on fertility so save loop iterations
-
-        for i in range(loops):
-            # Optimised looping through fields from NetLogo, saves several loop cycles and calculations 
-            for f in fields:
-                # If the field is not harvested, setup for harvesting
-                if not f.harvested:
-                    harvest = (int(f.fertility * maxYield * self.competency) - 
-                              (((abs(self.pos[0]) - f.pos[0]) + 
-                                 abs(self.pos[1] - f.pos[1])) * 
-                                 self.model.distanceCost))
-                    # If the chance is met, harvest the field
-                    chance = np.random.uniform(0, 1)
-                    if (((self.grain > (self.workers * 160)) or (chance < self.ambition * self.competency)) 
-                        and (f is not None)):
-                        f.harvested = True
-                        if rental and f.owner is not None:
-                            totalHarvest += round((harvest * (1 - (self.model.rentalRate)))) - 300 #Renter farms and re-seeds
-                            f.owner.grain += round(harvest * (self.model.rentalRate)) # Renter pays rental fee
-                            self.model.totalGrain += round(harvest * (self.model.rentalRate)) # Add to total grain
-                        else:
-                            totalHarvest += harvest - 300  # -300 for planting
-                        self.workersWorked += 2
-                    break # Stop looping through fields after choosing the best and taking the farm chance
+                totalHarvest += harvest - 300  # -300 for planting
+        self.workersWorked += 2 * taken
+        if model.events is not None and taken:
+            self.recordHarvests(candidates[:taken], owners[:taken], harvests[:taken], rental)
         # Complete farming by updating grain totals
         self.grain += totalHarvest
         self.model.totalGrain += totalHarvest
 
+    def recordHarvests(self, fields, owners, harvests, rental):
+        """
+        Records the harvested fields in the model's event log, as rentals when they were rented from a household
+
+        Args:
+            fields: The indices of the harvested fields
+            owners: The id of each field's owner, -1 for none
+            harvests: The harvest each field yielded
+            rental: If the fields were rented
+        """
+        year = self.model.currentTime
+        if not rental:
+            self.model.events.recordMany(year, HARVEST, self.unique_id, -1, fields, harvests)
+            return
+        harvests = np.asarray(harvests)
+        rented = owners >= 0
+        for kind, mask in ((HARVEST, ~rented), (RENT, rented)):
+            if mask.any():
+                self.model.events.recordMany(year, kind, self.unique_id, owners[mask], fields[mask], harvests[mask])
+
+    def takeChances(self, owners, harvests, loops, rental):
+        """
+        Decides how many of the candidate fields are harvested, taking them in order
+
+        Each of the loops attempts draws a chance and harvests the next candidate if the household has enough grain to
+        feed its workers or the chance is below ambition * competency. Chances are drawn in vectors, each no longer than
+        the attempts that are certain to be made, so no more are drawn than the sequential loop would have.
+
+        Args:
+            owners: The ids of the owners of the unharvested fields, in the order the fields would be farmed
+            harvests: The harvest each field would yield
+            loops: The number of attempts, one per pair of free workers
+            rental: If the fields are being rented, in which case fees paid to this household count towards its grain
+
+        Returns:
+            The number of candidates harvested
+        """
+        threshold = self.workers * 160
+        chanceLimit = self.ambition * self.competency
+        # Renting its own fields pays this household a fee part way through, which can change the grain condition
+        own = owners == self.unique_id
+        sequential = rental and bool(own.any())
+        if sequential:
+            fees = np.where(own, np.rint(np.array(harvests) * self.model.rentalRate), 0).astype(np.int64)
+        grain = self.grain
+        taken = 0
+        attempts = 0
+        while attempts < loops and taken < len(owners):
+            chances = np.random.uniform(0, 1, min(loops - attempts, len(owners) - taken))
+            attempts += len(chances)
+            if not sequential:
+                taken += len(chances) if grain > threshold else int(np.count_nonzero(chances < chanceLimit))
+                continue
+            taken, grain = self.model.kernels.sequentialTaken(chances, fees, grain, threshold, chanceLimit, taken)
+        return int(taken)
+
     def rent(self, fields):
         """
         This method allows more ambition and competent households to farm the unharvested fields owned by other households.
@@ -290,12 +444,16 @@ class Household(Agent):
             self.workers -= 1
             self.settlement.population -= 1
             self.model.totalPopulation -= 1
+            if self.model.events is not None:
+                self.model.events.record(self.model.currentTime, DEATH, self.unique_id, self.settlement.unique_id,
+                                         amount=self.workers)
+            if self.settlement.population == 0:
+                self.model.schedule.queueTeardown(self.settlement)
 
             # Check if there are still workers in the Household
             if self.workers <= 0:
                 # Removes ownership of all fields
-                for f in self.fields:
-                    f.owned = False
+                self.model.fieldOwned[self.fields] = False
                 # Decrements the amount of households and removes this household from the simulation
                 self.settlement.noHouseholds -= 1
                 self.model.schedule.remove(self)
@@ -321,11 +479,15 @@ class Household(Agent):
             self.workers += 1
             self.settlement.population += 1
             self.model.totalPopulation += 1
+            if self.model.events is not None:
+                self.model.events.record(self.model.currentTime, GROWTH, self.unique_id, self.settlement.unique_id,
+                                         amount=self.workers)
 
     def genChangeover(self):
         """
         This method is to simulate what may happen when a relative or child takes over the household and thus allows
         for the level of competency and ambition of a household to change as would be expected when an new person is in control.
+        A value that no redraw moves outside (minimum, 1] within MAX_GENERATION_REDRAWS draws is kept.
         """
         # Decreases the generational countdown 
         self.generationCountdown -= 1
@@ -336,7 +498,7 @@ class Household(Agent):
             self.generationCountdown = random.randint(0, 5) + 10 
 
             # continues to recalculate the new ambition value until it is less than one and greater than the model's minimum ambition
-            while(True):
+            for _ in range(MAX_GENERATION_REDRAWS):
                 # Chooses an amount to change ambition by between 0 and the generational variance number
                 ambitionChange = random.uniform(0, self.model.generationalVariation)
                 # Chooses a random number between 0 and 1
@@ -354,7 +516,7 @@ class Household(Agent):
                     break
 
             # continues to recalculate the new competency value until it is less than one and greater than the model's minimum competency
-            while(True): 
+            for _ in range(MAX_GENERATION_REDRAWS):
                 # Chooses an amount to change competency by between 0 and the generational variance number
                 competencyChange = random.uniform(0, self.model.generationalVariation)
                 # Chooses a random number between 0 and 1
@@ -378,33 +540,22 @@ class Household(Agent):
         of the field and it is free for other households to claim.
         """
 
-        # Array to store fields to delete
-        toDel = []
-        
-        # For loop to loop through all owned fields
-        for i in range(len(self.fields)):
-            # If statement to check if a field has been harvested or not, and set render values for the farms
-            if (self.fields[i].harvested == True):
-                self.fields[i].yearsFallow = 0
-                if self.fields[i].pos in self.farms:
-                    self.farms[self.fields[i].pos].farmed = True
-            else:
-                self.fields[i].yearsFallow += 1
-                if self.fields[i].pos in self.farms:
-                    self.farms[self.fields[i].pos].farmed = False
-            
-            # If statement to add fallowlimit exceeding fields to an array of fields to delete
-            if (self.fields[i].yearsFallow >= self.model.fallowLimit):
-                self.model.grid.remove_agent(self.farms[self.fields[i].pos])# Remove the farm from the map
-                del self.farms[self.fields[i].pos] # Remove the farm from list 
-                # Reset ownership
-                self.fields[i].owned = False
-                self.fields[i].owner = None
-                toDel.append(i - len(toDel)) # Subtract to account for array shrinkage as deletion happens
-
-        # Remove all fallowlimit exceded fields from the Households ownership, does not remove agent
-        for i in toDel:
-            del self.fields[i] # Delete the field
+        # Age every owned field in one pass over the model's field state arrays
+        yearsFallow = np.where(self.model.fieldHarvested[self.fields], 0, self.model.fieldYearsFallow[self.fields] + 1)
+        self.model.fieldYearsFallow[self.fields] = yearsFallow
+        self.model.fieldFarmed[self.fields] = self.model.fieldHarvested[self.fields] # Set render values for the farms
+
+        # Release all fallowlimit exceeding fields from the Households ownership in bulk, does not remove agent
+        expired = yearsFallow >= self.model.fallowLimit
+        if expired.any():
+            released = self.fields[expired]
+            self.model.fieldOwned[released] = False
+            self.model.fieldOwner[released] = -1
+            if self.model.events is not None:
+                self.model.events.recordMany(self.model.currentTime, RELEASE, self.unique_id, -1, released, 0)
+            for i in released.tolist():
+                self.model.grid.remove_agent(self.farms.pop(i)) # Remove the farm from the map
+            self.fields = self.fields[~expired]
 
     def fission(self):
         """ Performs household fission if enabled"""
@@ -414,7 +565,7 @@ class Household(Agent):
             if self.model.fissionChance < np.random.uniform(0,1):
                 # If requirements are met, create a splinter household
                 if self.workers >= 15 and self.grain > (3 * self.workers * (164)):
-                    uid = "h" + str(self.model.schedule.get_breed_count(Household) + 1)
+                    uid = self.model.ids.allocate(HOUSEHOLD)
                     ambition =  np.random.uniform(self.model.minAmbition, 1)
                     competency = np.random.uniform(self.model.minCompetency, 1)
                     genCount = random.randrange(5) + 10
@@ -423,6 +574,8 @@ class Household(Agent):
                     self.model.schedule.add(household) # Add to scheduler
                     self.workers -= 5
                     self.grain -= 5
+                    if self.model.events is not None:
+                        self.model.events.record(self.model.currentTime, FISSION, self.unique_id, uid, amount=5)
 
     def step(self):
         """
@@ -458,18 +611,20 @@ class Household(Agent):
         self.genChangeover()
         self.populationShift()
         self.fission()
-        # Update grain max for datacollector
-        if self.grain > self.model.maxHouseholdGrain:
-            self.model.maxHouseholdGrain = self.grain
 
 
 class Farm(Tile):
     """Farm stub object for visualsiation purposes"""
 
     color = ""
-    farmed = False
+    field = 0 # Index of the farmed field
 
-    def __init__(self, unique_id: int, model, pos: tuple, color: str = "#FFFFFF", farmed: bool = False):
+    def __init__(self, unique_id: int, model, pos: tuple, color: str = "#FFFFFF", field: int = 0):
         super().__init__(unique_id, model, pos)
         self.color = color
-        self.farmed = farmed
+        self.field = field
+
+    @property
+    def farmed(self):
+        """ If the field was harvested in its last changeover, False until its first """
+        return self.model.fieldFarmed[self.field]
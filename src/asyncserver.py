@@ -0,0 +1,200 @@
+import ipaddress
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import tornado.escape
+import tornado.ioloop
+import tornado.web
+from mesa.visualization.ModularVisualization import ModularServer, SocketHandler
+from mesa.visualization.UserParam import UserSettableParameter
+
+from src.metrics import RunMetrics, prometheusText
+
+
+class AsyncSocketHandler(SocketHandler):
+    """
+    Websocket handler that keeps model stepping and rendering off the Tornado event loop
+
+    Steps, resets and renders are handed to the server's executor so that control messages
+    (pause, reset, parameter changes) are answered immediately regardless of how long a step takes.
+    Parameter changes only ever touch the server's parameters on the event loop, a reset takes a copy of them there.
+    """
+
+    def on_message(self, message):
+        """
+        Receiving a message from the websocket, parse, and act accordingly.
+
+        Steps and resets are spawned rather than awaited, Tornado does not read the next message
+        until this method returns.
+        """
+        if self.application.verbose:
+            print(message)
+        msg = tornado.escape.json_decode(message)
+
+        if msg["type"] == "get_step":
+            if not self.application.model.running:
+                self.write_message({"type": "end"})
+            else:
+                tornado.ioloop.IOLoop.current().spawn_callback(self.send_step)
+
+        elif msg["type"] == "reset":
+            tornado.ioloop.IOLoop.current().spawn_callback(self.send_reset)
+
+        elif msg["type"] == "submit_params":
+            param = msg["param"]
+            value = msg["value"]
+
+            # Is the param editable?
+            if param in self.application.user_params:
+                if isinstance(self.application.model_kwargs[param], UserSettableParameter):
+                    self.application.model_kwargs[param].value = value
+                else:
+                    self.application.model_kwargs[param] = value
+
+        elif msg["type"] == "get_params":
+            self.write_message({
+                "type": "model_params",
+                "params": self.application.user_params
+            })
+
+        else:
+            if self.application.verbose:
+                print("Unexpected message!")
+
+    async def send_step(self):
+        """ Step the model on the server's executor and send the resulting snapshot """
+        self.send_state(await self.application.step_model())
+
+    async def send_reset(self):
+        """ Reset the model on the server's executor and send the new model's snapshot """
+        self.send_state(await self.application.reset_model_async())
+
+    def send_state(self, state):
+        """
+        Send a rendered snapshot to the client, if there is one and the socket is still open
+
+        Args:
+            state: The rendered visualisation state, None if the request was dropped or superseded
+        """
+        if state is None or self.ws_connection is None:
+            return
+        self.write_message({"type": "viz_state", "data": state})
+
+
+class MetricsPageHandler(tornado.web.RequestHandler):
+    """
+    Serves the server's live performance metrics, as JSON at /metrics.json and as Prometheus text at /metrics, to this
+    machine only. The interface itself listens on every interface, the metrics are refused to any other client.
+    """
+
+    def prepare(self):
+        if not ipaddress.ip_address(self.request.remote_ip).is_loopback:
+            raise tornado.web.HTTPError(403)
+
+    def get(self, extension):
+        snapshot = self.application.metrics.snapshot()
+        if extension == ".json":
+            self.set_header("Content-Type", "application/json")
+            self.write(json.dumps(snapshot))
+        else:
+            self.set_header("Content-Type", "text/plain; version=0.0.4")
+            self.write(prometheusText(snapshot))
+
+
+class AsyncModularServer(ModularServer):
+    """
+    ModularServer that runs EgyptSim.step() in a worker thread with backpressure
+
+    A single worker thread owns the model: it steps it and renders the visualisation snapshot straight
+    after each step, so the event loop only ever sends finished snapshots. At most max_pending_steps step
+    requests wait behind the one in flight, further requests are dropped (the client simply asks again on
+    its next tick). A reset supersedes any queued steps for the old model.
+    """
+
+    max_pending_steps = 1
+
+    socket_handler = (r'/ws', AsyncSocketHandler)
+    metrics_handler = (r'/metrics(\.json)?', MetricsPageHandler)
+    handlers = [ModularServer.page_handler, socket_handler,
+                ModularServer.static_handler, ModularServer.local_handler]
+
+    def __init__(self, model_cls, visualization_elements, name="Mesa Model", model_params={}, metrics=False):
+        """
+        Create a new visualization server with the given elements.
+
+        Args:
+            metrics: If the server also serves live performance metrics of its model to this machine, see src.metrics
+        """
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.generation = 0  # Incremented on reset, so stale steps for an old model are discarded
+        self.pendingSteps = 0
+        self.metrics = RunMetrics() if metrics else None
+        if metrics:
+            self.handlers = self.handlers + [self.metrics_handler]
+        super().__init__(model_cls, visualization_elements, name, model_params)
+
+    def model_parameters(self):
+        """ A copy of the current values of the model's parameters """
+        model_params = {}
+        for key, val in self.model_kwargs.items():
+            if isinstance(val, UserSettableParameter):
+                if val.param_type == 'static_text':    # static_text is never used for setting params
+                    continue
+                model_params[key] = val.value
+            else:
+                model_params[key] = val
+        return model_params
+
+    def reset_model(self, model_params=None):
+        """
+        Reinstantiate the model object, following it in the metrics if served
+
+        Args:
+            model_params: The parameters to build it with, a copy of the current parameters if not given
+        """
+        if model_params is None:
+            model_params = self.model_parameters()
+        self.model = self.model_cls(**model_params)
+        if self.metrics is not None:
+            self.metrics.watch(self.model)
+
+    def _step_and_render(self, generation):
+        """ Step the model and render a snapshot, run on the worker thread """
+        if generation != self.generation or not self.model.running:
+            return None
+        self.model.step()
+        return self.render_model()
+
+    def _reset_and_render(self, model_params):
+        """ Rebuild the model from a copy of its parameters and render a snapshot, run on the worker thread """
+        self.reset_model(model_params)
+        return self.render_model()
+
+    async def step_model(self):
+        """
+        Queue a step of the model on the worker thread
+
+        Returns:
+            The rendered snapshot after the step, or None if the request was dropped by backpressure
+            or superseded by a reset
+        """
+        if self.pendingSteps > self.max_pending_steps:
+            return None
+        self.pendingSteps += 1
+        try:
+            loop = tornado.ioloop.IOLoop.current()
+            return await loop.run_in_executor(self.executor, self._step_and_render, self.generation)
+        finally:
+            self.pendingSteps -= 1
+
+    async def reset_model_async(self):
+        """
+        Queue a reset of the model on the worker thread, discarding any steps queued for the old model. The new model
+        is built from the parameters as they are now, later changes only apply to the next reset
+
+        Returns:
+            The rendered snapshot of the new model
+        """
+        self.generation += 1
+        loop = tornado.ioloop.IOLoop.current()
+        return await loop.run_in_executor(self.executor, self._reset_and_render, self.model_parameters())
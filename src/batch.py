@@ -0,0 +1,500 @@
+import math
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, as_completed, wait
+from statistics import NormalDist
+
+import numpy as np
+
+from src.inequality import QuantileSketch
+from src.landscape import SHARED_LANDSCAPES
+from src.model import EgyptSim
+
+
+# Helpers for running EgyptSim without the visualisation server, one or many replicates at a time.
+# Everything here is importable from a worker process: no Mesa visualisation modules are pulled in, and
+# pandas is only imported by the parent process when the results are combined.
+
+def runModel(params: dict, seed: int = None, collectEvery: int = 1, metrics=None):
+    """
+    Run a single EgyptSim to completion
+
+    Args:
+        params: Keyword arguments for the EgyptSim constructor
+        seed: Seed for the model's random number generators
+        collectEvery: Collect data every this many years, and in the last year
+        metrics: src.metrics.RunMetrics to report the run to, None to report it to nothing
+
+    Returns:
+        A tuple of the DataCollector output as a dictionary of columns (the model reporters followed by
+        the settlement population table, one entry per collected year) and the number of years simulated
+    """
+    model = EgyptSim(**params, seed=seed)
+    if metrics is not None:
+        metrics.watch(model)
+    model.run(collectEvery=collectEvery)
+    if metrics is not None:
+        metrics.finished(model.currentTime, model)
+    data = dict(model.datacollector.model_vars)
+    data.update(model.datacollector.tables["Settlement Population"])
+    return data, model.currentTime
+
+
+def finalValues(params: dict, seed: int, outputs: list):
+    """
+    Run a model to completion and return the final value of each output
+
+    Args:
+        params: Keyword arguments for the EgyptSim constructor
+        seed: Seed for the model's random number generators
+        outputs: DataCollector model reporters to return
+    """
+    data, years = runModel(params, seed)
+    return [data[output][-1] for output in outputs]
+
+
+def collectedYears(years: int, collectEvery: int = 1):
+    """ The years EgyptSim.run collects data for, in a run of this many years """
+    collected = list(range(0, years + 1, collectEvery))
+    if collected[-1] != years:
+        collected.append(years)
+    return collected
+
+
+def poolParameters(params: dict):
+    """
+    Parameters for models run on a process pool: unless told otherwise the workers memory map their landscapes from
+    a shared directory rather than each building their own
+    """
+    params = dict(params)
+    params.setdefault("landscapeDir", SHARED_LANDSCAPES)
+    return params
+
+
+def replicateSeeds(replicates: int, seed: int = None):
+    """
+    Seeds for a set of replicates, drawn at random if no base seed is given.
+
+    Worker processes are forked from the same parent, so unseeded replicates would share generator state.
+    """
+    if seed is None:
+        seed = random.SystemRandom().randrange(2 ** 31)
+    return [seed + i for i in range(replicates)]
+
+
+def runReplicates(params: dict, replicates: int = 1, workers: int = 1, seed: int = None, collectEvery: int = 1,
+                  metrics=None):
+    """
+    Run several replicates of the same parameter set, across a process pool if more than one worker is used
+
+    Args:
+        params: Keyword arguments for the EgyptSim constructor
+        replicates: The number of replicates to run
+        workers: The number of worker processes
+        seed: Base seed, replicate i is seeded with seed + i
+        collectEvery: Collect data every this many years, and in the last year
+        metrics: src.metrics.RunMetrics to report the runs to. Runs on worker processes are reported as they finish
+
+    Returns:
+        A tuple of the combined pandas DataFrame (with "Replicate", "Seed" and "Step" columns prepended),
+        the total number of years simulated and the elapsed wall time in seconds
+    """
+    seeds = replicateSeeds(replicates, seed)
+    start = time.perf_counter()
+    if workers > 1 and replicates > 1:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(runModel, poolParameters(params), s, collectEvery) for s in seeds]
+            if metrics is not None:
+                for future in as_completed(futures):
+                    metrics.finished(future.result()[1])
+            results = [future.result() for future in futures]
+    else:
+        results = [runModel(params, s, collectEvery, metrics) for s in seeds]
+    elapsed = time.perf_counter() - start
+
+    import pandas as pd
+    frames = []
+    years = 0
+    for i, (columns, runYears) in enumerate(results):
+        data = pd.DataFrame(columns)
+        data.insert(0, "Step", collectedYears(runYears, collectEvery))
+        data.insert(0, "Seed", seeds[i])
+        data.insert(0, "Replicate", i)
+        frames.append(data)
+        years += runYears
+
+    return pd.concat(frames, ignore_index=True), years, elapsed
+
+
+class RunningMoments:
+    """
+    Welford's running count, mean and variance, and the minimum and maximum, of each element of a vector of values,
+    such as a series' value in each year over many replicates
+    """
+
+    def __init__(self, size: int = 0):
+        """
+        Create new, empty moments
+
+        Args:
+            size: The number of elements to make room for, grown as needed
+        """
+        self.count = np.zeros(size, dtype=np.int64)
+        self.mean = np.zeros(size)
+        self.m2 = np.zeros(size) # Sum of the squared differences from the mean
+        self.minimum = np.full(size, math.inf)
+        self.maximum = np.full(size, -math.inf)
+
+    def grow(self, size: int):
+        """ Make room for at least size elements """
+        extra = size - len(self.count)
+        if extra > 0:
+            self.count = np.concatenate((self.count, np.zeros(extra, dtype=np.int64)))
+            self.mean = np.concatenate((self.mean, np.zeros(extra)))
+            self.m2 = np.concatenate((self.m2, np.zeros(extra)))
+            self.minimum = np.concatenate((self.minimum, np.full(extra, math.inf)))
+            self.maximum = np.concatenate((self.maximum, np.full(extra, -math.inf)))
+
+    def update(self, index, values):
+        """
+        Add a value to each of some elements. Values that are not finite, such as the None of a settlement that has
+        died or the inf of the minimum wealth of no households, are skipped
+
+        Args:
+            index: Array of distinct element indices
+            values: Array of the value for each
+        """
+        finite = np.isfinite(values)
+        index, values = index[finite], values[finite]
+        if len(index) == 0:
+            return
+        self.grow(int(index.max()) + 1)
+        self.count[index] += 1
+        delta = values - self.mean[index]
+        self.mean[index] += delta / self.count[index]
+        self.m2[index] += delta * (values - self.mean[index])
+        self.minimum[index] = np.minimum(self.minimum[index], values)
+        self.maximum[index] = np.maximum(self.maximum[index], values)
+
+    def merge(self, other):
+        """ Add the values of other moments, with Chan et al.'s pairwise update """
+        self.grow(len(other.count))
+        n = len(other.count)
+        count = self.count[:n] + other.count
+        delta = other.mean - self.mean[:n]
+        with np.errstate(invalid="ignore", divide="ignore"):
+            weight = np.where(count > 0, other.count / count, 0.0)
+        self.mean[:n] += delta * weight
+        self.m2[:n] += other.m2 + delta ** 2 * self.count[:n] * weight
+        self.count[:n] = count
+        self.minimum[:n] = np.minimum(self.minimum[:n], other.minimum)
+        self.maximum[:n] = np.maximum(self.maximum[:n], other.maximum)
+
+    def variance(self):
+        """ The sample variance of each element, nan for those with fewer than two values """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return np.where(self.count > 1, self.m2 / (self.count - 1), math.nan)
+
+
+class ReplicateSummary:
+    """
+    The mean, variance, extremes and quantiles of each collected series in each year over many replicates, folded in one
+    run at a time so that its memory does not grow with the number of replicates
+    """
+
+    def __init__(self, quantiles: tuple = (0.05, 0.5, 0.95), accuracy: float = 0.01, bufferRuns: int = 64):
+        """
+        Create a new, empty ReplicateSummary
+
+        Args:
+            quantiles: The quantiles of each series reported, as fractions
+            accuracy: The relative accuracy of the quantiles, None to keep every value and report them exactly
+            bufferRuns: The number of runs buffered before they are added to the quantile sketches together
+        """
+        self.quantiles = tuple(quantiles)
+        self.accuracy = accuracy
+        self.bufferRuns = bufferRuns
+        self.replicates = 0
+        self.moments = {} # RunningMoments of each series, indexed by year
+        self.sketches = {} # Lists of the QuantileSketch of each series in each year, None for years not seen
+        self.pending = [] # The years and columns of runs not yet added to the sketches
+
+    def add(self, columns: dict, steps):
+        """
+        Add the output of a run
+
+        Args:
+            columns: Dictionary of series names and their values, as runModel returns
+            steps: The year of each value
+        """
+        steps = np.asarray(steps, dtype=np.int64)
+        for name, values in columns.items():
+            if name not in self.moments:
+                self.moments[name] = RunningMoments(len(steps))
+                self.sketches[name] = []
+            self.moments[name].update(steps, np.array(values, dtype=float))
+        self.replicates += 1
+        self.pending.append((steps, columns))
+        if len(self.pending) >= self.bufferRuns:
+            self.flush()
+
+    def flush(self):
+        """ Add the buffered runs to the quantile sketches, each year's values of each series at once """
+        if not self.pending:
+            return
+        years = max(int(steps.max()) for steps, columns in self.pending) + 1
+        for name, sketches in self.sketches.items():
+            values = np.full((len(self.pending), years), math.nan)
+            for run, (steps, columns) in enumerate(self.pending):
+                if name in columns:
+                    values[run, steps] = np.array(columns[name], dtype=float)
+            sketches.extend([None] * (years - len(sketches)))
+            finite = np.isfinite(values)
+            for year in np.flatnonzero(finite.any(axis=0)):
+                if sketches[year] is None:
+                    sketches[year] = QuantileSketch(self.accuracy)
+                sketches[year].update(values[finite[:, year], year])
+        self.pending = []
+
+    def merge(self, other):
+        """
+        Add the runs summarised by another ReplicateSummary, such as one of a worker's, flushing both first
+
+        Args:
+            other: ReplicateSummary of the same quantiles and accuracy
+        """
+        self.flush()
+        other.flush()
+        self.replicates += other.replicates
+        for name, moments in other.moments.items():
+            if name not in self.moments:
+                self.moments[name] = RunningMoments()
+                self.sketches[name] = []
+            self.moments[name].merge(moments)
+            sketches = self.sketches[name]
+            sketches.extend([None] * (len(other.sketches[name]) - len(sketches)))
+            for year, sketch in enumerate(other.sketches[name]):
+                if sketch is None:
+                    continue
+                if sketches[year] is None:
+                    sketches[year] = QuantileSketch(self.accuracy)
+                sketches[year].merge(sketch)
+
+    def get_dataframe(self):
+        """
+        Returns the summary as a pandas DataFrame with one row per series and year: "Series", "Step", "Replicates" with
+        a value in that year, "Mean", "Variance", "Min", "Max" and a "Q<q>" column per quantile, e.g. "Q0.5"
+        """
+        import pandas as pd
+        self.flush()
+        rows = []
+        for name, moments in self.moments.items():
+            variance = moments.variance()
+            sketches = self.sketches[name]
+            for year in np.flatnonzero(moments.count).tolist():
+                row = {"Series": name, "Step": year, "Replicates": int(moments.count[year]),
+                       "Mean": float(moments.mean[year]), "Variance": float(variance[year]),
+                       "Min": float(moments.minimum[year]), "Max": float(moments.maximum[year])}
+                for q in self.quantiles:
+                    row["Q%g" % q] = sketches[year].quantile(q)
+                rows.append(row)
+        return pd.DataFrame(rows, columns=["Series", "Step", "Replicates", "Mean", "Variance", "Min", "Max"] +
+                                          ["Q%g" % q for q in self.quantiles])
+
+
+def summariseReplicates(params: dict, seeds: list, collectEvery: int = 1, quantiles: tuple = (0.05, 0.5, 0.95),
+                        accuracy: float = 0.01, metrics=None):
+    """
+    Run replicates one after another, folding each into a ReplicateSummary as it finishes
+
+    Returns:
+        A tuple of the flushed ReplicateSummary and the number of years each replicate simulated
+    """
+    summary = ReplicateSummary(quantiles, accuracy)
+    years = []
+    for seed in seeds:
+        columns, runYears = runModel(params, seed, collectEvery, metrics)
+        summary.add(columns, collectedYears(runYears, collectEvery))
+        years.append(runYears)
+    summary.flush()
+    return summary, years
+
+
+def runSummary(params: dict, replicates: int = 1, workers: int = 1, seed: int = None, collectEvery: int = 1,
+               quantiles: tuple = (0.05, 0.5, 0.95), accuracy: float = 0.01, metrics=None):
+    """
+    Run many replicates of the same parameter set, keeping only the per year mean, variance, extremes and quantiles of
+    each series across them. Each worker summarises a block of replicates and the blocks' summaries are merged, so
+    memory is proportional to the number of years and series, not of replicates.
+
+    Args:
+        params: Keyword arguments for the EgyptSim constructor
+        replicates: The number of replicates to run
+        workers: The number of worker processes
+        seed: Base seed, replicate i is seeded with seed + i
+        collectEvery: Collect data every this many years, and in the last year
+        quantiles: The quantiles of each series reported, as fractions
+        accuracy: The relative accuracy of the quantiles, None to report them exactly
+        metrics: src.metrics.RunMetrics to report the runs to. Runs on worker processes are reported a block at a time
+
+    Returns:
+        A tuple of the ReplicateSummary, the total number of years simulated and the elapsed wall time in seconds
+    """
+    seeds = replicateSeeds(replicates, seed)
+    start = time.perf_counter()
+    if workers > 1 and replicates > 1:
+        # A few blocks per worker, so that the workers finishing early pick up more
+        blocks = [block.tolist() for block in np.array_split(seeds, min(replicates, workers * 4))]
+        summary = ReplicateSummary(quantiles, accuracy)
+        years = 0
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(summariseReplicates, poolParameters(params), block, collectEvery, quantiles,
+                                   accuracy) for block in blocks]
+            if metrics is not None:
+                for future in as_completed(futures):
+                    for runYears in future.result()[1]:
+                        metrics.finished(runYears)
+            # Merged in order, so that a seeded summary does not depend on which worker finished first
+            for future in futures:
+                partial, blockYears = future.result()
+                summary.merge(partial)
+                years += sum(blockYears)
+    else:
+        summary, blockYears = summariseReplicates(params, seeds, collectEvery, quantiles, accuracy, metrics)
+        years = sum(blockYears)
+    return summary, years, time.perf_counter() - start
+
+
+def runEnsemble(params: dict, replicates: int = 1, seed: int = None):
+    """
+    Run several replicates of the same parameter set in lockstep on the ensemble engine, in a single process
+
+    Replicates are equivalent to runReplicates' in distribution, but are not the same as the EgyptSim runs of
+    the same seeds.
+
+    Args:
+        params: Keyword arguments for the EgyptSim constructor
+        replicates: The number of replicates to run
+        seed: Seed for the ensemble's random number generator
+
+    Returns:
+        A tuple of the combined pandas DataFrame, laid out as runReplicates', the total number of years simulated
+        and the elapsed wall time in seconds
+    """
+    from src.ensemble import EgyptEnsemble
+    seed = replicateSeeds(1, seed)[0]
+    start = time.perf_counter()
+    ensemble = EgyptEnsemble(replicates, params, seed)
+    ensemble.run()
+    results = ensemble.results()
+    elapsed = time.perf_counter() - start
+
+    import pandas as pd
+    frames = []
+    for i, columns in enumerate(results):
+        data = pd.DataFrame(columns)
+        data.insert(0, "Step", data.index)
+        data.insert(0, "Seed", seed)
+        data.insert(0, "Replicate", i)
+        frames.append(data)
+
+    return pd.concat(frames, ignore_index=True), int(ensemble.years.sum()), elapsed
+
+
+def confidenceHalfWidth(values: list, confidence: float):
+    """
+    The half width of the normal approximation confidence interval on the mean of values, infinite for fewer than two
+
+    Args:
+        values: The samples
+        confidence: The confidence level, e.g. 0.95
+    """
+    if len(values) < 2:
+        return math.inf
+    return NormalDist().inv_cdf(0.5 + confidence / 2) * float(np.std(values, ddof=1)) / math.sqrt(len(values))
+
+
+def runAdaptive(points: list, output: str = "Gini-Index", tolerance: float = 0.01, minReplicates: int = 10,
+                maxReplicates: int = 100, workers: int = 1, seed: int = None, confidence: float = 0.95):
+    """
+    Run replicates of each parameter set until the confidence interval on the final value of an output is narrow
+    enough, or the point's replicate budget is spent
+
+    Every point first gets minReplicates, then more are launched one at a time for the points whose interval is still
+    wider than tolerance either side of the mean. Free workers are given to the point needing samples that has had the
+    fewest launched, so the pool stays busy with the noisy points once the quiet ones have converged. Replicate i of
+    point p is seeded with seed + p * maxReplicates + i.
+
+    Args:
+        points: Keyword arguments for the EgyptSim constructor, one dictionary per parameter point
+        output: The DataCollector model reporter whose final value is estimated
+        tolerance: The half width of the confidence interval to stop at
+        minReplicates: Replicates run for every point before its interval is checked, at least 2
+        maxReplicates: The most replicates run for any point, at least minReplicates. Each point's seeds are spaced this
+                       far apart, so no two points share one
+        workers: The number of worker processes
+        seed: Base seed for the replicates
+        confidence: The confidence level of the interval
+
+    Returns:
+        A tuple of a pandas DataFrame summarising each point (its parameters, "Replicates", "Mean", "Std",
+        "Half Width" and "Converged"), a DataFrame of every replicate ("Point", "Replicate", "Seed" and the output)
+        and the elapsed wall time in seconds
+    """
+    if minReplicates < 2:
+        raise ValueError("minReplicates must be at least 2 for a confidence interval")
+    if minReplicates > maxReplicates:
+        raise ValueError("minReplicates must be at most maxReplicates")
+    seed = replicateSeeds(1, seed)[0]
+    runParams = [poolParameters(params) for params in points] if workers > 1 else points
+    samples = [[] for p in points]
+    launched = [0] * len(points)
+    runs = []
+
+    def nextPoint():
+        """ The point to launch a replicate for next, None if none needs one now """
+        needing = [p for p in range(len(points)) if launched[p] < minReplicates or
+                   (len(samples[p]) >= minReplicates and launched[p] < maxReplicates and
+                    confidenceHalfWidth(samples[p], confidence) > tolerance)]
+        return min(needing, key=lambda p: launched[p]) if needing else None
+
+    def record(p, replicate, value):
+        samples[p].append(value)
+        runs.append((p, replicate, seed + p * maxReplicates + replicate, value))
+
+    start = time.perf_counter()
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    running = {}
+    try:
+        while True:
+            while len(running) < workers:
+                p = nextPoint()
+                if p is None:
+                    break
+                replicate = launched[p]
+                launched[p] += 1
+                args = (runParams[p], seed + p * maxReplicates + replicate, [output])
+                if pool is None:
+                    record(p, replicate, finalValues(*args)[0])
+                else:
+                    running[pool.submit(finalValues, *args)] = (p, replicate)
+            if not running: # Nothing in flight and nothing left to launch
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                p, replicate = running.pop(future)
+                record(p, replicate, future.result()[0])
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    elapsed = time.perf_counter() - start
+
+    import pandas as pd
+    summary = []
+    for params, values in zip(points, samples):
+        halfWidth = confidenceHalfWidth(values, confidence)
+        summary.append(dict(params, **{"Replicates": len(values), "Mean": float(np.mean(values)),
+                                       "Std": float(np.std(values, ddof=1)) if len(values) > 1 else math.nan,
+                                       "Half Width": halfWidth, "Converged": halfWidth <= tolerance}))
+    runs = pd.DataFrame(sorted(runs), columns=["Point", "Replicate", "Seed", output])
+    return pd.DataFrame(summary), runs, elapsed
@@ -0,0 +1,81 @@
+import os
+import re
+import subprocess
+import sys
+import unittest
+
+
+# Performance budgets, checked by runbenchmarks.py rather than the regular test suite as they depend on the machine
+IMPORT_TIME_BUDGET = 0.25  # Seconds to import the simulation core (src.model and everything it imports)
+MEMORY_PER_YEAR_BUDGET = 4096  # Bytes of memory a model may hold on to per simulated year, mostly its collected data
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def importTime(module: str):
+    """
+    Measures the cumulative import time of a module in a fresh interpreter using python -X importtime
+
+    Args:
+        module: The dotted name of the module to import
+
+    Returns:
+        A tuple of the import time in seconds, excluding interpreter startup, and the set of modules imported
+    """
+    out = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                         capture_output=True, text=True, cwd=ROOT, check=True)
+    seconds = 0
+    modules = set()
+    for line in out.stderr.splitlines():
+        match = re.match(r"import time:\s+\d+\s+\|\s+(\d+)\s+\|\s*(\S+)", line)
+        if match is None:
+            continue
+        modules.add(match.group(2))
+        if match.group(2) == module:
+            seconds = int(match.group(1)) / 1e6
+    return seconds, modules
+
+
+class TestImportBudget(unittest.TestCase):
+
+    def testModelImportTime(self):
+        """ Test that importing the simulation core stays within the import time budget """
+        # Take the best of a few runs, the first can pay for a cold disk cache
+        seconds = min(importTime("src.model")[0] for i in range(3))
+        print("\nimport src.model: %.3fs (budget %.3fs)" % (seconds, IMPORT_TIME_BUDGET))
+        self.assertLess(seconds, IMPORT_TIME_BUDGET)
+
+    def testModelDefersOptionalSubsystems(self):
+        """ Test that importing the simulation core does not pull in pandas or the visualisation stack """
+        modules = importTime("src.model")[1]
+        for heavy in ("pandas", "tornado", "mesa.visualization", "mesa.datacollection"):
+            self.assertNotIn(heavy, modules)
+
+
+class TestMemoryBudget(unittest.TestCase):
+
+    def testMemoryPerYear(self):
+        """ Test that the memory a model holds on to grows by no more than the budget per simulated year """
+        from src.memory import MemoryProfiler
+        from src.model import EgyptSim
+        model = EgyptSim(height=20, width=20, timeSpan=200, startingSettlements=6, fission=True, seed=1)
+        profiler = MemoryProfiler(every=0)
+        profiler.attach(model)
+        try:
+            model.run()
+        finally:
+            profiler.detach()
+        perYear = profiler.report()["growthPer100Years"]["traced"] / 100
+        print("\nmemory per simulated year: %.0f bytes (budget %d bytes)" % (perYear, MEMORY_PER_YEAR_BUDGET))
+        self.assertLess(perYear, MEMORY_PER_YEAR_BUDGET)
+
+
+def suite():
+    """
+    Gather all benchmarks from this module into a test suite
+    """
+    testSuite = unittest.TestSuite()
+    testSuite.addTest(unittest.makeSuite(TestImportBudget))
+    testSuite.addTest(unittest.makeSuite(TestMemoryBudget))
+
+    return testSuite
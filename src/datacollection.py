@@ -0,0 +1,171 @@
+import numpy as np
+
+
+class EgyptDataCollector:
+    """
+    Collects model level data and tables for EgyptSim
+
+    A drop in for the parts of Mesa's DataCollector used by the model and the visualisation modules
+    (model_vars, tables, collect, add_table_row and the DataFrame getters). Mesa's version imports pandas
+    when its module is imported, which is most of the cost of importing the model, here pandas is only
+    imported once a DataFrame is actually requested.
+    """
+
+    def __init__(self, model_reporters: dict = None, tables: dict = None):
+        """
+        Create a new EgyptDataCollector
+
+        Args:
+            model_reporters: Dictionary of reporter names and functions that take the model and return a value
+            tables: Dictionary of table names and lists of their column names
+        """
+        self.model_reporters = {}
+        self.model_vars = {}
+        self.tables = {}
+
+        if model_reporters is not None:
+            for name, reporter in model_reporters.items():
+                self.model_reporters[name] = reporter
+                self.model_vars[name] = []
+
+        if tables is not None:
+            for name, columns in tables.items():
+                self.tables[name] = {column: [] for column in columns}
+
+    def collect(self, model):
+        """ Collect all the model level data for the given model """
+        for name, reporter in self.model_reporters.items():
+            self.model_vars[name].append(reporter(model))
+
+    def add_table_row(self, table_name: str, row: dict, ignore_missing: bool = False):
+        """
+        Add a row dictionary to a specific table
+
+        Args:
+            table_name: Name of the table to append a row to
+            row: A dictionary of the form {column_name: value...}
+            ignore_missing: If True, fill any missing columns with Nones, otherwise raise an error
+        """
+        if table_name not in self.tables:
+            raise Exception("Table does not exist.")
+
+        for column, values in self.tables[table_name].items():
+            if column in row:
+                values.append(row[column])
+            elif ignore_missing:
+                values.append(None)
+            else:
+                raise Exception("Could not insert row with missing column")
+
+    def get_model_vars_dataframe(self):
+        """ Create a pandas DataFrame from the model variables, one column per reporter and one row per collection """
+        import pandas as pd
+        return pd.DataFrame(self.model_vars)
+
+    def get_table_dataframe(self, table_name: str):
+        """ Create a pandas DataFrame from a table """
+        import pandas as pd
+        if table_name not in self.tables:
+            raise Exception("No such table.")
+        return pd.DataFrame(self.tables[table_name])
+
+
+class HouseholdPanel:
+    """
+    Collects panel data on a sample of EgyptSim's households: their grain, workers, ambition, competency and number of
+    fields, one row per sampled household per collected year
+
+    Rows are written into preallocated column arrays, doubled in size whenever they fill, so collecting costs a few
+    array writes per sampled household rather than a dictionary per household per year. Households can be sampled by
+    collecting only every few years, by following a fixed fraction of them, or by following the cohort alive when the
+    panel starts.
+    """
+
+    COLUMNS = {"Year": np.int32, "Household": np.int64, "Settlement": np.int64, "Grain": np.int64,
+               "Workers": np.int32, "Ambition": np.float64, "Competency": np.float64, "Fields": np.int32}
+
+    def __init__(self, every: int = 1, fraction: float = 1.0, cohort=None, capacity: int = 1024):
+        """
+        Create a new HouseholdPanel
+
+        Args:
+            every: Collect every this many years
+            fraction: The fraction of households followed. Whether a household is followed is decided by a hash of its
+                      id, so a followed household is followed for its whole life
+            cohort: Ids of the only households to follow, e.g. those alive when the panel starts. None to follow any
+            capacity: The number of rows allocated to begin with
+        """
+        if every < 1:
+            raise ValueError("every must be at least 1")
+        if not 0.0 <= fraction <= 1.0:
+            raise ValueError("fraction must be between 0 and 1")
+        self.every = every
+        self.fraction = fraction
+        self.cohort = None if cohort is None else np.array(sorted(cohort), dtype=np.int64)
+        self.size = 0
+        self.columns = {name: np.zeros(max(capacity, 1), dtype=dtype) for name, dtype in self.COLUMNS.items()}
+
+    def sampled(self, ids):
+        """
+        Returns a mask of the households in the sample
+
+        Args:
+            ids: Array of household ids
+        """
+        keep = np.ones(len(ids), dtype=bool)
+        if self.fraction < 1.0:
+            # Fibonacci hashing spreads consecutive ids evenly over [0, 1)
+            keep &= ((ids.astype(np.uint64) * np.uint64(11400714819323198485)) >> np.uint64(11)) / 2.0 ** 53 < self.fraction
+        if self.cohort is not None:
+            keep &= np.isin(ids, self.cohort)
+        return keep
+
+    def collect(self, model, households):
+        """
+        Collect a row for each sampled household, if the model's year is one to collect
+
+        Args:
+            model: The model
+            households: The model's live households
+        """
+        year = model.currentTime
+        if year % self.every:
+            return
+        ids = np.fromiter((h.unique_id for h in households), dtype=np.int64, count=len(households))
+        keep = self.sampled(ids)
+        if not keep.all():
+            households = [h for h, k in zip(households, keep.tolist()) if k]
+            ids = ids[keep]
+        n = len(households)
+        self.reserve(self.size + n)
+        rows = slice(self.size, self.size + n)
+        columns = self.columns
+        columns["Year"][rows] = year
+        columns["Household"][rows] = ids
+        columns["Settlement"][rows] = [h.settlement.unique_id for h in households]
+        columns["Grain"][rows] = [h.grain for h in households]
+        columns["Workers"][rows] = [h.workers for h in households]
+        columns["Ambition"][rows] = [h.ambition for h in households]
+        columns["Competency"][rows] = [h.competency for h in households]
+        columns["Fields"][rows] = [len(h.fields) for h in households]
+        self.size += n
+
+    def reserve(self, rows: int):
+        """ Grow the column arrays to hold at least this many rows """
+        capacity = len(self.columns["Year"])
+        if rows > capacity:
+            while capacity < rows:
+                capacity *= 2
+            for name, values in self.columns.items():
+                grown = np.zeros(capacity, dtype=values.dtype)
+                grown[:self.size] = values[:self.size]
+                self.columns[name] = grown
+
+    def data(self):
+        """ Dictionary of the collected columns, trimmed to the rows collected """
+        return {name: values[:self.size] for name, values in self.columns.items()}
+
+    def get_dataframe(self):
+        """ Create a pandas DataFrame of the panel, one row per sampled household per collected year """
+        import pandas as pd
+        return pd.DataFrame(self.data())
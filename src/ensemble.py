@@ -0,0 +1,638 @@
+import inspect
+import math
+
+import numpy as np
+
+from src.agents import MAX_GENERATION_REDRAWS
+from src.model import EgyptSim
+
+
+# Lockstep ensemble engine. Simulates many replicates of one EgyptSim parameter set at once, with the state of every
+# field, household and settlement held in arrays with a leading replicate axis instead of one Python object per agent.
+#
+# Each year follows the same phases as EgyptSim.step and EgyptSchedule.step_households: the flood, then every household
+# claims and farms in order of wealth, then rents, consumes, ages its fields, changes generation, grows and splits in
+# order of ambition, then dead settlements are torn down and the data collected. Households within a replicate still
+# act one after another, but the n-th household of every replicate acts at once, so the Python overhead is paid once
+# per household rank rather than once per household per replicate.
+#
+# The engine draws its random numbers differently to the object model (a household's chances of farming are drawn as
+# one binomial, for example), so replicates are equivalent to EgyptSim runs in distribution but do not reproduce a
+# seeded EgyptSim run. The model's quirks are kept: fields of dead households keep their owner and are paid rent,
+# and households dead during a step still finish it.
+
+MAX_YIELD = 2475
+
+
+def modelDefaults():
+    """ Returns the default EgyptSim parameters """
+    signature = inspect.signature(EgyptSim.__init__)
+    return {name: p.default for name, p in signature.parameters.items() if name not in ("self", "seed")}
+
+
+class EgyptEnsemble:
+    """
+    Simulates many replicates of a parameter set in lockstep, collecting the same data as EgyptSim for each replicate
+    """
+
+    def __init__(self, replicates: int, params: dict = None, seed: int = None):
+        """
+        Create a new ensemble
+
+        Args:
+            replicates: The number of replicates to simulate
+            params: EgyptSim constructor parameters, defaults are used for any not given
+            seed: Seed for the ensemble's random number generator, None for an unseeded run
+        """
+        defaults = modelDefaults()
+        params = dict(params or {})
+        unknown = set(params) - set(defaults)
+        if unknown:
+            raise TypeError("unknown EgyptSim parameters: " + ", ".join(sorted(unknown)))
+        if params.get("stopCondition") is not None:
+            raise TypeError("the ensemble does not take a stopCondition, it would be called once per replicate per year")
+        if params.get("eventLog") is not None:
+            raise TypeError("the ensemble does not keep an event log, run the replicate with EgyptSim to record one")
+        if params.get("panelEvery", 0) > 0:
+            raise TypeError("the ensemble does not collect household panels, run the replicate with EgyptSim to collect one")
+        if params.get("spatialStore") is not None:
+            raise TypeError("the ensemble does not record field rasters, run the replicate with EgyptSim to record them")
+        if params.get("inequalityAccuracy", 0) > 0:
+            raise TypeError("the ensemble computes its reporters exactly, it does not take an inequalityAccuracy")
+        defaults.update(params)
+        for name, value in defaults.items():
+            setattr(self, name, value)
+        if self.plateauReporter is not None and self.plateauReporter not in self.REPORTERS:
+            raise ValueError("unknown plateau reporter: %r" % self.plateauReporter)
+
+        self.replicates = replicates
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+        # Limit the number of settlements exactly as EgyptSim does
+        if self.startingSettlements > ((self.width - 1) * self.height) // (9 + (self.startingHouseholds * 2)):
+            if self.startingSettlements > 20:
+                self.startingSettlements = 20
+            else:
+                self.startingSettlements = ((self.height - 1) * self.width) // (9 + (self.startingHouseholds * 2))
+            print("Too many starting settlements to support the settlements and household, truncating to: ", self.startingSettlements)
+
+        self.currentTime = 0
+        self.startingPopulation = self.startingSettlements * self.startingHouseholds * self.startingHouseholdSize
+        self.rows = np.arange(replicates)
+        self.totalGrain = np.full(replicates, self.startingGrain * self.startingHouseholds * self.startingSettlements, dtype=np.int64)
+        self.totalPopulation = np.full(replicates, self.startingPopulation, dtype=np.int64)
+        self.projectedHistoricalPopulation = self.startingPopulation
+        self.maxHouseholdGrain = np.full(replicates, self.startingGrain, dtype=np.int64)
+        self.running = np.ones(replicates, dtype=bool)
+        self.stopReason = np.full(replicates, None, dtype=object) # Why each replicate stopped, as EgyptSim.stopReason
+        self.years = np.zeros(replicates, dtype=np.int64)
+
+        self.setupFields()
+        self.setupSettlements()
+        self.setupHouseholds()
+
+        self.columns = {name: [] for name in self.REPORTERS}
+        self.settlementColumns = ["s" + str(i + 1) + "_Population" for i in range(self.startingSettlements)]
+        self.collected = [] # Per step, the replicates still running when the data was collected
+        self.settlementPopulations = []
+        self.collect()
+
+    def setupFields(self):
+        """
+        Create the field state arrays. Fields are numbered row by row (y, then x), the order the grid lists a
+        settlement's neighbourhood in, so the first of several equally fertile fields in reach is the first by index.
+        """
+        self.fieldCount = (self.width - 1) * self.height
+        self.fieldX = np.tile(np.arange(1, self.width), self.height)
+        self.fieldY = np.repeat(np.arange(self.height), self.width - 1)
+        shape = (self.replicates, self.fieldCount)
+        self.fertility = np.zeros(shape)
+        self.harvested = np.zeros(shape, dtype=bool)
+        self.yearsFallow = np.zeros(shape, dtype=np.int64)
+        self.owned = np.zeros(shape, dtype=bool)
+        self.owner = np.full(shape, -1, dtype=np.int64) # Household slot, -1 for none
+        self.territory = np.zeros(shape, dtype=bool)
+
+    def fieldIndex(self, x, y):
+        """ The index of the field at (x, y) """
+        return y * (self.width - 1) + x - 1
+
+    def setupSettlements(self):
+        """
+        Place the settlements of every replicate, each on a cell outside the territory of the ones placed before it
+        """
+        R, S = self.replicates, self.startingSettlements
+        self.settlementX = np.zeros((R, S), dtype=np.int64)
+        self.settlementY = np.zeros((R, S), dtype=np.int64)
+        self.settlementTerritory = np.full((R, S, 9), -1, dtype=np.int64) # Fields in each territory, padded with -1
+        self.population = np.full((R, S), self.startingHouseholds * self.startingHouseholdSize, dtype=np.int64)
+        self.alive = np.ones((R, S), dtype=bool)
+
+        for r in range(R):
+            for s in range(S):
+                while True:
+                    x = int(self.rng.integers(1, self.width))
+                    y = int(self.rng.integers(self.height))
+                    if not self.territory[r, self.fieldIndex(x, y)]:
+                        break
+                self.settlementX[r, s] = x
+                self.settlementY[r, s] = y
+                # Moore neighbourhood including the settlement's own cell, river cells are never farmed so are left out
+                cells = [self.fieldIndex(x + dx, y + dy) for dy in (-1, 0, 1) for dx in (-1, 0, 1)
+                         if 1 <= x + dx < self.width and 0 <= y + dy < self.height]
+                self.settlementTerritory[r, s, :len(cells)] = cells
+                self.territory[r, cells] = True
+
+        # Settlements never move, so the fields within the knowledge radius of each are found once
+        distance = (np.abs(self.fieldX - self.settlementX[:, :, None]) +
+                    np.abs(self.fieldY - self.settlementY[:, :, None]))
+        self.reach = (distance <= self.knowledgeRadius) & (distance > 0)
+
+    def setupHouseholds(self):
+        """
+        Create the starting households. Each replicate's households occupy slots numbered in the order they were
+        created, slots of dead households are not reused.
+        """
+        R = self.replicates
+        n = self.startingSettlements * self.startingHouseholds
+        self.capacity = max(n, 1)
+        self.fieldCapacity = 4
+        self.slots = np.full(R, n, dtype=np.int64) # Slots used in each replicate, in the order households were added
+
+        shape = (R, self.capacity)
+        self.exists = np.zeros(shape, dtype=bool) # Households in the schedule
+        self.exists[:, :n] = True
+        self.settlement = np.zeros(shape, dtype=np.int64)
+        self.settlement[:, :n] = np.repeat(np.arange(self.startingSettlements), self.startingHouseholds)
+        self.grain = np.zeros(shape, dtype=np.int64)
+        self.grain[:, :n] = self.startingGrain
+        self.workers = np.zeros(shape, dtype=np.int64)
+        self.workers[:, :n] = self.startingHouseholdSize
+        self.ambition = np.zeros(shape)
+        self.ambition[:, :n] = self.rng.uniform(self.minAmbition, 1, (R, n))
+        self.competency = np.zeros(shape)
+        self.competency[:, :n] = self.rng.uniform(self.minCompetency, 1, (R, n))
+        self.generationCountdown = np.zeros(shape, dtype=np.int64)
+        self.generationCountdown[:, :n] = self.rng.integers(10, 15, (R, n))
+        self.workersWorked = np.zeros(shape, dtype=np.int64)
+        self.wealthRank = np.zeros(shape, dtype=np.int64)
+        self.fields = np.zeros((R, self.capacity, self.fieldCapacity), dtype=np.int64) # Owned fields in farming order
+        self.fieldCounts = np.zeros(shape, dtype=np.int64)
+
+    def growHouseholds(self):
+        """ Double the number of household slots """
+        old = self.capacity
+        self.capacity *= 2
+        for name in ("exists", "settlement", "grain", "workers", "ambition", "competency",
+                     "generationCountdown", "workersWorked", "wealthRank", "fieldCounts", "fields"):
+            array = getattr(self, name)
+            grown = np.zeros((self.replicates, self.capacity) + array.shape[2:], dtype=array.dtype)
+            grown[:, :old] = array
+            setattr(self, name, grown)
+
+    def growFields(self):
+        """ Double the number of fields a household can hold """
+        grown = np.zeros(self.fields.shape[:2] + (self.fieldCapacity * 2,), dtype=self.fields.dtype)
+        grown[:, :, :self.fieldCapacity] = self.fields
+        self.fields = grown
+        self.fieldCapacity *= 2
+
+    def step(self):
+        """ Advance every running replicate by a year """
+        self.currentTime += 1
+        self.maxHouseholdGrain[:] = 0
+        self.flood()
+        self.stepHouseholds()
+        self.teardownSettlements()
+        self.projectedHistoricalPopulation = round(self.startingPopulation * ((1.001) ** self.currentTime))
+        self.years[self.running] = self.currentTime
+        self.collect()
+        self.checkStop()
+
+    def checkStop(self):
+        """ Stops the replicates that meet one of EgyptSim's stop conditions, recording the reason """
+        stops = [("extinction", self.totalPopulation == 0),
+                 ("timeSpan", np.full(self.replicates, self.currentTime >= self.timeSpan))]
+        if self.minSettlements > 0:
+            stops.append(("settlements", self.columns["Settlements"][-1] <= self.minSettlements))
+        if self.plateauReporter is not None and len(self.columns[self.plateauReporter]) >= self.plateauWindow:
+            window = np.array(self.columns[self.plateauReporter][-self.plateauWindow:])
+            stops.append(("plateau", np.ptp(window, axis=0) <= self.plateauTolerance))
+        for reason, stop in stops:
+            stopping = self.running & stop
+            self.stopReason[stopping] = reason
+            self.running &= ~stopping
+
+    def run(self):
+        """ Step until every replicate has stopped """
+        while self.running.any():
+            self.step()
+
+    def flood(self):
+        """ Draw each replicate's flood and set the fertility of every field """
+        R = self.replicates
+        mu = self.rng.integers(0, 11, R) + 5
+        sigma = self.rng.integers(0, 6, R) + 5
+        alpha = (2 * sigma ** 2)[:, None]
+        beta = (1 / (sigma * math.sqrt(2 * math.pi)))[:, None]
+        # Fertility only depends on x, computed once per column and spread over the rows
+        x = np.arange(1, self.width)
+        fertility = 17 * (beta * np.exp(0 - (x - mu[:, None]) ** 2 / alpha))
+        self.fertility = fertility[:, self.fieldX - 1]
+        self.harvested[:] = False
+
+        # Rank of each field in order of fertility, equally fertile fields by index, so the best field to claim is the
+        # one of lowest rank. Barren fields are never claimed and are given the lowest rank of all.
+        order = np.argsort(-self.fertility, axis=1, kind="stable")
+        self.claimRank = np.empty(order.shape, dtype=np.int32)
+        self.claimRank[self.rows[:, None], order] = np.arange(self.fieldCount, dtype=np.int32)
+        self.claimRank[self.fertility <= 0] = self.fieldCount
+
+    def haulCost(self, rows, slots, fields):
+        """
+        The cost of hauling the harvest of fields back to the households' settlements
+
+        Args:
+            rows: Replicate of each household
+            slots: Slot of each household
+            fields: Array of fields, one row per household
+        """
+        settlement = self.settlement[rows, slots]
+        sx = self.settlementX[rows, settlement][:, None]
+        sy = self.settlementY[rows, settlement][:, None]
+        return ((sx - self.fieldX[fields]) + np.abs(sy - self.fieldY[fields])) * self.distanceCost
+
+    def chancesTaken(self, rows, slots, available, loops):
+        """
+        The number of fields a household harvests when it has no fees to collect while farming. Each of the loops
+        attempts harvests the next field if the household has enough grain to feed its workers or with a chance of
+        ambition * competency, so the number taken is a binomial draw capped at the fields available.
+        """
+        loops = np.maximum(loops, 0)
+        p = np.clip(self.ambition[rows, slots] * self.competency[rows, slots], 0, 1)
+        fed = self.grain[rows, slots] > self.workers[rows, slots] * 160
+        return np.minimum(available, np.where(fed, loops, self.rng.binomial(loops, p)))
+
+    def stepHouseholds(self):
+        """
+        Run the households of every replicate, in order of wealth to claim and farm, then in order of ambition to
+        rent, consume, age their fields, change generation, grow and split
+        """
+        R = self.replicates
+        # Wealth order, equally wealthy households in the order they were added, the order of their slots
+        order = np.lexsort((self.grain, ~self.exists), axis=-1)
+        counts = np.where(self.running, self.exists.sum(axis=1), 0)
+        ranks = counts.max(initial=0)
+        order = order[:, :ranks]
+        present = np.arange(ranks) < counts[:, None]
+        self.wealthRank[self.rows[:, None], order] = np.arange(ranks)
+        self.workersWorked[:] = 0
+
+        for k in range(ranks):
+            rows = np.flatnonzero(present[:, k])
+            slots = order[rows, k]
+            self.claimFields(rows, slots)
+            self.farm(rows, slots)
+
+        if self.rental:
+            self.queueRentals(order, present)
+            snapshot = np.zeros_like(self.exists)
+            snapshot[self.rows[:, None], order] = present
+            order = np.lexsort((self.wealthRank, self.ambition, ~snapshot), axis=-1)[:, :ranks]
+
+        for k in range(ranks):
+            rows = np.flatnonzero(present[:, k])
+            slots = order[rows, k]
+            if self.rental:
+                self.rent(rows, slots)
+            self.consumeGrain(rows, slots)
+            self.storageLoss(rows, slots)
+            self.fieldChangeover(rows, slots)
+            self.genChangeover(rows, slots)
+            self.populationShift(rows, slots)
+            if self.fission:
+                self.splitHouseholds(rows, slots)
+
+        # Update grain max for data collection
+        anyHouseholds = self.exists.any(axis=1)
+        richest = np.where(self.exists, self.grain, np.iinfo(np.int64).min).max(axis=1, initial=np.iinfo(np.int64).min)
+        self.maxHouseholdGrain[anyHouseholds] = np.maximum(richest[anyHouseholds], 0)
+
+    def claimFields(self, rows, slots):
+        """ Claim the most fertile free field in reach, for the households that decide to """
+        fieldCounts = self.fieldCounts[rows, slots]
+        chance = self.rng.random(len(rows))
+        claim = (((chance > self.ambition[rows, slots]) & (self.workers[rows, slots] > fieldCounts)) |
+                 (fieldCounts <= 1))
+        rows, slots, fieldCounts = rows[claim], slots[claim], fieldCounts[claim]
+        if len(rows) == 0:
+            return
+
+        free = self.reach[rows, self.settlement[rows, slots]] & ~(self.owned[rows] | self.territory[rows])
+        rank = np.where(free, self.claimRank[rows], self.fieldCount)
+        best = np.argmin(rank, axis=1)
+        found = rank[np.arange(len(rows)), best] < self.fieldCount
+        rows, slots, best, fieldCounts = rows[found], slots[found], best[found], fieldCounts[found]
+        if len(rows) == 0:
+            return
+
+        self.owned[rows, best] = True
+        self.owner[rows, best] = slots
+        self.harvested[rows, best] = False
+        self.yearsFallow[rows, best] = 0
+        while fieldCounts.max() >= self.fieldCapacity:
+            self.growFields()
+        self.fields[rows, slots, fieldCounts] = best
+        self.fieldCounts[rows, slots] += 1
+
+    def farm(self, rows, slots):
+        """ Farm the households' own fields, most fertile first """
+        fieldCounts = self.fieldCounts[rows, slots]
+        width = fieldCounts.max(initial=0)
+        if width == 0:
+            return
+        fields = self.fields[rows, slots, :width]
+        owned = np.arange(width) < fieldCounts[:, None]
+        index = rows[:, None]
+        # Stable sort on fertility, harvested fields last, kept as the household's farming order
+        key = np.where(self.harvested[index, fields], 1.0, -self.fertility[index, fields])
+        fields = np.take_along_axis(fields, np.argsort(np.where(owned, key, np.inf), axis=1, kind="stable"), axis=1)
+        self.fields[rows, slots, :width] = fields
+
+        available = (owned & ~self.harvested[index, fields]).sum(axis=1)
+        loops = (self.workers[rows, slots] - self.workersWorked[rows, slots]) // 2
+        taken = self.chancesTaken(rows, slots, available, loops)
+
+        harvests = (np.trunc(self.fertility[index, fields] * MAX_YIELD * self.competency[rows, slots][:, None]).astype(np.int64) -
+                    self.haulCost(rows, slots, fields))
+        harvested = np.arange(width) < taken[:, None]
+        totalHarvest = np.where(harvested, harvests - 300, 0).sum(axis=1) # -300 for planting
+        self.harvested[np.broadcast_to(index, fields.shape)[harvested], fields[harvested]] = True
+        self.workersWorked[rows, slots] += 2 * taken
+        self.grain[rows, slots] += totalHarvest
+        self.totalGrain[rows] += totalHarvest
+
+    def queueRentals(self, order, present):
+        """
+        Build each replicate's queue of fields to rent. Renting sorts the joined fields of every household on fertility,
+        harvested fields last, and farms from the front. Sorting again after a renter only moves the fields it harvested
+        behind the rest, so the renters take turns from the front of the unharvested fields as first sorted.
+        """
+        R = self.replicates
+        width = self.fieldCapacity
+        index = self.rows[:, None]
+        fields = self.fields[index, order].reshape(R, -1) # Joined in wealth order
+        counts = self.fieldCounts[index, order]
+        valid = ((np.arange(width) < counts[:, :, None]) & present[:, :, None]).reshape(R, -1)
+        valid &= ~self.harvested[index, np.where(valid, fields, 0)]
+
+        # Pack each replicate's unharvested fields to the front, keeping their order
+        lengths = valid.sum(axis=1)
+        rows, columns = np.nonzero(valid)
+        start = np.cumsum(lengths) - lengths
+        queue = np.zeros((R, lengths.max(initial=0)), dtype=np.int64)
+        queue[rows, np.arange(len(rows)) - start[rows]] = fields[rows, columns]
+        inQueue = np.arange(queue.shape[1]) < lengths[:, None]
+        key = np.where(inQueue, -self.fertility[index, queue], np.inf)
+        self.rentQueue = np.take_along_axis(queue, np.argsort(key, axis=1, kind="stable"), axis=1)
+        self.rentLengths = lengths
+        self.rentNext = np.zeros(R, dtype=np.int64)
+
+    def rent(self, rows, slots):
+        """ Farm the next unharvested fields in the replicates' rent queues, paying the rental fee to their owners """
+        loops = np.maximum((self.workers[rows, slots] - self.workersWorked[rows, slots]) // 2, 0)
+        available = self.rentLengths[rows] - self.rentNext[rows]
+        width = np.minimum(loops, available).max(initial=0)
+        if width == 0:
+            return
+        index = rows[:, None]
+        position = self.rentNext[rows][:, None] + np.arange(width)
+        inWindow = position < self.rentLengths[rows][:, None]
+        fields = self.rentQueue[index, np.minimum(position, self.rentQueue.shape[1] - 1)]
+        owners = np.where(inWindow, self.owner[index, fields], -1)
+        harvests = (np.trunc(self.fertility[index, fields] * MAX_YIELD * self.competency[rows, slots][:, None]).astype(np.int64) -
+                    self.haulCost(rows, slots, fields))
+        fees = np.where(owners >= 0, np.rint(harvests * self.rentalRate).astype(np.int64), 0)
+
+        # A household renting its own fields collects fees part way through, which can change whether it has enough grain
+        own = ((owners == slots[:, None]) & (np.arange(width) < loops[:, None])).any(axis=1)
+        taken = np.zeros(len(rows), dtype=np.int64)
+        taken[~own] = self.chancesTaken(rows[~own], slots[~own], available[~own], loops[~own])
+        if own.any():
+            taken[own] = self.sequentialChances(rows[own], slots[own], available[own], loops[own],
+                                                owners[own], fees[own])
+
+        harvested = (np.arange(width) < taken[:, None]) & inWindow
+        renterShare = np.where(owners >= 0, np.rint(harvests * (1 - self.rentalRate)).astype(np.int64) - 300, harvests - 300)
+        totalHarvest = np.where(harvested, renterShare, 0).sum(axis=1)
+        paid = harvested & (owners >= 0)
+        payer = np.broadcast_to(index, fields.shape)
+        self.harvested[payer[harvested], fields[harvested]] = True
+        np.add.at(self.grain, (payer[paid], owners[paid]), fees[paid])
+        np.add.at(self.totalGrain, payer[paid], fees[paid])
+        self.rentNext[rows] += taken
+        self.workersWorked[rows, slots] += 2 * taken
+        self.grain[rows, slots] += totalHarvest
+        self.totalGrain[rows] += totalHarvest
+
+    def sequentialChances(self, rows, slots, available, loops, owners, fees):
+        """
+        The number of fields harvested by households that collect fees from themselves while renting. The fields are
+        taken one at a time, the attempts until each is harvested drawn as a geometric variable while the household
+        cannot feed its workers.
+        """
+        p = np.clip(self.ambition[rows, slots] * self.competency[rows, slots], 0, 1)
+        grain = self.grain[rows, slots].copy()
+        threshold = self.workers[rows, slots] * 160
+        attempts = np.zeros(len(rows), dtype=np.int64)
+        taken = np.zeros(len(rows), dtype=np.int64)
+        for i in range(owners.shape[1]):
+            live = (attempts < loops) & (taken == i) & (taken < available)
+            if not live.any():
+                break
+            needed = np.where(p > 0, self.rng.geometric(np.where(p > 0, p, 1)), loops + 1)
+            attempts += np.where(live, np.where(grain > threshold, 1, needed), 0)
+            success = live & (attempts <= loops)
+            taken += success
+            grain += np.where(success & (owners[:, i] == slots), fees[:, i], 0)
+        return taken
+
+    def consumeGrain(self, rows, slots):
+        """ Feed the workers, a starving household loses a worker and dies once it has none """
+        eaten = self.workers[rows, slots] * 160
+        self.totalGrain[rows] -= eaten
+        grain = self.grain[rows, slots] - eaten
+        starving = grain <= 0
+        self.totalGrain[rows] -= np.where(starving, grain, 0) # Add back negative grain
+        self.grain[rows, slots] = np.where(starving, 0, grain)
+
+        rows, slots = rows[starving], slots[starving]
+        self.workers[rows, slots] -= 1
+        np.subtract.at(self.population, (rows, self.settlement[rows, slots]), 1)
+        self.totalPopulation[rows] -= 1
+
+        dead = self.workers[rows, slots] <= 0
+        rows, slots = rows[dead], slots[dead]
+        for r, s in zip(rows.tolist(), slots.tolist()):
+            self.owned[r, self.fields[r, s, :self.fieldCounts[r, s]]] = False
+        self.exists[rows, slots] = False
+
+    def storageLoss(self, rows, slots):
+        """ Lose a tenth of the stored grain """
+        loss = np.rint(self.grain[rows, slots] * 0.1).astype(np.int64)
+        self.totalGrain[rows] -= loss
+        self.grain[rows, slots] -= loss
+
+    def fieldChangeover(self, rows, slots):
+        """ Age the households' fields and release those left fallow for the fallow limit """
+        fieldCounts = self.fieldCounts[rows, slots]
+        width = fieldCounts.max(initial=0)
+        if width == 0:
+            return
+        fields = self.fields[rows, slots, :width]
+        owned = np.arange(width) < fieldCounts[:, None]
+        index = np.broadcast_to(rows[:, None], fields.shape)
+        rows2, fields2 = index[owned], fields[owned]
+        yearsFallow = np.where(self.harvested[rows2, fields2], 0, self.yearsFallow[rows2, fields2] + 1)
+        self.yearsFallow[rows2, fields2] = yearsFallow
+
+        expired = np.zeros(fields.shape, dtype=bool)
+        expired[owned] = yearsFallow >= self.fallowLimit
+        if expired.any():
+            self.owned[index[expired], fields[expired]] = False
+            self.owner[index[expired], fields[expired]] = -1
+            # Keep the remaining fields in order
+            kept = np.argsort(~owned | expired, axis=1, kind="stable")
+            self.fields[rows, slots, :width] = np.take_along_axis(fields, kept, axis=1)
+            self.fieldCounts[rows, slots] -= expired.sum(axis=1)
+
+    def genChangeover(self, rows, slots):
+        """ Hand over households whose generation has ended, redrawing their ambition and competency """
+        self.generationCountdown[rows, slots] -= 1
+        due = self.generationCountdown[rows, slots] <= 0
+        rows, slots = rows[due], slots[due]
+        if len(rows) == 0:
+            return
+        self.generationCountdown[rows, slots] = self.rng.integers(10, 16, len(rows))
+        # As in the object model, changes are redrawn until the new value lies outside (minimum, 1], at most
+        # MAX_GENERATION_REDRAWS times, so that one household no draw can move does not hold up every replicate
+        for trait, minimum in ((self.ambition, self.minAmbition), (self.competency, self.minCompetency)):
+            pending = np.ones(len(rows), dtype=bool)
+            for _ in range(MAX_GENERATION_REDRAWS):
+                if not pending.any():
+                    break
+                change = self.rng.uniform(0, self.generationalVariation, len(rows))
+                change = np.where(self.rng.random(len(rows)) < 0.5, -change, change)
+                value = trait[rows, slots] + change
+                accept = pending & ((value > 1) | (value < minimum))
+                trait[rows[accept], slots[accept]] = value[accept]
+                pending &= ~accept
+
+    def populationShift(self, rows, slots):
+        """ Grow households while the population is below the projected growth """
+        limit = self.startingPopulation * ((1 + (self.popGrowthRate / 100)) ** self.currentTime)
+        grow = (self.totalPopulation[rows] <= limit) & (self.rng.random(len(rows)) > 0.5)
+        rows, slots = rows[grow], slots[grow]
+        self.workers[rows, slots] += 1
+        np.add.at(self.population, (rows, self.settlement[rows, slots]), 1)
+        self.totalPopulation[rows] += 1
+
+    def splitHouseholds(self, rows, slots):
+        """
+        Split a new household off large and wealthy households, into a new slot
+
+        Args:
+            rows: Replicate of each household
+            slots: Slot of each household
+        """
+        chance = self.rng.random(len(rows))
+        split = ((self.fissionChance < chance) & (self.workers[rows, slots] >= 15) &
+                 (self.grain[rows, slots] > (3 * self.workers[rows, slots] * (164))))
+        for r, s in zip(rows[split].tolist(), slots[split].tolist()):
+            if self.slots[r] >= self.capacity:
+                self.growHouseholds()
+            new = self.slots[r]
+            self.slots[r] += 1
+            self.exists[r, new] = True
+            self.settlement[r, new] = self.settlement[r, s]
+            self.grain[r, new] = 1100 # Grain for 5 workers and 1 field
+            self.workers[r, new] = 5
+            self.ambition[r, new] = self.rng.uniform(self.minAmbition, 1)
+            self.competency[r, new] = self.rng.uniform(self.minCompetency, 1)
+            self.generationCountdown[r, new] = self.rng.integers(10, 15)
+            self.workersWorked[r, new] = 0
+            self.fieldCounts[r, new] = 0
+            self.workers[r, s] -= 5
+            self.grain[r, s] -= 5
+
+    def teardownSettlements(self):
+        """
+        Tear down settlements without population, releasing their territory. A settlement's population only reaches
+        zero when its last worker dies, so these are the settlements EgyptSchedule queues for teardown.
+        """
+        rows, settlements = np.nonzero(self.alive & (self.population == 0))
+        if len(rows):
+            cells = self.settlementTerritory[rows, settlements]
+            index = np.broadcast_to(rows[:, None], cells.shape)
+            inTerritory = cells >= 0
+            self.territory[index[inTerritory], cells[inTerritory]] = False
+            self.alive[rows, settlements] = False
+
+    # Reporter names, matching EgyptSim's data collector
+    REPORTERS = ("Households", "Settlements", "Total Grain", "Total Population",
+                 "Projected Hisorical Poulation (0.1% Growth)", "Gini-Index", "Maximum Settlement Population",
+                 "Minimum Settlement Population", "Mean Settlement Poulation", "Maximum Household Wealth",
+                 "Minimum Household Wealth", "Mean Household Wealth",
+                 "Number of households with < 33% of wealthiest grain holding",
+                 "Number of households with 33 - 66%  of wealthiest grain holding",
+                 "Number of households with > 66% of wealthiest grain holding")
+
+    def collect(self):
+        """ Collect the model level data and settlement populations of every running replicate """
+        households = self.exists.sum(axis=1)
+        grain = np.where(self.exists, self.grain, 0)
+        totalHouseholdGrain = grain.sum(axis=1)
+        settlements = self.alive.sum(axis=1)
+        population = np.where(self.alive, self.population, 0)
+        sortedGrain = np.sort(np.where(self.exists, self.grain, np.iinfo(np.int64).max), axis=1)
+        rank = np.arange(self.capacity)
+        weights = np.where(rank < households[:, None], households[:, None] - rank, 0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            B = (np.where(weights > 0, sortedGrain, 0) * weights).sum(axis=1) / (households * totalHouseholdGrain)
+            gini = np.where(households != 0, np.round(1 + (1 / households) - 2 * B, 2), 0)
+            meanWealth = np.where(households != 0, np.round(totalHouseholdGrain / households, 2), 0)
+            meanPopulation = np.where(settlements != 0, np.round(population.sum(axis=1) / settlements, 2), 0)
+
+        lower = (self.exists & (grain <= self.maxHouseholdGrain[:, None] / 3)).sum(axis=1)
+        upper = (self.exists & (grain > 2 * self.maxHouseholdGrain[:, None] / 3)).sum(axis=1)
+        values = (households, settlements, self.totalGrain, self.totalPopulation,
+                  np.full(self.replicates, self.projectedHistoricalPopulation),
+                  gini,
+                  population.max(axis=1, initial=0),
+                  np.where(settlements != 0, np.where(self.alive, self.population, np.inf).min(axis=1, initial=np.inf), np.inf),
+                  meanPopulation,
+                  np.maximum(grain.max(axis=1, initial=0), 0),
+                  np.where(households != 0, np.where(self.exists, self.grain, np.inf).min(axis=1, initial=np.inf), np.inf),
+                  meanWealth, lower, households - lower - upper, upper)
+        for name, value in zip(self.REPORTERS, values):
+            self.columns[name].append(np.array(value))
+        self.collected.append(self.running.copy())
+        self.settlementPopulations.append(np.where(self.alive, self.population, -1))
+
+    def results(self):
+        """
+        Returns the collected data of each replicate as a dictionary of columns, laid out as batch.runModel returns
+        them: the model reporters followed by the settlement population table, one entry per collected year
+        """
+        collected = np.array(self.collected)
+        columns = {name: np.array(values) for name, values in self.columns.items()}
+        populations = np.array(self.settlementPopulations)
+        results = []
+        for r in range(self.replicates):
+            steps = collected[:, r]
+            data = {name: values[steps, r].tolist() for name, values in columns.items()}
+            for s, name in enumerate(self.settlementColumns):
+                data[name] = [None if p < 0 else p for p in populations[steps, r, s].tolist()]
+            results.append(data)
+        return results
@@ -0,0 +1,182 @@
+import numpy as np
+
+from src.headers import readHeader
+
+
+# Opt-in event log for EgyptSim. With EgyptSim(eventLog=path) every claim, harvest, rental, fallow release, change in
+# a household's workers, fission and settlement extinction is recorded as a fixed width record. Records are written
+# into a preallocated buffer and appended to the file whenever it fills and when the model stops running, so recording
+# costs one array write per event. EventLog reads a log back and rebuilds the ownership of fields, the households and
+# their workers and the surviving settlements at the end of any year, without simulating it again.
+#
+# A log starts with a 16 byte header, the magic bytes, the format version and the number of fields, then the records.
+
+MAGIC = b"EGYPTEV\0"
+VERSION = 1
+HEADER = np.dtype([("magic", "S8"), ("version", "<u4"), ("fields", "<u4")])
+EVENT = np.dtype([("year", "<i4"), ("kind", "u1"), ("household", "<i8"), ("other", "<i8"), ("field", "<i4"),
+                  ("amount", "<i8")])
+
+# Kinds of event, what the household, other, field and amount of their records hold
+FOUND = 0 # A household of the starting population: the household, its settlement, -, its workers
+CLAIM = 1 # A field claimed: the household, -, the field, -
+HARVEST = 2 # A household harvesting its own field: the household, -, the field, the harvest
+RENT = 3 # A household harvesting a field it rents: the renter, the owner, the field, the harvest
+RELEASE = 4 # A field left fallow too long and released: the household, -, the field, -
+DEATH = 5 # A worker dying of hunger: the household, its settlement, -, the workers left, 0 once the household has died
+GROWTH = 6 # A worker joining a household: the household, its settlement, -, its workers
+FISSION = 7 # A household splitting off another: the household, the new household, -, the workers it took
+EXTINCTION = 8 # A settlement whose population reached zero torn down: -, the settlement, -, -
+KINDS = ("found", "claim", "harvest", "rent", "release", "death", "growth", "fission", "extinction")
+
+
+class EventRecorder:
+    """
+    Records the events of one model into a buffer, appending it to a binary log file whenever it fills
+    """
+
+    def __init__(self, path: str, fields: int, capacity: int = 65536):
+        """
+        Create a new log file, replacing any at path
+
+        Args:
+            path: The file to write
+            fields: The number of fields of the model
+            capacity: The number of records buffered between writes
+        """
+        self.path = path
+        self.buffer = np.zeros(capacity, dtype=EVENT)
+        self.size = 0
+        self.written = 0
+        with open(path, "wb") as f:
+            np.array([(MAGIC, VERSION, fields)], dtype=HEADER).tofile(f)
+
+    def record(self, year: int, kind: int, household: int = -1, other: int = -1, field: int = -1, amount: int = 0):
+        """ Record a single event """
+        if self.size >= len(self.buffer):
+            self.flush()
+        self.buffer[self.size] = (year, kind, household, other, field, amount)
+        self.size += 1
+
+    def recordMany(self, year: int, kind: int, household: int, other, fields, amounts):
+        """
+        Record events of one kind by one household, one per field
+
+        Args:
+            year: The year of the events
+            kind: The kind of the events
+            household: The household's id
+            other: The other party of each event, or one for all of them
+            fields: Array of field indices
+            amounts: The amount of each event, or one for all of them
+        """
+        n = len(fields)
+        if self.size + n > len(self.buffer):
+            self.flush()
+            if n > len(self.buffer):
+                self.buffer = np.zeros(n, dtype=EVENT)
+        events = self.buffer[self.size:self.size + n]
+        events["year"] = year
+        events["kind"] = kind
+        events["household"] = household
+        events["other"] = other
+        events["field"] = fields
+        events["amount"] = amounts
+        self.size += n
+
+    def flush(self):
+        """ Append the buffered records to the log file """
+        if self.size:
+            with open(self.path, "ab") as f:
+                self.buffer[:self.size].tofile(f)
+            self.written += self.size
+            self.size = 0
+
+
+class ReplayState:
+    """
+    The state of a model at the end of a year, rebuilt from its event log
+
+    Attributes:
+        year: The year replayed up to
+        fieldOwner: The id of the household owning each field, -1 for fields nobody owns
+        households: Dictionary of live household ids and [settlement id, workers] lists
+        settlements: Set of the ids of the settlements that have not been torn down
+    """
+
+    def __init__(self, year: int, fields: int):
+        self.year = year
+        self.fieldOwner = np.full(fields, -1, dtype=np.int64)
+        self.households = {}
+        self.settlements = set()
+
+    def fieldsOf(self, household: int):
+        """ The indices of the fields a household owns """
+        return np.flatnonzero(self.fieldOwner == household)
+
+
+class EventLog:
+    """
+    Reads an event log written by EventRecorder
+    """
+
+    def __init__(self, path: str):
+        """
+        Open a log, memory mapping its records
+
+        Args:
+            path: The log file
+        """
+        header = readHeader(path, HEADER, MAGIC, VERSION, "event log")
+        self.fields = int(header["fields"])
+        self.records = np.memmap(path, dtype=EVENT, mode="r", offset=HEADER.itemsize)
+
+    def events(self, year: int = None, kind: int = None):
+        """
+        Returns the records of a year and/or kind, in the order they happened
+
+        Args:
+            year: Only the events of this year
+            kind: Only events of this kind, e.g. RENT
+        """
+        keep = np.ones(len(self.records), dtype=bool)
+        if year is not None:
+            keep &= self.records["year"] == year
+        if kind is not None:
+            keep &= self.records["kind"] == kind
+        return np.asarray(self.records[keep])
+
+    def stateAt(self, year: int):
+        """
+        Rebuild the ownership of fields, the households and the settlements at the end of a year by replaying the log
+
+        Args:
+            year: The year to replay up to, 0 for the starting state
+        """
+        state = ReplayState(year, self.fields)
+        records = self.records[self.records["year"] <= year]
+        changes = records[np.isin(records["kind"], (FOUND, CLAIM, RELEASE, DEATH, GROWTH, FISSION, EXTINCTION))]
+        households = state.households
+        for kind, household, other, field, amount in zip(changes["kind"].tolist(), changes["household"].tolist(),
+                                                         changes["other"].tolist(), changes["field"].tolist(),
+                                                         changes["amount"].tolist()):
+            if kind == FOUND:
+                households[household] = [other, amount]
+                state.settlements.add(other)
+            elif kind == CLAIM:
+                state.fieldOwner[field] = household
+            elif kind == RELEASE:
+                state.fieldOwner[field] = -1
+            elif kind == DEATH or kind == GROWTH:
+                if household not in households: # A worker joining in the year its household died, after it was removed
+                    continue
+                households[household][1] = amount
+                if amount <= 0: # The household died with its last worker, leaving its fields
+                    del households[household]
+                    state.fieldOwner[state.fieldOwner == household] = -1
+            elif kind == FISSION:
+                households[household][1] -= amount
+                households[other] = [households[household][0], amount]
+            elif kind == EXTINCTION:
+                state.settlements.discard(other)
+        return state
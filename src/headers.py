@@ -0,0 +1,26 @@
+import numpy as np
+
+
+# The binary files EgyptSim writes, event logs (src.events) and spatial stores (src.spatial), each start with a header
+# record of their own whose first two fields are 8 magic bytes naming the kind of file and the version of its format.
+# readHeader reads that record and rejects any file that is not of the kind and version asked for.
+
+
+def readHeader(path: str, dtype, magic: bytes, version: int, kind: str):
+    """
+    Read the header of a file, checking its magic bytes and format version
+
+    Args:
+        path: The file
+        dtype: The header's record type, starting with fields "magic" and "version"
+        magic: The magic bytes of the kind of file
+        version: The format version that can be read
+        kind: The kind of file, for the error raised for any other file, e.g. "event log"
+
+    Returns:
+        The header record
+    """
+    header = np.fromfile(path, dtype=dtype, count=1)
+    if len(header) == 0 or header["magic"][0] != magic.rstrip(b"\0") or header["version"][0] != version:
+        raise ValueError("%s is not an EgyptSim %s" % (path, kind))
+    return header[0]
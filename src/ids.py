@@ -0,0 +1,49 @@
+# Integer ids for EgyptSim's agents. Each kind of agent has its own range of ids: the kind is kept in the low bits of
+# the id and the rest counts the agents of that kind in the order they were created, so ids never collide, are cheap to
+# hash and lead straight to an agent's position in the arrays holding the state of its kind. Readable labels, such as
+# "s1" for the first settlement, are only made where they are shown, in the DataCollector tables and the visualisation.
+
+RIVER, FIELD, SETTLEMENT, HOUSEHOLD, FARM = range(5)
+KIND_BITS = 3
+KIND_MASK = (1 << KIND_BITS) - 1
+LABEL_PREFIXES = {RIVER: "r", FIELD: "f", SETTLEMENT: "s", HOUSEHOLD: "h", FARM: "farm"}
+
+
+class IdAllocator:
+    """
+    Hands out the ids of one model's agents, in order within each kind
+    """
+
+    def __init__(self):
+        self.counts = [0] * (1 << KIND_BITS)
+
+    def allocate(self, kind: int):
+        """
+        Returns a new id
+
+        Args:
+            kind: The kind of agent, one of RIVER, FIELD, SETTLEMENT, HOUSEHOLD or FARM
+        """
+        serial = self.counts[kind]
+        self.counts[kind] += 1
+        return makeId(kind, serial)
+
+
+def makeId(kind: int, serial: int):
+    """ The id of the serial-th agent of a kind, counting from 0 """
+    return (serial << KIND_BITS) | kind
+
+
+def idKind(uid: int):
+    """ The kind of agent an id belongs to """
+    return uid & KIND_MASK
+
+
+def idSerial(uid: int):
+    """ The position of an agent among those of its kind, in the order they were created """
+    return uid >> KIND_BITS
+
+
+def idLabel(uid: int):
+    """ A readable label for an id, the kind's prefix followed by the agent's position counting from 1, e.g. "s1" """
+    return LABEL_PREFIXES[idKind(uid)] + str(idSerial(uid) + 1)
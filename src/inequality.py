@@ -0,0 +1,257 @@
+import math
+
+import numpy as np
+
+
+# Inequality statistics over very many values, such as the grain of hundreds of thousands of households,
+# without sorting or keeping all of them. A QuantileSketch sorts values into logarithmic buckets, each holding the
+# values within a factor gamma = (1 + accuracy) / (1 - accuracy) of each other, and keeps the number and the exact sum
+# of the values in each bucket, in the manner of DDSketch. Adding values is one vectorised pass with no sort, the
+# number of buckets only grows with the logarithm of the range of the values, and sketches of different populations,
+# such as the households of several replicates or workers, merge into a sketch of all of them by adding their buckets.
+# The count, total, minimum and maximum are kept exactly alongside. Zeros are counted, and negative values, such as the
+# grain of the few households that paid more than they had, are kept as they are.
+#
+# Rank based sketches (KLL, t-digest) bound the error of ranks, but the Gini-Index and the shares of the top are
+# carried by the few largest values, where a rank error of a fraction of a percent can misplace a large part of the
+# total. Buckets with exact sums bound the errors relative to the values instead:
+#
+#   - quantiles are within a factor of 1 +/- accuracy of the true value
+#   - the Gini-Index is underestimated by at most accuracy / (1 - accuracy), only differences within a bucket are lost
+#   - the share of the top is off by at most the share of the one bucket split by the cut
+#
+# With accuracy=None every value is kept and every statistic is exact.
+#
+#     sketch = QuantileSketch(accuracy=0.01)
+#     sketch.update(grain)
+#     sketch.gini(), sketch.percentile(90), sketch.topShare(0.01)
+
+
+class QuantileSketch:
+    """
+    Mergeable summary of a population of values for quantiles and inequality statistics
+    """
+
+    def __init__(self, accuracy: float = 0.01):
+        """
+        Create a new, empty QuantileSketch
+
+        Args:
+            accuracy: The relative accuracy of the quantiles, between 0 and 1. None to keep every value, an exact sketch
+        """
+        if accuracy is not None and not 0 < accuracy < 1:
+            raise ValueError("accuracy must be between 0 and 1")
+        self.accuracy = accuracy
+        if accuracy is not None:
+            self.gamma = (1 + accuracy) / (1 - accuracy)
+            self.logGamma = math.log(self.gamma)
+        self.clear()
+
+    def clear(self):
+        """ Empty the sketch """
+        self.values = [] # Arrays of every value added, for an exact sketch
+        self.offset = 0 # The key of the first bucket, values in bucket key are in (gamma ** (key - 1), gamma ** key]
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.sums = np.zeros(0)
+        self.zeros = 0 # The number of values equal to 0, which have no bucket
+        self.negatives = [] # Arrays of the negative values, kept exactly
+        self.count = 0
+        self.total = 0
+        self.minimum = math.inf
+        self.maximum = -math.inf
+
+    @property
+    def exact(self):
+        """ If the sketch keeps every value """
+        return self.accuracy is None
+
+    @property
+    def size(self):
+        """ The number of values or buckets the sketch keeps """
+        if self.exact:
+            return sum(len(values) for values in self.values)
+        return len(self.counts) + sum(len(values) for values in self.negatives)
+
+    def update(self, values):
+        """
+        Add values to the sketch
+
+        Args:
+            values: Array or sequence of numbers
+        """
+        values = np.asarray(values).ravel()
+        if len(values) == 0:
+            return
+        self.count += len(values)
+        self.total += values.sum().item()
+        self.minimum = min(self.minimum, values.min().item())
+        self.maximum = max(self.maximum, values.max().item())
+        if self.exact:
+            self.values.append(values.copy())
+            return
+        positive = values[values > 0]
+        if self.minimum < 0:
+            negative = values[values < 0]
+            if len(negative):
+                self.negatives.append(negative)
+        else:
+            negative = ()
+        self.zeros += len(values) - len(positive) - len(negative)
+        if len(positive):
+            keys = np.ceil(np.log(positive.astype(float)) / self.logGamma).astype(np.int64)
+            first = int(keys.min())
+            self.addBuckets(first, np.bincount(keys - first), np.bincount(keys - first, weights=positive))
+
+    def add(self, value):
+        """ Add a single value to the sketch, update is much faster for many values at once """
+        self.update([value])
+
+    def addBuckets(self, first: int, counts, sums):
+        """ Add the counts and sums of consecutive buckets starting from key first, growing the buckets to hold them """
+        if len(self.counts) == 0:
+            self.offset = first
+            self.counts = np.array(counts, dtype=np.int64)
+            self.sums = np.array(sums, dtype=float)
+            return
+        start = min(self.offset, first)
+        stop = max(self.offset + len(self.counts), first + len(counts))
+        if start != self.offset or stop != self.offset + len(self.counts):
+            grownCounts = np.zeros(stop - start, dtype=np.int64)
+            grownSums = np.zeros(stop - start)
+            grownCounts[self.offset - start:self.offset - start + len(self.counts)] = self.counts
+            grownSums[self.offset - start:self.offset - start + len(self.sums)] = self.sums
+            self.offset, self.counts, self.sums = start, grownCounts, grownSums
+        self.counts[first - start:first - start + len(counts)] += counts
+        self.sums[first - start:first - start + len(sums)] += sums
+
+    def merge(self, other):
+        """
+        Add the values summarised by another sketch, leaving it unchanged
+
+        Args:
+            other: QuantileSketch of the same accuracy to merge into this one
+        """
+        if self.accuracy != other.accuracy:
+            raise ValueError("cannot merge sketches of different accuracy")
+        self.count += other.count
+        self.total += other.total
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        if self.exact:
+            self.values.extend(values.copy() for values in other.values)
+        else:
+            self.zeros += other.zeros
+            self.negatives.extend(values.copy() for values in other.negatives)
+            if len(other.counts):
+                self.addBuckets(other.offset, other.counts, other.sums)
+
+    def groups(self):
+        """
+        The population as groups of equal values in ascending order, the mean of each bucket standing for its values
+
+        Returns:
+            A tuple of the arrays of the values and of the number of values in each group
+        """
+        if self.exact:
+            values = np.sort(np.concatenate(self.values)) if self.values else np.zeros(0)
+            return values, np.ones(len(values), dtype=np.int64)
+        used = self.counts > 0
+        negatives = self.sortedNegatives()
+        values = np.concatenate((negatives, [0.0] if self.zeros else [], self.sums[used] / self.counts[used]))
+        counts = np.concatenate((np.ones(len(negatives), dtype=np.int64), [self.zeros] if self.zeros else [],
+                                 self.counts[used])).astype(np.int64)
+        return values, counts
+
+    def sortedNegatives(self):
+        """ The negative values in ascending order """
+        return np.sort(np.concatenate(self.negatives)) if self.negatives else np.zeros(0)
+
+    def rank(self, value):
+        """
+        The number of values less than or equal to a value. The values in the bucket of value are all counted, those
+        up to a factor of gamma above it may be counted too.
+        """
+        if self.exact:
+            return int(sum(np.count_nonzero(values <= value) for values in self.values))
+        negatives = int(sum(np.count_nonzero(values <= value) for values in self.negatives))
+        if value < 0:
+            return negatives
+        if value == 0:
+            return negatives + self.zeros
+        index = math.ceil(math.log(value) / self.logGamma) - self.offset + 1
+        return negatives + self.zeros + int(self.counts[:max(index, 0)].sum())
+
+    def quantile(self, q: float):
+        """
+        The smallest value with at least a fraction q of the values less than or equal to it
+
+        Args:
+            q: The fraction, from 0 to 1
+
+        Returns:
+            The value, within a factor of 1 +/- accuracy. nan for an empty sketch
+        """
+        if self.count == 0:
+            return math.nan
+        rank = max(q * self.count, 1)
+        if self.exact:
+            values = self.groups()[0]
+            return values[min(int(math.ceil(rank)) - 1, len(values) - 1)].item()
+        negatives = self.sortedNegatives()
+        if rank <= len(negatives):
+            return negatives[int(math.ceil(rank)) - 1].item()
+        rank -= len(negatives)
+        if rank <= self.zeros or len(self.counts) == 0:
+            return 0
+        index = int(np.searchsorted(np.cumsum(self.counts), rank - self.zeros, side="left"))
+        key = self.offset + min(index, len(self.counts) - 1)
+        # The point of the bucket within a factor of 1 +/- accuracy of all of it
+        value = 2 * self.gamma ** key / (self.gamma + 1)
+        return min(max(value, self.minimum), self.maximum)
+
+    def percentile(self, p: float):
+        """ The p-th percentile, quantile(p / 100) """
+        return self.quantile(p / 100)
+
+    def gini(self):
+        """
+        The Gini-Index of the values, 0 if they sum to 0. An exact sketch of integers gives exactly the value
+        src.model.gini calculates before rounding, an approximate one is at most accuracy / (1 - accuracy) lower.
+        """
+        if self.count == 0 or self.total <= 0:
+            return 0.0
+        values, counts = self.groups()
+        n = self.count
+        if self.exact and values.dtype.kind in "iu" and n * self.total < 2 ** 62:
+            # Sum of the running totals, that is of each value times the number of values from it to the largest
+            B = int(np.cumsum(values).sum()) / (n * int(self.total))
+            return 1 + (1 / n) - 2 * B
+        # Twice the area under the Lorenz curve, which is straight across each group of equal values
+        mass = values * counts
+        cumulative = np.cumsum(mass)
+        total = cumulative[-1]
+        return 1 + float((counts * mass).sum() / (n * total)) - 2 * float((counts * cumulative).sum() / (n * total))
+
+    def topShare(self, fraction: float):
+        """
+        The share of the total held by the largest values
+
+        Args:
+            fraction: The fraction of the values, k / n for the k largest of n
+
+        Returns:
+            The share, from 0 to 1, 0 if the values sum to 0
+        """
+        if self.count == 0 or self.total <= 0:
+            return 0.0
+        values, counts = self.groups()
+        values, counts = values[::-1], counts[::-1]
+        mass = values * counts
+        target = fraction * self.count
+        covered = np.cumsum(counts)
+        index = int(np.searchsorted(covered, target, side="left"))
+        share = float(mass[:index].sum())
+        if index < len(values):
+            # Part of a group, at its mean
+            share += float(target - (covered[index - 1] if index else 0)) * float(values[index])
+        return share / float(mass.sum())
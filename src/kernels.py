@@ -0,0 +1,184 @@
+import functools
+import importlib.util
+import warnings
+
+import numpy as np
+
+
+# Kernels for the hot loops of a household's year: choosing the field to claim, ordering fields for farming, computing
+# their harvests and deciding how many are harvested when a household rents its own fields.
+#
+# Each kernel works on the model's field state arrays only, so it can be compiled. The python backend uses the NumPy
+# versions. The numba backend compiles the loop versions with Numba when it is installed, they are written in the subset
+# of Python and NumPy Numba supports and give exactly the same results. Random numbers are always drawn by the caller,
+# from the model's generators, so a seeded run is the same whichever backend is used.
+
+BACKENDS = ("python", "numba")
+
+
+def bestClaim(reach, fertility, owned, territory):
+    """
+    Finds the most fertile free field within reach, the first one in reach order if tied
+
+    Args:
+        reach: Indices of the fields within the settlement's knowledge radius
+        fertility: Fertility of every field
+        owned: Ownership of every field
+        territory: If each field is part of a settlement's territory
+
+    Returns:
+        The index of the field to claim, -1 if no field is free
+    """
+    fertilities = fertility[reach]
+    free = np.flatnonzero((fertilities > 0) & ~owned[reach] & ~territory[reach])
+    if len(free) == 0:
+        return -1
+    return reach[free[np.argmax(fertilities[free])]]
+
+
+def farmingOrder(fields, fertility, harvested):
+    """
+    Sorts fields in place into farming order: on fertility, harvested fields last. The sort is stable, equally fertile
+    fields are farmed in array order.
+
+    Args:
+        fields: Array of field indices
+        fertility: Fertility of every field
+        harvested: If each field has been harvested this year
+
+    Returns:
+        The number of unharvested fields, which are at the front of the array
+    """
+    done = harvested[fields]
+    fields[:] = fields[np.argsort(np.where(done, 1.0, -fertility[fields]), kind="stable")]
+    return len(fields) - np.count_nonzero(done)
+
+
+def harvestYields(candidates, fertility, fieldX, fieldY, haulCost, competency, maxYield):
+    """
+    The harvest each field would yield once hauled back to the settlement
+
+    Args:
+        candidates: Indices of the fields
+        fertility: Fertility of every field
+        fieldX: x coordinate of every field
+        fieldY: y coordinate of every field
+        haulCost: The settlement's haul cost raster, indexed [x, y]
+        competency: Competency of the farming household
+        maxYield: The yield of a field of fertility 1
+    """
+    return (np.trunc(fertility[candidates] * maxYield * competency).astype(np.int64) -
+            haulCost[fieldX[candidates], fieldY[candidates]])
+
+
+def sequentialTaken(chances, fees, grain, threshold, chanceLimit, taken):
+    """
+    Takes chances on the candidate fields one at a time, for a household renting fields it owns itself. The fee it
+    pays itself for each of its own fields counts towards its grain for the following chances.
+
+    Args:
+        chances: The chances drawn, one per attempt
+        fees: The fee paid to the household for each candidate field, 0 for fields it does not own
+        grain: The household's grain
+        threshold: Grain above which every attempt succeeds
+        chanceLimit: Chance below which an attempt succeeds
+        taken: The number of candidates already harvested
+
+    Returns:
+        A tuple of the number of candidates harvested and the household's grain
+    """
+    for chance in chances:
+        if grain > threshold or chance < chanceLimit:
+            grain += fees[taken]
+            taken += 1
+    return taken, grain
+
+
+def bestClaimLoop(reach, fertility, owned, territory):
+    """ Loop version of bestClaim """
+    best = -1
+    bestFertility = 0.0
+    for i in reach:
+        if fertility[i] > 0 and not owned[i] and not territory[i] and (best == -1 or fertility[i] > bestFertility):
+            best = i
+            bestFertility = fertility[i]
+    return best
+
+
+def farmingOrderLoop(fields, fertility, harvested):
+    """ Loop version of farmingOrder """
+    keys = np.empty(len(fields))
+    unharvested = 0
+    for i in range(len(fields)):
+        if harvested[fields[i]]:
+            keys[i] = 1.0
+        else:
+            keys[i] = -fertility[fields[i]]
+            unharvested += 1
+    fields[:] = fields[np.argsort(keys, kind="mergesort")]
+    return unharvested
+
+
+def harvestYieldsLoop(candidates, fertility, fieldX, fieldY, haulCost, competency, maxYield):
+    """ Loop version of harvestYields """
+    harvests = np.empty(len(candidates), dtype=np.int64)
+    for i in range(len(candidates)):
+        field = candidates[i]
+        harvests[i] = np.int64(np.trunc(fertility[field] * maxYield * competency)) - haulCost[fieldX[field], fieldY[field]]
+    return harvests
+
+
+class Kernels:
+    """
+    The kernels used by one backend
+    """
+
+    def __init__(self, name: str, bestClaim, farmingOrder, harvestYields, sequentialTaken):
+        """
+        Create a new set of kernels
+
+        Args:
+            name: The name of the backend
+        """
+        self.name = name
+        self.bestClaim = bestClaim
+        self.farmingOrder = farmingOrder
+        self.harvestYields = harvestYields
+        self.sequentialTaken = sequentialTaken
+
+
+PYTHON_KERNELS = Kernels("python", bestClaim, farmingOrder, harvestYields, sequentialTaken)
+
+
+def loopKernels():
+    """ Returns the loop versions of the kernels, uncompiled """
+    return Kernels("loops", bestClaimLoop, farmingOrderLoop, harvestYieldsLoop, sequentialTaken)
+
+
+@functools.lru_cache(maxsize=None)
+def numbaKernels():
+    """
+    Returns the loop versions of the kernels compiled with Numba. Numba is only imported here, it takes longer to import
+    than the rest of the model. Compiled kernels are cached on disk, so only the first run pays for compilation.
+    """
+    import numba
+    loops = loopKernels()
+    return Kernels("numba", *(numba.njit(cache=True)(f) for f in
+                              (loops.bestClaim, loops.farmingOrder, loops.harvestYields, loops.sequentialTaken)))
+
+
+def loadKernels(backend: str = "python"):
+    """
+    Returns the kernels of a backend, falling back to the python backend with a warning if Numba is not installed
+
+    Args:
+        backend: One of BACKENDS
+    """
+    if backend not in BACKENDS:
+        raise ValueError("unknown backend %r, expected one of %s" % (backend, ", ".join(BACKENDS)))
+    if backend == "numba":
+        if importlib.util.find_spec("numba") is None:
+            warnings.warn("numba is not installed, using the python backend")
+            return PYTHON_KERNELS
+        return numbaKernels()
+    return PYTHON_KERNELS
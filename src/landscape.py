@@ -0,0 +1,199 @@
+import functools
+import math
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+
+# The parts of EgyptSim's world that only depend on the grid's geometry: which cells are river and which are fields,
+# where each field lies, the fertility of every column under each possible flood, the distances grain is hauled over and
+# the fields within the knowledge radius of every cell. Every model of the same geometry shares one read only copy.
+#
+# Without a directory a landscape is built once per process and shared by the models the process runs. With one, the
+# first process to need a geometry saves it there as .npy files and every process, the first included, memory maps the
+# files, so the operating system keeps a single copy in its page cache however many workers attach to it.
+
+# Where process pools share their landscapes unless told otherwise
+SHARED_LANDSCAPES = os.path.join(tempfile.gettempdir(), "egypt-landscapes")
+LANDSCAPE_VERSION = 1 # Bumped whenever the layout of the arrays changes, so stale saved landscapes are not attached
+# Floods are drawn by EgyptSim.setupFlood as mu = randint(0, 10) + 5 and sigma = randint(0, 5) + 5
+FLOOD_MU = range(5, 16)
+FLOOD_SIGMA = range(5, 11)
+# The number of geometries loadLandscape keeps per process, enough for a sweep over every knowledge radius slider value
+CACHED_LANDSCAPES = 16
+
+
+def floodFertility(x, mu, sigma):
+    """
+    The fertility of column x under the flood (mu, sigma), computed exactly as Field.flood does
+
+    Args:
+        x: The column of the field
+        mu: Mean of the flood
+        sigma: Standard deviation of the flood
+    """
+    alpha = (2 * sigma ** 2)
+    beta = 1 / (sigma * math.sqrt(2 * math.pi))
+    return 17 * (beta * (math.exp(0 - (x - mu) ** 2 / alpha)))
+
+
+class Landscape:
+    """
+    Read only arrays describing a grid geometry, shared between every model of that geometry
+    """
+
+    ARRAYS = ("river", "fieldIndex", "fieldX", "fieldY", "floodProfiles", "columnDistance", "rowDistance",
+              "reachStart", "reachFields")
+
+    def __init__(self, width: int, height: int, knowledgeRadius: int, arrays: dict):
+        """
+        Create a landscape from its arrays, see build. The arrays are made read only, as every model of the geometry
+        shares them
+
+        Args:
+            width: The width of the grid
+            height: The height of the grid
+            knowledgeRadius: The radius of the neighbourhoods in reach
+            arrays: Dictionary of the arrays named in ARRAYS
+        """
+        self.width = width
+        self.height = height
+        self.knowledgeRadius = knowledgeRadius
+        for name in self.ARRAYS:
+            arrays[name].setflags(write=False)
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def build(cls, width: int, height: int, knowledgeRadius: int):
+        """
+        Compute the landscape of a geometry
+
+        Args:
+            width: The width of the grid
+            height: The height of the grid
+            knowledgeRadius: The radius of the neighbourhoods in reach
+        """
+        x = np.arange(width)
+        y = np.arange(height)
+        river = np.zeros((width, height), dtype=bool)
+        river[0, :] = True
+        # Fields are numbered in the order EgyptSim.setupMapBase creates them, the order of MultiGrid.coord_iter
+        fieldIndex = np.full((width, height), -1, dtype=np.int32)
+        fieldIndex[~river] = np.arange(np.count_nonzero(~river))
+        fieldX, fieldY = (a.astype(np.int64) for a in np.nonzero(~river))
+
+        floodProfiles = np.array([[[floodFertility(column, mu, sigma) for column in range(width)]
+                                   for sigma in FLOOD_SIGMA] for mu in FLOOD_MU])
+
+        # Haul distances as Settlement.haulCostRaster takes them, separable into a column and a row part
+        columnDistance = x[:, None] - x[None, :]
+        rowDistance = np.abs(y[:, None] - y[None, :])
+
+        # Von Neumann neighbourhoods in the order MultiGrid.iter_neighborhood lists them, rows outer and columns inner
+        r = knowledgeRadius
+        dy, dx = (a.ravel() for a in np.mgrid[-r:r + 1, -r:r + 1])
+        keep = (np.abs(dx) + np.abs(dy) <= r) & ((dx != 0) | (dy != 0))
+        dx, dy = dx[keep], dy[keep]
+        counts = np.zeros(width * height, dtype=np.int64)
+        chunks = []
+        for column in range(width): # One column of cells at a time bounds the size of the temporaries
+            nx = column + dx[None, :]
+            ny = y[:, None] + dy[None, :]
+            inside = (nx >= 0) & (nx < width) & (ny >= 0) & (ny < height)
+            fields = np.where(inside, fieldIndex[np.clip(nx, 0, width - 1), np.clip(ny, 0, height - 1)], -1)
+            counts[column * height:(column + 1) * height] = (fields >= 0).sum(axis=1)
+            chunks.append(fields[fields >= 0])
+        reachStart = np.concatenate([[0], np.cumsum(counts)])
+        reachFields = np.concatenate(chunks).astype(np.int32)
+
+        return cls(width, height, knowledgeRadius, {
+            "river": river, "fieldIndex": fieldIndex, "fieldX": fieldX, "fieldY": fieldY,
+            "floodProfiles": floodProfiles, "columnDistance": columnDistance, "rowDistance": rowDistance,
+            "reachStart": reachStart, "reachFields": reachFields})
+
+    def save(self, path: str):
+        """
+        Save the landscape as a directory of .npy files. The directory is written under a temporary name and renamed
+        into place, so processes racing to save the same landscape never see a partial one.
+
+        Args:
+            path: The directory to create
+        """
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        staging = tempfile.mkdtemp(dir=parent)
+        for name in self.ARRAYS:
+            np.save(os.path.join(staging, name + ".npy"), getattr(self, name))
+        try:
+            os.rename(staging, path)
+        except OSError: # Another process saved it first
+            shutil.rmtree(staging)
+
+    @classmethod
+    def attach(cls, path: str, width: int, height: int, knowledgeRadius: int):
+        """
+        Memory map a saved landscape, read only
+
+        Args:
+            path: The directory the landscape was saved to
+            width: The width of the grid
+            height: The height of the grid
+            knowledgeRadius: The radius of the neighbourhoods in reach
+        """
+        # Plain array views of the maps, so that compiled kernels take them like any other array
+        arrays = {name: np.asarray(np.load(os.path.join(path, name + ".npy"), mmap_mode="r")) for name in cls.ARRAYS}
+        return cls(width, height, knowledgeRadius, arrays)
+
+    def fieldsInReach(self, pos: tuple):
+        """
+        The indices of the fields within the knowledge radius of a cell, in the order the grid lists the neighbourhood
+
+        Args:
+            pos: The cell
+        """
+        cell = pos[0] * self.height + pos[1]
+        return self.reachFields[self.reachStart[cell]:self.reachStart[cell + 1]]
+
+    def haulDistance(self, pos: tuple):
+        """
+        The distance grain is hauled from every cell back to pos, indexed [x, y]
+
+        Args:
+            pos: The cell grain is hauled to
+        """
+        return self.columnDistance[pos[0]][:, None] + self.rowDistance[pos[1]][None, :]
+
+    def floodProfile(self, mu: int, sigma: int):
+        """
+        The fertility of every column under the flood (mu, sigma)
+
+        Args:
+            mu: Mean of the flood
+            sigma: Standard deviation of the flood
+        """
+        if mu in FLOOD_MU and sigma in FLOOD_SIGMA:
+            return self.floodProfiles[mu - FLOOD_MU.start, sigma - FLOOD_SIGMA.start]
+        return np.array([floodFertility(column, mu, sigma) for column in range(self.width)])
+
+
+@functools.lru_cache(maxsize=CACHED_LANDSCAPES)
+def loadLandscape(width: int, height: int, knowledgeRadius: int, directory: str = None):
+    """
+    Returns the landscape of a geometry, built or attached once per process. Only the CACHED_LANDSCAPES geometries
+    used last are kept, the models holding older ones keep them alive as long as they need them
+
+    Args:
+        width: The width of the grid
+        height: The height of the grid
+        knowledgeRadius: The radius of the neighbourhoods in reach
+        directory: Directory of saved landscapes to attach to, saving the landscape there first if it is missing.
+                   None to build it in this process's memory.
+    """
+    if directory is None:
+        return Landscape.build(width, height, knowledgeRadius)
+    path = os.path.join(directory, "landscape-%dx%d-r%d-v%d" % (width, height, knowledgeRadius, LANDSCAPE_VERSION))
+    if not os.path.isdir(path):
+        Landscape.build(width, height, knowledgeRadius).save(path)
+    return Landscape.attach(path, width, height, knowledgeRadius)
@@ -0,0 +1,170 @@
+import gc
+import tracemalloc
+
+import numpy as np
+
+from src.agents import Farm, Field, Household, River, Settlement
+from src.schedule import PHASES
+
+
+# Opt-in memory accounting for EgyptSim, for tracking down objects that outlive their use. A MemoryProfiler observes the
+# phases of EgyptSchedule.step: it measures the memory traced by tracemalloc that each phase leaves allocated, and every
+# few years counts the live instances of each agent class and takes a tracemalloc snapshot at the end of each phase.
+# Counting with the garbage collector finds agents that are no longer scheduled but still referenced, such as dead
+# households still named as a field's owner. The report gives the growth of each per 100 years.
+#
+#     profiler = MemoryProfiler(every=10)
+#     profiler.attach(model)
+#     model.run()
+#     print(profiler.report()["growthPer100Years"])
+
+
+def liveInstances(classes):
+    """
+    Counts the live instances of each class, including objects no longer reachable from the model. Garbage is
+    collected first, so that only objects something still refers to are counted.
+
+    Args:
+        classes: The classes to count, subclasses are counted under their own class only
+    """
+    gc.collect()
+    counts = dict.fromkeys(classes, 0)
+    for obj in gc.get_objects():
+        cls = type(obj)
+        if cls in counts:
+            counts[cls] += 1
+    return {cls.__name__: count for cls, count in counts.items()}
+
+
+def growthPer100Years(years, values):
+    """ The least squares slope of values over years, per 100 years, 0 with fewer than two distinct years """
+    years = np.asarray(years, dtype=float)
+    if len(np.unique(years)) < 2:
+        return 0.0
+    return round(float(np.polyfit(years, np.asarray(values, dtype=float), 1)[0] * 100), 6)
+
+
+class MemoryProfiler:
+    """
+    Observer of EgyptSchedule's phases, accounting for the memory each phase allocates and the agents that stay alive
+    """
+
+    def __init__(self, every: int = 10, classes=(River, Field, Settlement, Household, Farm), frames: int = 1):
+        """
+        Create a new MemoryProfiler
+
+        Args:
+            every: Count live objects and take snapshots in the years that are a multiple of this, 0 to never
+            classes: The classes whose live instances are counted
+            frames: The number of frames tracemalloc keeps for each allocation, if it is started by the profiler
+        """
+        self.every = every
+        self.classes = tuple(classes)
+        self.frames = frames
+        self.model = None
+        self.startedTracing = False
+        self.phaseStart = {}
+        self.phaseBytes = dict.fromkeys(PHASES, 0) # Net bytes left allocated by each phase over every run of it
+        self.phaseRuns = dict.fromkeys(PHASES, 0)
+        self.years = [] # Years the traced memory was measured at the end of
+        self.traced = [] # Memory traced at the end of each of those years
+        self.countYears = [] # Years the live objects were counted in
+        self.counts = [] # Dictionaries of class names and live instance counts
+        self.unscheduled = [] # Dictionaries of class names and live instances that have left the schedule
+        self.firstSnapshots = {} # The first and latest snapshot taken at the end of each phase
+        self.lastSnapshots = {}
+
+    def attach(self, model):
+        """
+        Start profiling a model's steps, starting tracemalloc if it is not already tracing
+
+        Args:
+            model: The EgyptSim to profile
+        """
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+            self.startedTracing = True
+        self.model = model
+        model.schedule.phaseObservers.append(self)
+        self.sample(model.currentTime, self.every > 0)
+
+    def detach(self):
+        """ Stop profiling, stopping tracemalloc if the profiler started it """
+        if self.model is not None:
+            self.model.schedule.phaseObservers.remove(self)
+            self.model = None
+        if self.startedTracing:
+            tracemalloc.stop()
+            self.startedTracing = False
+
+    def sampleYear(self, year: int):
+        """ If the live objects are counted and snapshots taken in a year """
+        return self.every > 0 and year % self.every == 0
+
+    def sample(self, year: int, count: bool):
+        """ Record the memory traced at the end of a year, counting the live objects if asked """
+        current = tracemalloc.get_traced_memory()[0]
+        if self.years and self.years[-1] == year: # A later phase of the same year
+            self.traced[-1] = current
+        else:
+            self.years.append(year)
+            self.traced.append(current)
+        if count and (not self.countYears or self.countYears[-1] != year):
+            counts = liveInstances(self.classes)
+            schedule = self.model.schedule
+            self.countYears.append(year)
+            self.counts.append(counts)
+            self.unscheduled.append({cls.__name__: counts[cls.__name__] - schedule.get_breed_count(cls)
+                                     for cls in self.classes if cls in schedule.agents_by_breed})
+
+    def phaseStarted(self, name: str):
+        """ Measure the traced memory before a phase """
+        self.phaseStart[name] = tracemalloc.get_traced_memory()[0]
+
+    def phaseEnded(self, name: str):
+        """ Account for the memory a phase left allocated, sampling the year if it is one to sample """
+        current = tracemalloc.get_traced_memory()[0]
+        self.phaseBytes[name] = self.phaseBytes.get(name, 0) + current - self.phaseStart.pop(name)
+        self.phaseRuns[name] = self.phaseRuns.get(name, 0) + 1
+        year = self.model.currentTime
+        if self.sampleYear(year):
+            snapshot = tracemalloc.take_snapshot()
+            self.firstSnapshots.setdefault(name, snapshot)
+            self.lastSnapshots[name] = snapshot
+        # Counted once the settlements are torn down, no agents are added or removed later in the year
+        self.sample(year, self.sampleYear(year) and name == "settlements")
+
+    def topGrowth(self, phase: str, limit: int = 10):
+        """
+        The source lines whose allocations at the end of a phase grew the most between the first and latest snapshots
+
+        Args:
+            phase: One of PHASES
+            limit: The number of lines to return
+
+        Returns:
+            List of tracemalloc.StatisticDiff, largest growth first
+        """
+        if phase not in self.lastSnapshots:
+            return []
+        return self.lastSnapshots[phase].compare_to(self.firstSnapshots[phase], "lineno")[:limit]
+
+    def report(self):
+        """
+        Summarises the profile
+
+        Returns:
+            A dictionary of the years profiled, the memory traced at the end of the last one, the mean bytes each phase
+            leaves allocated, the live instances of each class at each count and those of the scheduled classes that
+            are no longer scheduled, and the growth per 100 years of the traced memory and of the live instances of
+            each class
+        """
+        growth = {"traced": growthPer100Years(self.years, self.traced)}
+        for name in (cls.__name__ for cls in self.classes):
+            growth[name] = growthPer100Years(self.countYears, [counts[name] for counts in self.counts])
+        return {"years": self.years[-1] - self.years[0] if self.years else 0,
+                "traced": self.traced[-1] if self.traced else 0,
+                "phaseBytes": {name: self.phaseBytes[name] / runs for name, runs in self.phaseRuns.items() if runs},
+                "counts": dict(zip(self.countYears, self.counts)),
+                "unscheduled": dict(zip(self.countYears, self.unscheduled)),
+                "growthPer100Years": growth}
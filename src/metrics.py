@@ -0,0 +1,191 @@
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from src.agents import Field, Household, Settlement
+from src.schedule import PHASES
+
+
+# Live performance metrics for long running simulations. A RunMetrics follows the models run by its process, timing
+# each phase of their steps and counting the years and replicates finished, and serveMetrics serves its snapshots over
+# HTTP, as JSON at /metrics.json and in the Prometheus text format at /metrics. The headless runner serves them when
+# given --metricsPort, and AsyncModularServer(metrics=True) adds the same two pages to the visualisation server.
+#
+# Models run on the worker processes of a pool are only seen as they finish, the model being stepped, its phase timings
+# and its agent counts are reported for models run in the serving process.
+
+
+def residentMemory():
+    """ The resident set size of this process in bytes, its peak where the current size cannot be read. None if neither can """
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+    except ImportError: # Windows
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024 # Bytes on macOS, kilobytes elsewhere
+
+
+class PhaseTimer:
+    """
+    Observer of EgyptSchedule's phases, timing the last run of each phase and the total time spent in it
+    """
+
+    def __init__(self):
+        self.started = {}
+        self.last = dict.fromkeys(PHASES, 0.0)
+        self.total = dict.fromkeys(PHASES, 0.0)
+
+    def phaseStarted(self, name: str):
+        """ Start timing a phase """
+        self.started[name] = time.perf_counter()
+
+    def phaseEnded(self, name: str):
+        """ Stop timing a phase """
+        elapsed = time.perf_counter() - self.started.pop(name)
+        self.last[name] = elapsed
+        self.total[name] = self.total.get(name, 0.0) + elapsed
+
+
+class RunMetrics:
+    """
+    Throughput and state of the simulations run by one process
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.timer = PhaseTimer()
+        self.model = None # The model being run in this process
+        self.modelStart = 0 # The year it was at when it started being watched
+        self.yearsFinished = 0 # Years simulated by the finished runs
+        self.replicatesFinished = 0
+
+    def watch(self, model):
+        """
+        Follow a model run in this process, timing the phases of its steps. A model followed before it, such as the
+        one a visualisation server's reset replaces, has its years counted and is no longer followed.
+
+        Args:
+            model: The EgyptSim to follow
+        """
+        with self.lock:
+            if self.model is not None:
+                self.yearsFinished += self.model.currentTime - self.modelStart
+                self.model.schedule.phaseObservers.remove(self.timer)
+            model.schedule.phaseObservers.append(self.timer)
+            self.model = model
+            self.modelStart = model.currentTime
+
+    def finished(self, years: int, model=None):
+        """
+        Count a finished run
+
+        Args:
+            years: The number of years it simulated
+            model: The model, if it was being watched, so its years are not counted twice
+        """
+        with self.lock:
+            self.yearsFinished += years
+            self.replicatesFinished += 1
+            if model is not None and model is self.model:
+                model.schedule.phaseObservers.remove(self.timer)
+                self.model = None
+
+    def snapshot(self):
+        """ Returns the current metrics as a dictionary """
+        with self.lock:
+            model = self.model
+            years = self.yearsFinished
+            if model is not None:
+                years += model.currentTime - self.modelStart
+            elapsed = time.perf_counter() - self.start
+            snapshot = {"uptime_seconds": elapsed,
+                        "years_simulated": years,
+                        "years_per_second": years / elapsed if elapsed > 0 else 0.0,
+                        "replicates_finished": self.replicatesFinished,
+                        "rss_bytes": residentMemory(),
+                        "phase_seconds": dict(self.timer.last),
+                        "phase_seconds_total": dict(self.timer.total)}
+            if model is not None:
+                collector = model.datacollector
+                snapshot.update({
+                    "step": model.currentTime,
+                    "running": bool(model.running),
+                    "households": model.schedule.get_breed_count(Household),
+                    "settlements": model.schedule.get_breed_count(Settlement),
+                    "fields": model.schedule.get_breed_count(Field),
+                    "datacollector_rows": len(model.collectedYears),
+                    "datacollector_values": sum(len(values) for values in collector.model_vars.values()) +
+                                            sum(len(values) for table in collector.tables.values() for values in table.values())})
+            return snapshot
+
+
+def prometheusText(snapshot: dict):
+    """
+    Formats a snapshot in the Prometheus text exposition format
+
+    Args:
+        snapshot: Dictionary returned by RunMetrics.snapshot
+    """
+    lines = []
+    for name, value in snapshot.items():
+        metric = "egypt_" + name
+        if isinstance(value, dict):
+            kind = "counter" if name.endswith("_total") else "gauge"
+            lines.append("# TYPE %s %s" % (metric, kind))
+            for phase, seconds in value.items():
+                lines.append('%s{phase="%s"} %r' % (metric, phase, float(seconds)))
+        elif value is not None:
+            lines.append("# TYPE %s gauge" % metric)
+            lines.append("%s %r" % (metric, float(value)))
+    return "\n".join(lines) + "\n"
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    """ Serves the snapshots of the server's RunMetrics """
+
+    def do_GET(self):
+        snapshot = self.server.metrics.snapshot()
+        if self.path == "/metrics":
+            body, contentType = prometheusText(snapshot), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, contentType = json.dumps(snapshot), "application/json"
+        else:
+            self.send_error(404)
+            return
+        body = body.encode()
+        self.send_response(200)
+        self.send_header("Content-Type", contentType)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scraped every few seconds, not worth a line each
+
+
+def serveMetrics(metrics: RunMetrics, port: int, host: str = "127.0.0.1"):
+    """
+    Serve a RunMetrics over HTTP on a daemon thread, which stops with the process
+
+    Args:
+        metrics: The metrics to serve
+        port: The port to listen on, 0 for any free port
+        host: The interface to listen on, only this machine by default
+
+    Returns:
+        The running ThreadingHTTPServer, its server_address gives the port and shutdown() stops it
+    """
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.metrics = metrics
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,27 +1,27 @@
+import bisect
 import math
 import random
 import numpy as np
 
 from mesa import Model
-from mesa.datacollection import DataCollector
 from mesa.space import MultiGrid
 
 from src.agents import River, Field, Settlement, Household
+from src.datacollection import EgyptDataCollector, HouseholdPanel
+from src.ids import FIELD, HOUSEHOLD, RIVER, SETTLEMENT, IdAllocator, idLabel, makeId
+from src.events import FOUND, EventRecorder
+from src.spatial import SpatialRecorder
+from src.inequality import QuantileSketch
+from src.kernels import loadKernels
+from src.landscape import loadLandscape
 from src.schedule import EgyptSchedule
 
 # Data collctor methods
 def gini(model):
     """Calculates the Gini-Index of the model"""
-    # Sorting functor
-    def wealth(agent):
-        return agent.grain
-
-    agents = model.schedule.get_breed(Household)
-    # print(agent_wealths)
-    agents.sort(key = wealth)
-    x = []
-    for agent in agents:
-        x.append(agent.grain)
+    if model.inequality is not None:
+        return round(model.inequality.gini(), 2)
+    x = [agent.grain for agent in model.schedule.wealthOrder()]
     N = model.schedule.get_breed_count(Household)
     # Avoid divide by 0 errors
     if N != 0:
@@ -61,21 +61,17 @@ def meanSetPop(model):
 
 def minHWealth(model):
     """Finds the minimum household wealth in the model"""
-    households = model.schedule.get_breed(Household)
-    minWealth = float("inf") # Workaround of removal of sys.maxint
-    for household in households:
-        if(minWealth > household.grain):
-            minWealth = household.grain
-    return minWealth
+    households = model.schedule.wealthOrder()
+    if households:
+        return households[0].grain
+    return float("inf") # Workaround of removal of sys.maxint
 
 def maxHWealth(model):
     """Finds the maximum household wealth in the model"""
-    households = model.schedule.get_breed(Household)
-    maxWealth = 0
-    for household in households:
-        if(maxWealth < household.grain):
-            maxWealth = household.grain
-    return maxWealth
+    households = model.schedule.wealthOrder()
+    if households:
+        return max(households[-1].grain, 0)
+    return 0
 
 def meanHWealth(model):
     """Finds the mean household wealth in the model"""
@@ -89,32 +85,37 @@ def meanHWealth(model):
         return 0
 
 
+def grainHoldings(model):
+    """
+    Counts the households holding up to a third, between a third and two thirds and over two thirds of the highest
+    grain total, by bisecting the households' grain in wealth order, or from the ranks of the quantile sketch
+    """
+    if model.inequality is not None:
+        lower = model.inequality.rank(model.maxHouseholdGrain / 3)
+        upper = model.inequality.rank(2 * model.maxHouseholdGrain / 3)
+        return lower, upper - lower, model.inequality.count - upper
+    grains = [household.grain for household in model.schedule.wealthOrder()]
+    lower = bisect.bisect_right(grains, model.maxHouseholdGrain / 3)
+    upper = bisect.bisect_right(grains, 2 * model.maxHouseholdGrain / 3)
+    return lower, upper - lower, len(grains) - upper
+
 def lowerThirdGrainHoldings(model):
     """ Determines the number of households that hold below 33% of the highest grain total"""
-    households = model.schedule.get_breed(Household)
-    count = 0
-    for household in households:
-        if household.grain <= (model.maxHouseholdGrain / 3):
-            count += 1
-    return count
+    return grainHoldings(model)[0]
 
 def middleThirdGrainHoldings(model):
     """ Determines the number of households that hold between 33% and 66% of the highest grain total"""
-    households = model.schedule.get_breed(Household)
-    count = 0
-    for household in households:
-        if ((household.grain > (model.maxHouseholdGrain / 3)) and (household.grain <= ( 2 * model.maxHouseholdGrain / 3))):
-            count += 1
-    return count
+    return grainHoldings(model)[1]
 
 def upperThirdGrainHoldings(model):
     """ Determines the number of households that hold above 66% of the highest grain total"""
-    households = model.schedule.get_breed(Household)
-    count = 0
-    for household in households:
-        if household.grain > ( 2 * model.maxHouseholdGrain / 3):
-            count += 1
-    return count
+    return grainHoldings(model)[2]
+
+
+# Reasons a model stops running: everyone died, the time span ran out, no more than minSettlements settlements survive,
+# the plateau reporter plateaued or the stop condition was met
+STOP_REASONS = ("extinction", "timeSpan", "settlements", "plateau", "stopCondition")
+
 
 class EgyptSim(Model):
     """
@@ -144,6 +145,26 @@ class EgyptSim(Model):
     fissionChance = 0.7
     rental = True
     rentalRate = 0.5
+    backend = "python"
+    minSettlements = 0
+    plateauReporter = None
+    plateauWindow = 50
+    plateauTolerance = 0.0
+    stopCondition = None
+    stopReason = None # Why the model stopped running, one of STOP_REASONS
+    landscapeDir = None
+    eventLog = None
+    events = None # EventRecorder of the event log, None when no log is kept
+    panelEvery = 0
+    panelFraction = 1.0
+    panelCohort = False
+    panel = None # HouseholdPanel collecting household level data, None when no panel is kept
+    spatialStore = None
+    spatialChunkYears = 50
+    spatial = None # SpatialRecorder of the field rasters, None when none are recorded
+    inequalityAccuracy = 0.0
+    inequality = None # QuantileSketch of the households' grain in the year collected, None when computed exactly
+    collectedYears = [] # The year of each row of collected data
     totalPopulation = startingSettlements * startingHouseholds * startingHouseholdSize
     totalGrain = startingGrain * startingHouseholds
     startingPopulation = totalPopulation
@@ -188,7 +209,12 @@ class EgyptSim(Model):
                  generationalVariation: float = 0.9, knowledgeRadius: int = 20,
                  distanceCost: int = 10, fallowLimit: int = 4, popGrowthRate: float = 0.1,
                  fission: bool = False, fissionChance: float = 0.7, rental: bool = True,
-                 rentalRate: float = 0.5):
+                 rentalRate: float = 0.5, backend: str = "python", minSettlements: int = 0,
+                 plateauReporter: str = None, plateauWindow: int = 50, plateauTolerance: float = 0.0,
+                 stopCondition=None, landscapeDir: str = None, eventLog: str = None,
+                 panelEvery: int = 0, panelFraction: float = 1.0, panelCohort: bool = False,
+                 spatialStore: str = None, spatialChunkYears: int = 50, inequalityAccuracy: float = 0.0,
+                 seed: int = None):
         """
         Create a new EgyptSim model
         Args:
@@ -210,8 +236,36 @@ class EgyptSim(Model):
             fissionChance: The chance fission occuring
             rental: If land rental is allowed
             rentalRate: The rate at which households will rent land
+            backend: The backend running the households' claiming, farming and renting kernels, "python" or "numba".
+                     Falls back to "python" if Numba is not installed.
+            minSettlements: Stop once no more than this many settlements survive, 0 to run on while anyone lives
+            plateauReporter: Name of a model reporter, stop once it has plateaued. None to run on
+            plateauWindow: The number of years the plateau is checked over, on the values collected in them
+            plateauTolerance: The most the reporter can vary over the window and still be on a plateau
+            stopCondition: Function taking the model, stop once it returns True. Called at the end of each year
+            landscapeDir: Directory of saved landscapes to memory map, shared by every process running the same geometry.
+                          None to share the landscape between the models of this process only
+            eventLog: Binary file to record the model's claims, harvests, rentals, releases, deaths, fissions and
+                      extinctions in, read back with src.events.EventLog. None to keep no log
+            panelEvery: Collect household level panel data in model.panel every this many years, 0 to collect none
+            panelFraction: The fraction of households the panel follows
+            panelCohort: If the panel only follows the households the model starts with
+            spatialStore: File to record yearly rasters of the fields' owners, fertility and harvests in, read back with
+                          src.spatial.SpatialStore. None to record none
+            spatialChunkYears: The number of years of rasters compressed together in each chunk of the spatial store
+            inequalityAccuracy: Relative accuracy of the quantile sketch of the households' grain that the Gini-Index
+                                and grain holding reporters are computed from, for very many households. 0 to compute
+                                them exactly from the households in wealth order
+            seed: Seed for all of the random number generators used by the model, None for an unseeded run
         """
         super().__init__()
+        # Seed every generator the agents draw from so that a seeded run is reproducible. Each gets its own seed derived
+        # from the one given, the model's and the random module's generators would produce the same stream otherwise.
+        if seed is not None:
+            modelSeed, randomSeed, numpySeed = np.random.SeedSequence(seed).generate_state(3).tolist()
+            self.reset_randomizer(modelSeed)
+            random.seed(randomSeed)
+            np.random.seed(numpySeed)
         # Set Parameters
         # Map size
         self.height = height
@@ -245,6 +299,26 @@ class EgyptSim(Model):
         self.fissionChance = fissionChance
         self.rental = rental
         self.rentalRate = rentalRate
+        self.kernels = loadKernels(backend)
+        self.backend = self.kernels.name
+        self.minSettlements = minSettlements
+        self.plateauReporter = plateauReporter
+        self.plateauWindow = plateauWindow
+        self.plateauTolerance = plateauTolerance
+        self.stopCondition = stopCondition
+        self.stopReason = None
+        self.landscapeDir = landscapeDir
+        self.landscape = loadLandscape(width, height, knowledgeRadius, landscapeDir)
+        self.eventLog = eventLog
+        self.events = None if eventLog is None else EventRecorder(eventLog, (width - 1) * height)
+        self.panelEvery = panelEvery
+        self.panelFraction = panelFraction
+        self.panelCohort = panelCohort
+        self.spatialStore = spatialStore
+        self.spatialChunkYears = spatialChunkYears
+        self.spatial = None if spatialStore is None else SpatialRecorder(spatialStore, self.landscape, spatialChunkYears)
+        self.inequalityAccuracy = inequalityAccuracy
+        self.inequality = QuantileSketch(inequalityAccuracy) if inequalityAccuracy > 0 else None
         self.totalGrain = startingGrain * startingHouseholds * startingSettlements
         self.totalPopulation = startingSettlements * startingHouseholds * startingHouseholdSize
         self.startingPopulation = self.totalPopulation
@@ -252,17 +326,18 @@ class EgyptSim(Model):
         self.maxHouseholdGrain = startingGrain
 
         # Scheduler and Grid
+        self.ids = IdAllocator()
         self.schedule = EgyptSchedule(self)
         self.grid = MultiGrid(height = self.height, width = self.width, torus=False)
 
         # Define specific tables for data collection purposes
         setlist = []
         for i in range(self.startingSettlements):
-            setlist.append("s" + str(i + 1) + "_Population")
+            setlist.append(idLabel(makeId(SETTLEMENT, i)) + "_Population")
         tables = {"Settlement Population": setlist}
 
         # Data collection
-        self.datacollector = DataCollector(model_reporters = 
+        self.datacollector = EgyptDataCollector(model_reporters = 
             {"Households": lambda m: m.schedule.get_breed_count(Household),
              "Settlements": lambda m: m.schedule.get_breed_count(Settlement),
              "Total Grain": lambda m: m.totalGrain,
@@ -280,32 +355,80 @@ class EgyptSim(Model):
              "Number of households with > 66% of wealthiest grain holding": upperThirdGrainHoldings 
             },
             tables = tables)
+        if plateauReporter is not None and plateauReporter not in self.datacollector.model_reporters:
+            raise ValueError("unknown plateau reporter: %r" % plateauReporter)
 
         self.setup()
         self.running = True
-        self.collectTableData()
+        if panelEvery > 0:
+            households = self.schedule.get_breed(Household)
+            cohort = [h.unique_id for h in households] if panelCohort else None
+            # Room for one collection of the starting households, the columns double as the run goes on so that
+            # memory follows the rows collected rather than the longest the run could be
+            capacity = max(int(len(households) * panelFraction), 1)
+            self.panel = HouseholdPanel(panelEvery, panelFraction, cohort, capacity)
+        self.collectedYears = []
+        self.collect()
+        if self.panel is not None:
+            self.panel.collect(self, self.schedule.get_breed(Household))
+        if self.spatial is not None:
+            self.spatial.record(self)
+
+    def collect(self):
+        """ Collect the model reporters and the settlement population table for the current year """
+        self.schedule.phaseStarted("collect")
+        if self.inequality is not None:
+            households = self.schedule.agents_by_breed[Household]
+            self.inequality.clear()
+            self.inequality.update(np.fromiter((h.grain for h in households.values()), dtype=float, count=len(households)))
         self.datacollector.collect(self)
+        # Add settlement data to table
+        self.collectTableData()
+        self.collectedYears.append(self.currentTime)
+        self.schedule.phaseEnded("collect")
 
     def collectTableData(self):
         setPops = {}
         for s in self.schedule.get_breed(Settlement):
-            setPops[s.unique_id + "_Population"] = s.population
+            setPops[s.label + "_Population"] = s.population
         self.datacollector.add_table_row("Settlement Population", setPops, True)
 
+    def setupFieldState(self, n: int):
+        """
+        Create the arrays holding the state of every field, indexed by Field.index.
+        Households farm, age and release their fields with array operations on these.
+        The coordinates of the fields never change and are the landscape's read only arrays.
+
+        Args:
+            n: The number of fields
+        """
+        self.fieldAgents = []
+        self.fieldX = self.landscape.fieldX
+        self.fieldY = self.landscape.fieldY
+        self.fieldFertility = np.zeros(n)
+        self.fieldAvf = np.zeros(n)
+        self.fieldHarvested = np.zeros(n, dtype=bool)
+        self.fieldYearsFallow = np.zeros(n, dtype=int)
+        self.fieldFarmed = np.zeros(n, dtype=bool) # If the field's farm is drawn as farmed, set at each changeover
+        self.fieldOwned = np.zeros(n, dtype=bool)
+        self.fieldOwner = np.full(n, -1, dtype=np.int64) # Ids of the owning households, see Field.owner
+        self.fieldTerritory = np.zeros(n, dtype=bool)
+
     def setupMapBase(self):
         """
         Create the grid as field and river
         """
+        self.setupFieldState((self.width - 1) * self.height)
         for agent, x, y in self.grid.coord_iter():
             # If on left edge, make a river
-            if x == 0:
-                uid = "r" + str(x) + "|" + str(y)
-                river = River(uid, self, (x, y))
+            if self.landscape.river[x, y]:
+                river = River(self.ids.allocate(RIVER), self, (x, y))
                 self.grid.place_agent(river, (x, y))
             # Otherwise make a field
             else:
-                uid = "f" + str(x) + "|" + str(y)
-                field = Field(uid, self, (x, y), 0.0)
+                # Fields are created in index order, so a field's id leads to its index
+                field = Field(self.ids.allocate(FIELD), self, (x, y), 0.0, len(self.fieldAgents))
+                self.fieldAgents.append(field)
                 self.grid.place_agent(field, (x, y))
                 self.schedule.add(field)
 
@@ -313,7 +436,6 @@ class EgyptSim(Model):
         """
         Add settlements and households to the simulation
         """
-        h = 1
         for i in range(self.startingSettlements):
             # Loop untill a suitable location is found
             while True:
@@ -335,18 +457,18 @@ class EgyptSim(Model):
 
             # Add settlement to the grid
             population = self.startingHouseholds * self.startingHouseholdSize
-            uid = "s" + str(i + 1) # Use a custom id for the datacollector
-            settlement = Settlement(uid, self, (x, y), population, self.startingHouseholds, uid, self.SETDICT[uid])
+            uid = self.ids.allocate(SETTLEMENT)
+            settlement = Settlement(uid, self, (x, y), population, self.startingHouseholds, self.SETDICT[idLabel(uid)])
             self.grid.place_agent(settlement, (x, y))
 
             # Set the surrounding fields as territory
-            local = self.grid.get_neighbors((x, y), moore=True, include_center=True, radius=1)
-            for a in local:
-                a.settlementTerritory = True
+            settlement.claimTerritory()
+            if population == 0:
+                self.schedule.queueTeardown(settlement)
 
             # Add households for the settlement to the scheduler
             for j in range(self.startingHouseholds):
-                huid = "h" + str(h) # Use a custom id for the datacollector
+                huid = self.ids.allocate(HOUSEHOLD)
                 ambition =  np.random.uniform(self.minAmbition, 1)
                 competency = np.random.uniform(self.minCompetency, 1)
                 genCount = self.random.randrange(5) + 10
@@ -354,7 +476,8 @@ class EgyptSim(Model):
                                       self.startingHouseholdSize, ambition, competency, genCount)
                 # ! Dont add household to grid, is redundant
                 self.schedule.add(household)
-                h += 1
+                if self.events is not None:
+                    self.events.record(0, FOUND, huid, uid, amount=self.startingHouseholdSize)
             # Add settlement to the scheduler
             self.schedule.add(settlement)
 
@@ -365,19 +488,100 @@ class EgyptSim(Model):
         self.setupMapBase()
         self.setupSettlementsHouseholds()
 
-    def step(self):
+    def step(self, collect: bool = True):
+        """
+        Simulate a year
+
+        Args:
+            collect: If the year's data is collected. The stop conditions are checked either way, a plateau on the
+                     values collected over the last plateauWindow years
+        """
         self.currentTime += 1
         self.maxHouseholdGrain = 0
         self.setupFlood()
         self.schedule.step()
         self.projectedHistoricalPopulation = round(self.startingPopulation * ((1.001) ** self.currentTime))
-        self.datacollector.collect(self)
-        # Add settlement data to table 
-        self.collectTableData()
-        # Cease running once time limit is reached or everyone is dead
-        if self.currentTime >= self.timeSpan or self.totalPopulation == 0: 
+        if collect:
+            self.collect()
+        if self.panel is not None:
+            self.panel.collect(self, self.schedule.get_breed(Household))
+        if self.spatial is not None:
+            self.spatial.record(self)
+        # Cease running once time limit is reached, everyone is dead or a stop condition is met
+        self.stopReason = self.checkStop()
+        if self.stopReason is not None:
             self.running = False
+            self.flush()
+
+    def run(self, years: int = None, collectEvery: int = 1):
+        """
+        Simulate many years in one call, collecting data every few years rather than every year. The last year
+        simulated is always collected.
+
+        Args:
+            years: The number of years to simulate, None to run until the model stops
+            collectEvery: Collect data for the years that are a multiple of this
+
+        Returns:
+            The number of years simulated
+        """
+        if collectEvery < 1:
+            raise ValueError("collectEvery must be at least 1")
+        start = self.currentTime
+        end = math.inf if years is None else start + years
+        step = self.step
+        while self.running and self.currentTime < end:
+            step((self.currentTime + 1) % collectEvery == 0)
+        if self.currentTime > start and self.collectedYears[-1] != self.currentTime:
+            self.collect()
+        self.flush()
+        return self.currentTime - start
+
+    def flush(self):
+        """
+        Write out what the event log and spatial store have buffered. Done when the model stops and when run returns,
+        a model stepped by hand and left running must be flushed before they are read
+        """
+        if self.events is not None:
+            self.events.flush()
+        if self.spatial is not None:
+            self.spatial.flush()
+
+    def checkStop(self):
+        """
+        Checks the stop conditions against the model's current state. A plateau is checked on the values collected
+        over the last plateauWindow years, every year's with collectEvery=1 but only every few years' otherwise, and
+        once the collected data reaches back that far
+
+        Returns:
+            The reason to stop, one of STOP_REASONS, or None to run on
+        """
+        if self.totalPopulation == 0:
+            return "extinction"
+        if self.currentTime >= self.timeSpan:
+            return "timeSpan"
+        if self.minSettlements > 0 and self.schedule.get_breed_count(Settlement) <= self.minSettlements:
+            return "settlements"
+        years = self.collectedYears
+        if self.plateauReporter is not None and years and years[0] <= self.currentTime - self.plateauWindow + 1:
+            first = bisect.bisect_right(years, self.currentTime - self.plateauWindow)
+            window = self.datacollector.model_vars[self.plateauReporter][first:]
+            if window and max(window) - min(window) <= self.plateauTolerance:
+                return "plateau"
+        if self.stopCondition is not None and self.stopCondition(self):
+            return "stopCondition"
+        return None
  
+    def floodFields(self):
+        """
+        Floods every field at once, equivalent to calling Field.flood on each but reading the fertility of each column
+        from the landscape's flood profiles
+        """
+        ticks = self.currentTime
+        self.fieldFertility[:] = self.landscape.floodProfile(self.mu, self.sigma)[self.fieldX]
+        self.fieldAvf[:] = ((ticks * self.fieldAvf) + self.fieldFertility) / (ticks + 1)
+        self.fieldHarvested[:] = False
+
     def setupFlood(self):
         """
         Sets up common variables used for the flood method in Fields
@@ -0,0 +1,42 @@
+# The ranges of the EgyptSim parameters set with sliders in the browser interface, shared with the headless tools that
+# need plausible bounds for the parameters, such as the sensitivity analysis. Kept free of the visualisation modules so
+# they can be imported without them.
+#
+# Each entry is the slider's label, default value, minimum, maximum and step, in the order UserSettableParameter takes them.
+
+SLIDERS = {"timeSpan": ('Model Time Span', 500, 100, 500, 25),
+           "startingSettlements": ('Starting Settlements', 14, 5, 20, 1),
+           "startingHouseholds": ('Starting Households', 7, 1, 10, 1),
+           "startingHouseholdSize": ('Starting Household Size', 5, 1, 10, 1),
+           "startingGrain": ('Starting Grain', 3000, 100, 8000, 100),
+           "minAmbition": ('Minimum Ambition', 0.1, 0.0, 1.0, 0.1),
+           "minCompetency": ('Minimum Competency', 0.7, 0.0, 1.0, 0.1),
+           "generationalVariation": ('Generational Variation', 0.9, 0.0, 1.0, 0.1),
+           "knowledgeRadius": ('Knowledge Radius', 20, 5, 40, 5),
+           "distanceCost": ('Distance Cost (in kg)', 10, 1, 15, 1),
+           "fallowLimit": ("Fallow Limit in Years", 4, 0, 10, 1),
+           "popGrowthRate": ('Population Growth Rate (in %)', 0.10, 0.00, 0.50, 0.001),
+           "fissionChance": ('Minimum Fission Chance', 0.7, 0.5, 0.9, 0.1),
+           "rentalRate": ('Land Rental Rate', 0.5, 0.3, 0.6, 0.05)}
+
+
+def sliderBounds(name: str):
+    """
+    Returns the minimum and maximum of a parameter's slider
+
+    Args:
+        name: The name of the EgyptSim parameter
+    """
+    label, value, low, high, step = SLIDERS[name]
+    return low, high
+
+
+def sliderStep(name: str):
+    """
+    Returns the step between the values of a parameter's slider
+
+    Args:
+        name: The name of the EgyptSim parameter
+    """
+    label, value, low, high, step = SLIDERS[name]
+    return step
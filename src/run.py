@@ -0,0 +1,151 @@
+import argparse
+import importlib.util
+import inspect
+import json
+import os
+import sys
+
+import numpy as np
+
+from src.batch import runEnsemble, runReplicates, runSummary
+from src.model import EgyptSim
+
+
+# Headless command line runner. Builds EgyptSim from flags and/or a JSON config file, runs it to timeSpan
+# and writes the DataCollector output, without importing any of the visualisation modules.
+#
+#     python -m src.run --timeSpan 200 --rental --replicates 8 --workers 4 --output runs.csv
+
+OUTPUT_FORMATS = ("csv", "parquet", "npz")
+# Help for the model parameters whose flags need more than their default
+PARAMETER_HELP = {"minSettlements": "Stop once no more than this many settlements survive, 0 to run on",
+                  "plateauReporter": "Model reporter to stop on once it has plateaued",
+                  "plateauWindow": "Years the plateau reporter must stay within plateauTolerance, checked on the "
+                                   "values collected in them, so with --collectEvery a window of several collections",
+                  "plateauTolerance": "The most the plateau reporter can vary over the window"}
+
+
+def modelParameters():
+    """
+    Returns the EgyptSim constructor parameters that can be set from the command line, those of a type that can be
+    given as text. Functions such as stopCondition can only be passed from Python.
+    """
+    signature = inspect.signature(EgyptSim.__init__)
+    return {name: p for name, p in signature.parameters.items()
+            if name not in ("self", "seed") and p.annotation in (int, float, bool, str)}
+
+
+def buildParser():
+    """ Builds the argument parser, with one flag per EgyptSim constructor parameter """
+    parser = argparse.ArgumentParser(description="Run the Farmers to Pharaohs simulation without the browser interface.")
+    parser.add_argument("--config", help="JSON file of EgyptSim parameters, flags given on the command line take precedence")
+    parser.add_argument("--output", "-o", help="File to write the collected data to, format taken from the extension unless --format is given")
+    parser.add_argument("--format", choices=OUTPUT_FORMATS, help="Output format")
+    parser.add_argument("--replicates", type=int, default=1, help="Number of replicates of the parameter set to run")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes to run replicates on")
+    parser.add_argument("--seed", type=int, help="Base seed, replicate i is seeded with seed + i")
+    parser.add_argument("--collectEvery", type=int, default=1, help="Collect data every this many years, and in the last year")
+    parser.add_argument("--metricsPort", type=int,
+                        help="Serve live performance metrics on this local port, at /metrics (Prometheus) and /metrics.json")
+    parser.add_argument("--ensemble", action="store_true",
+                        help="Run the replicates in lockstep on the array based ensemble engine, in a single process")
+    parser.add_argument("--summary", action="store_true",
+                        help="Write the per year mean, variance, extremes and quantiles of each series across the "
+                             "replicates instead of every replicate, without keeping every run in memory")
+    parser.add_argument("--quantiles", type=float, nargs="+", default=[0.05, 0.5, 0.95],
+                        help="Quantiles reported by --summary, as fractions")
+
+    group = parser.add_argument_group("model parameters")
+    for name, param in modelParameters().items():
+        text = " ".join(filter(None, (PARAMETER_HELP.get(name), "(default: %s)" % param.default)))
+        if param.annotation is bool:
+            group.add_argument("--" + name, action=argparse.BooleanOptionalAction, default=None, help=text)
+        else:
+            group.add_argument("--" + name, type=param.annotation, default=None, help=text)
+    return parser
+
+
+def loadParameters(args, parser):
+    """ Merge the config file, if any, with the parameters given as flags """
+    params = {}
+    if args.config is not None:
+        with open(args.config) as f:
+            params = json.load(f)
+        unknown = set(params) - set(modelParameters())
+        if unknown:
+            parser.error("unknown parameters in %s: %s" % (args.config, ", ".join(sorted(unknown))))
+    for name in modelParameters():
+        value = getattr(args, name)
+        if value is not None:
+            params[name] = value
+    return params
+
+
+def writeOutput(data, path, fmt):
+    """
+    Write the combined replicate data to a file
+
+    Args:
+        data: DataFrame returned by runReplicates
+        path: The file to write
+        fmt: One of OUTPUT_FORMATS
+    """
+    if fmt == "csv":
+        data.to_csv(path, index=False)
+    elif fmt == "parquet":
+        data.to_parquet(path, index=False)  # Requires pyarrow or fastparquet
+    elif fmt == "npz":
+        np.savez_compressed(path, **{column: data[column].to_numpy() for column in data.columns})
+
+
+def main(argv=None):
+    parser = buildParser()
+    args = parser.parse_args(argv)
+    params = loadParameters(args, parser)
+
+    fmt = args.format
+    if args.output is not None and fmt is None:
+        fmt = os.path.splitext(args.output)[1].lstrip(".").lower()
+        if fmt not in OUTPUT_FORMATS:
+            parser.error("cannot infer output format from %s, use --format" % args.output)
+    if fmt == "parquet" and not any(importlib.util.find_spec(engine) for engine in ("pyarrow", "fastparquet")):
+        parser.error("parquet output requires pyarrow or fastparquet to be installed")
+    if args.replicates < 1 or args.workers < 1 or args.collectEvery < 1:
+        parser.error("--replicates, --workers and --collectEvery must be at least 1")
+    if args.ensemble and args.collectEvery != 1:
+        parser.error("--collectEvery cannot be used with --ensemble, which collects every year")
+    if args.ensemble and args.metricsPort is not None:
+        parser.error("--metricsPort cannot be used with --ensemble")
+    if args.ensemble and args.summary:
+        parser.error("--summary cannot be used with --ensemble, which keeps every replicate in memory")
+    if params.get("eventLog") is not None and (args.replicates > 1 or args.ensemble):
+        parser.error("--eventLog records a single EgyptSim run, it cannot be used with replicates or --ensemble")
+    if params.get("spatialStore") is not None and (args.replicates > 1 or args.ensemble):
+        parser.error("--spatialStore records a single EgyptSim run, it cannot be used with replicates or --ensemble")
+
+    metrics = None
+    if args.metricsPort is not None:
+        from src.metrics import RunMetrics, serveMetrics
+        metrics = RunMetrics()
+        server = serveMetrics(metrics, args.metricsPort)
+        print("Serving metrics on http://%s:%d/metrics" % server.server_address)
+
+    if args.ensemble:
+        data, years, elapsed = runEnsemble(params, args.replicates, args.seed)
+    elif args.summary:
+        summary, years, elapsed = runSummary(params, args.replicates, args.workers, args.seed, args.collectEvery,
+                                             args.quantiles, metrics=metrics)
+        data = summary.get_dataframe()
+    else:
+        data, years, elapsed = runReplicates(params, args.replicates, args.workers, args.seed, args.collectEvery, metrics)
+
+    print("Simulated %d years over %d replicates in %.2fs (%.1f years/second)"
+          % (years, args.replicates, elapsed, years / elapsed if elapsed > 0 else float("inf")))
+    if args.output is not None:
+        writeOutput(data, args.output, fmt)
+        print("Wrote", args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
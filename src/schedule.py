@@ -1,6 +1,14 @@
 from collections import defaultdict
+from itertools import count
+from operator import attrgetter
+import numpy as np
 from mesa.time import RandomActivation
-from src.agents import Household
+from src.agents import Field, Household, Settlement
+
+
+# The phases of a year, in the order they run: flooding the fields, households claiming and farming, households
+# renting, consuming, ageing their fields and splitting, tearing down dead settlements, and the model collecting data
+PHASES = ("flood", "farm", "rent", "settlements", "collect")
 
 
 class EgyptSchedule(RandomActivation):
@@ -15,6 +23,17 @@ class EgyptSchedule(RandomActivation):
     def __init__(self, model):
         super().__init__(model)
         self.agents_by_breed = defaultdict(dict)
+        self.breedViews = {} # Cached tuples of each breed's agents returned by get_breed, dropped when the breed changes
+        self.teardownQueue = [] # Settlements whose population has reached zero, torn down on the settlements' turn
+        # Households kept in wealth and ambition order between steps. Each step only a few change rank, so re-sorting
+        # the previous order takes close to linear time. Removed households are filtered out on the next sort.
+        self.householdsByWealth = []
+        self.householdsByAmbition = []
+        self.removedHouseholds = set()
+        self.departedHouseholds = {} # The removed households by id, still found by household() until the orders are filtered
+        self.householdSeq = count()
+        # Objects told when each phase of a step starts and ends, such as src.metrics.PhaseTimer. See PHASES
+        self.phaseObservers = []
 
     def add(self, agent):
         """
@@ -26,7 +45,10 @@ class EgyptSchedule(RandomActivation):
 
         self._agents[agent.unique_id] = agent
         agent_class = type(agent)
+        if agent_class is Household:
+            self.orderHousehold(agent)
         self.agents_by_breed[agent_class][agent.unique_id] = agent
+        self.breedViews.pop(agent_class, None)
 
     def remove(self, agent):
         """
@@ -36,7 +58,68 @@ class EgyptSchedule(RandomActivation):
         del self._agents[agent.unique_id]
 
         agent_class = type(agent)
-        del self.agents_by_breed[agent_class][agent.unique_id]
+        removed = self.agents_by_breed[agent_class].pop(agent.unique_id)
+        if agent_class is Household:
+            self.removedHouseholds.add(removed)
+            self.departedHouseholds[removed.unique_id] = removed
+        self.breedViews.pop(agent_class, None)
+
+    def orderHousehold(self, household):
+        """
+        Add a household to the wealth and ambition orders. Ties are broken by the order of addition, the order the
+        households are kept in agents_by_breed.
+
+        Args:
+            household: The household being added to the schedule
+        """
+        household.seq = next(self.householdSeq)
+        if household in self.removedHouseholds: # Added back before the orders were filtered
+            self.removedHouseholds.discard(household)
+            self.departedHouseholds.pop(household.unique_id, None)
+        else:
+            self.householdsByWealth.append(household)
+            self.householdsByAmbition.append(household)
+
+    def dropRemovedHouseholds(self):
+        """ Filter the households removed from the schedule out of the wealth and ambition orders """
+        if self.removedHouseholds:
+            removed = self.removedHouseholds
+            self.householdsByWealth = [h for h in self.householdsByWealth if h not in removed]
+            self.householdsByAmbition = [h for h in self.householdsByAmbition if h not in removed]
+            self.removedHouseholds = set()
+            self.departedHouseholds = {}
+
+    def household(self, uid: int):
+        """
+        Returns the household with an id, None for -1. Households removed during the current step are still found, a
+        household dying part way through the rentals is still paid for the fields rented from it. None once they have
+        been filtered out of the orders.
+
+        Args:
+            uid: The id of the household
+        """
+        household = self.agents_by_breed[Household].get(uid)
+        if household is None:
+            household = self.departedHouseholds.get(uid)
+        return household
+
+    def wealthOrder(self):
+        """
+        Returns the households in ascending order of grain, equally wealthy households in schedule order.
+        The list is re-sorted in place on each call and shared, it should not be modified.
+        """
+        self.dropRemovedHouseholds()
+        self.householdsByWealth.sort(key=attrgetter("grain", "seq"))
+        return self.householdsByWealth
+
+    def ambitionOrder(self):
+        """
+        Returns the households in ascending order of ambition, equally ambitious households in the order of the wealth
+        ranks given by the last step. The list is re-sorted in place on each call and shared, it should not be modified.
+        """
+        self.dropRemovedHouseholds()
+        self.householdsByAmbition.sort(key=attrgetter("ambition", "wealthRank"))
+        return self.householdsByAmbition
 
     def step(self, by_breed=True):
         """
@@ -50,6 +133,14 @@ class EgyptSchedule(RandomActivation):
             for agent_class in self.agents_by_breed:
                 if agent_class is Household: # Households need seperate treatment for ordering of changeover and rental after farming has occured
                     self.step_households(agent_class)
+                elif agent_class is Settlement: # Only dead settlements have anything to do
+                    self.phaseStarted("settlements")
+                    self.step_settlements()
+                    self.phaseEnded("settlements")
+                elif agent_class is Field: # Fields only flood, which is done for all of them at once
+                    self.phaseStarted("flood")
+                    self.model.floodFields()
+                    self.phaseEnded("flood")
                 else:
                     self.step_breed(agent_class)
             self.steps += 1
@@ -57,6 +148,16 @@ class EgyptSchedule(RandomActivation):
         else:
             super().step()
 
+    def phaseStarted(self, name: str):
+        """ Tell the phase observers a phase of the step is starting """
+        for observer in self.phaseObservers:
+            observer.phaseStarted(name)
+
+    def phaseEnded(self, name: str):
+        """ Tell the phase observers a phase of the step has ended """
+        for observer in self.phaseObservers:
+            observer.phaseEnded(name)
+
     def step_breed(self, breed):
         """
         Shuffle order and run all agents of a given breed.
@@ -64,10 +165,30 @@ class EgyptSchedule(RandomActivation):
         Args:
             breed: Class object of the breed to run.
         """
-        agent_keys = list(self.agents_by_breed[breed].keys())
-        self.model.random.shuffle(agent_keys)
-        for agent_key in agent_keys:
-            self.agents_by_breed[breed][agent_key].step()
+        agents = list(self.get_breed(breed))
+        self.model.random.shuffle(agents)
+        for agent in agents:
+            agent.step()
+
+    def queueTeardown(self, settlement):
+        """
+        Queue a settlement to be torn down on the settlements' turn of the step
+
+        Args:
+            settlement: The settlement whose population has reached zero
+        """
+        self.teardownQueue.append(settlement)
+
+    def step_settlements(self):
+        """
+        Tear down the settlements queued since the last step. Dead settlements are queued when their last worker dies,
+        so live settlements cost nothing. A queued settlement is checked again as its population can still recover
+        within the step it was queued in.
+        """
+        queue, self.teardownQueue = self.teardownQueue, []
+        for settlement in queue:
+            if settlement.population == 0 and settlement.unique_id in self.agents_by_breed[Settlement]:
+                settlement.teardown()
 
     def step_households(self, breed):
         """
@@ -76,42 +197,46 @@ class EgyptSchedule(RandomActivation):
         Args:
             breed: Class object of the breed to run.
         """
-        # Sorting functors
-        def wealth(key):
-            return self.agents_by_breed[breed][key].grain
+        # Sort agents on wealth as in NetLogo ver. Simulates the increased "buying power" of the more wealthy households.
+        # Copied as households added by fission during the step are not run until the next one
+        self.phaseStarted("farm")
+        households = list(self.wealthOrder())
 
-        def ambition(key):
-            return self.agents_by_breed[breed][key].ambition
+        ownedFields = [] # Arrays of owned fields, joined for rental puropses
+        for rank, h in enumerate(households):
+            h.wealthRank = rank
+            h.stepFarm()
+            ownedFields.append(h.fields)
+        allFields = np.concatenate(ownedFields) if ownedFields else np.empty(0, dtype=int)
+        self.phaseEnded("farm")
 
-        allFields = [] # List of farms for rental puropses
-
-        agent_keys = list(self.agents_by_breed[breed].keys())
-        
-
-        agent_keys.sort(key = wealth) # Sort agents on wealth as in NetLogo ver. Simulates the increased "buying power" of the more wealthy households.
-        for agent_key in agent_keys:
-            self.agents_by_breed[breed][agent_key].stepFarm()
-            allFields += self.agents_by_breed[breed][agent_key].fields
+        self.phaseStarted("rent")
 
         # Sort agents on ambition, rewarding agents for being ambitions if they choose to rent and renting is enabled
         if self.model.rental:
-            agent_keys.sort(key = ambition) 
+            households = list(self.ambitionOrder())
+
+        for h in households:
+            h.stepRentConsumeChangeover(allFields)
 
-        for agent_key in agent_keys:
-            self.agents_by_breed[breed][agent_key].stepRentConsumeChangeover(allFields)
+        # Update grain max for datacollector, leaving the wealth order sorted for the reporters and the next step
+        households = self.wealthOrder()
+        if households:
+            self.model.maxHouseholdGrain = max(households[-1].grain, 0)
+        self.phaseEnded("rent")
 
     def get_breed_count(self, breed_class):
         """
         Returns the current number of agents of certain breed in the queue.
         """
-        return len(self.agents_by_breed[breed_class].values())
+        return len(self.agents_by_breed[breed_class])
 
     def get_breed(self, breed):
         """
-        Returns all agents of the given breed
+        Returns all agents of the given breed, in the order they were added, as a read only tuple.
+        The tuple is shared between calls until an agent of the breed is added or removed.
         """
-        lst = []
-        agent_keys = list(self.agents_by_breed[breed].keys())
-        for agent_key in agent_keys:
-            lst.append(self.agents_by_breed[breed][agent_key])
-        return lst
\ No newline at end of file
+        view = self.breedViews.get(breed)
+        if view is None:
+            view = self.breedViews[breed] = tuple(self.agents_by_breed[breed].values())
+        return view
@@ -0,0 +1,313 @@
+import argparse
+import importlib.util
+import inspect
+import json
+import os
+import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from src.batch import finalValues, poolParameters, replicateSeeds
+from src.model import EgyptSim
+from src.parameters import SLIDERS, sliderBounds, sliderStep
+
+
+# Global sensitivity analysis of EgyptSim's parameters, run headless across a process pool.
+#
+# A design is a list of parameter sets drawn from the factors' bounds, by default the ranges of the browser interface's
+# sliders. "lhs" draws a Latin hypercube, "sobol" draws Saltelli's design of two base samples A and B plus, for each
+# factor, A with that factor's column taken from B. Each parameter set is run once and the final value of each output
+# recorded. The Saltelli design gives first-order and total Sobol indices, a Latin hypercube first-order indices only.
+#
+# Every finished run is appended to a JSON lines file as it completes. Running an analysis again with the same file
+# skips the runs already recorded in it, so an interrupted analysis picks up where it stopped.
+#
+#     python -m src.sensitivity sobol.jsonl --method sobol --samples 64 --workers 8 --timeSpan 200
+
+METHODS = ("lhs", "sobol")
+OUTPUTS = ("Gini-Index", "Total Population", "Settlements")
+# Slider parameters varied by default. timeSpan sets the length of the run rather than the behaviour of the model.
+FACTORS = tuple(name for name in SLIDERS if name != "timeSpan")
+# Bounds narrower than the slider's for factors named without bounds of their own. Household.genChangeover redraws a
+# new generation's ambition and competency until they land outside (minimum, 1], which a starting value in the middle of
+# that range never does with a generationalVariation of at most half of it, so the model would never finish the year.
+FACTOR_BOUNDS = {"generationalVariation": (0.6, 1.0)}
+
+
+def defaultFactors(params: dict = None):
+    """
+    Returns the factors varied by default, FACTORS without fissionChance unless fission is enabled in params, as
+    fissionChance has no effect on a model without fission
+
+    Args:
+        params: EgyptSim parameters held fixed in every run
+    """
+    if (params or {}).get("fission"):
+        return FACTORS
+    return tuple(name for name in FACTORS if name != "fissionChance")
+
+
+def latinHypercube(samples: int, dimensions: int, rng):
+    """
+    Draws a Latin hypercube on the unit cube: each dimension is split into as many strata as there are samples,
+    and each stratum holds exactly one sample
+
+    Args:
+        samples: The number of samples
+        dimensions: The number of dimensions
+        rng: NumPy Generator to draw from
+    """
+    strata = np.argsort(rng.random((samples, dimensions)), axis=0)
+    return (strata + rng.random((samples, dimensions))) / samples
+
+
+def sobolSequence(samples: int, dimensions: int, seed: int):
+    """
+    Draws a scrambled Sobol sequence on the unit cube, requires SciPy
+
+    Args:
+        samples: The number of samples, ideally a power of two
+        dimensions: The number of dimensions
+        seed: Seed for the scrambling
+    """
+    from scipy.stats import qmc
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore") # Balance warnings for sample counts that are not powers of two
+        return qmc.Sobol(dimensions, scramble=True, seed=seed).random(samples)
+
+
+class SensitivityAnalysis:
+    """
+    A sensitivity analysis of EgyptSim outputs to its parameters, recorded in a resumable JSON lines file
+    """
+
+    def __init__(self, path: str, factors=None, method: str = "sobol", samples: int = 64, params: dict = None,
+                 outputs=OUTPUTS, seed: int = None):
+        """
+        Create a new analysis, or open the one recorded in path. An existing file must have been written by an analysis
+        with the same settings.
+
+        Args:
+            path: JSON lines file the design and results are recorded in
+            factors: Names of the parameters to vary, within their slider bounds or FACTOR_BOUNDS, or a dictionary of names
+                     and (low, high) bounds.
+                     The defaultFactors of params if not given
+            method: One of METHODS
+            samples: The number of base samples. A Latin hypercube runs this many models, a Saltelli design
+                     samples * (factors + 2)
+            params: EgyptSim parameters held fixed in every run
+            outputs: DataCollector model reporters to analyse, their final value is taken from each run
+            seed: Seed for the design and the runs, drawn at random if not given and recorded in the file
+        """
+        if method not in METHODS:
+            raise ValueError("unknown method %r, expected one of %s" % (method, ", ".join(METHODS)))
+        if factors is None:
+            factors = defaultFactors(params)
+        if not isinstance(factors, dict):
+            factors = {name: FACTOR_BOUNDS.get(name, sliderBounds(name)) for name in factors}
+        self.path = path
+        self.settings = {"method": method, "samples": samples,
+                         "factors": {name: list(bounds) for name, bounds in factors.items()},
+                         "params": dict(params or {}), "outputs": list(outputs)}
+        self.results = {}
+
+        if os.path.exists(path):
+            self.load(seed)
+        else:
+            self.seed = replicateSeeds(1, seed)[0]
+            with open(path, "w") as f:
+                f.write(json.dumps(dict(self.settings, seed=self.seed)) + "\n")
+
+        self.factors = list(factors)
+        self.bounds = np.array([factors[name] for name in self.factors], dtype=float)
+        self.method = method
+        self.samples = samples
+        self.params = self.settings["params"]
+        self.outputs = list(outputs)
+        self.design = self.buildDesign()
+
+    def load(self, seed: int):
+        """ Read the settings and finished runs of an existing analysis file """
+        with open(self.path) as f:
+            text = f.read()
+        if not text.endswith("\n"): # Finish a line cut short so that new runs are recorded on lines of their own
+            with open(self.path, "a") as f:
+                f.write("\n")
+        lines = text.splitlines()
+        header = json.loads(lines[0])
+        recordedSeed = header.pop("seed")
+        if header != self.settings or (seed is not None and seed != recordedSeed):
+            raise ValueError("%s was written by an analysis with different settings" % self.path)
+        self.seed = recordedSeed
+        for line in lines[1:]:
+            try:
+                record = json.loads(line)
+            except ValueError: # A line cut short when the analysis was interrupted
+                continue
+            self.results[record["run"]] = record["values"]
+
+    def buildDesign(self):
+        """
+        Returns the design as a list of parameter dictionaries, one per run. For a Saltelli design the runs are grouped
+        by sample, A, B and then A with each factor taken from B, and the runs of a group share a model seed so that
+        the differences between them are down to the parameters.
+        """
+        rng = np.random.default_rng(self.seed)
+        dimensions = len(self.factors)
+        if self.method == "lhs":
+            unit = latinHypercube(self.samples, dimensions, rng)
+        else:
+            if importlib.util.find_spec("scipy") is not None:
+                base = sobolSequence(self.samples, 2 * dimensions, self.seed)
+            else:
+                warnings.warn("scipy is not installed, using a Latin hypercube for the base samples of the Saltelli design")
+                base = latinHypercube(self.samples, 2 * dimensions, rng)
+            a, b = base[:, :dimensions], base[:, dimensions:]
+            unit = []
+            for j in range(self.samples):
+                unit.append(a[j])
+                unit.append(b[j])
+                for i in range(dimensions):
+                    mixed = a[j].copy()
+                    mixed[i] = b[j, i]
+                    unit.append(mixed)
+            unit = np.array(unit)
+
+        annotations = {name: p.annotation for name, p in inspect.signature(EgyptSim.__init__).parameters.items()}
+        design = []
+        for row in unit:
+            params = dict(self.params)
+            for name, (low, high), u in zip(self.factors, self.bounds, row):
+                if annotations.get(name) is int:
+                    # Every value the slider can take within the bounds, low + k * step, equally likely
+                    step = sliderStep(name) if name in SLIDERS else 1
+                    values = int((high - low) // step) + 1
+                    params[name] = int(low + step * min(np.floor(u * values), values - 1))
+                else:
+                    params[name] = float(low + u * (high - low))
+            design.append(params)
+        return design
+
+    def runSeed(self, run: int):
+        """ The model seed of a run """
+        if self.method == "sobol":
+            return self.seed + run // (len(self.factors) + 2)
+        return self.seed + run
+
+    def remaining(self):
+        """ The runs of the design that have not finished """
+        return [run for run in range(len(self.design)) if run not in self.results]
+
+    def run(self, workers: int = 1):
+        """
+        Run every remaining model of the design, across a process pool if more than one worker is used, recording each
+        as it finishes
+
+        Args:
+            workers: The number of worker processes
+        """
+        runs = self.remaining()
+        with open(self.path, "a") as f:
+            if workers > 1 and len(runs) > 1:
+                with ProcessPoolExecutor(max_workers=workers) as pool:
+                    futures = {pool.submit(finalValues, poolParameters(self.design[run]), self.runSeed(run), self.outputs): run
+                               for run in runs}
+                    for future in as_completed(futures):
+                        self.record(f, futures[future], future.result())
+            else:
+                for run in runs:
+                    self.record(f, run, finalValues(self.design[run], self.runSeed(run), self.outputs))
+
+    def record(self, f, run: int, values: list):
+        """ Record a finished run in memory and in the analysis file """
+        self.results[run] = values
+        f.write(json.dumps({"run": run, "values": values}) + "\n")
+        f.flush()
+
+    def indices(self):
+        """
+        Computes the sensitivity indices of each output once every run has finished
+
+        First-order and total indices of a Saltelli design use the estimators of Saltelli et al. (2010) and Jansen (1999).
+        For a Latin hypercube the first-order index is estimated as the share of the variance explained by the mean
+        of the output within equal-count bins of each factor, and the total index is not available.
+
+        Returns:
+            A dictionary keyed by output of dictionaries keyed by factor of (first-order, total) index tuples
+        """
+        missing = self.remaining()
+        if missing:
+            raise RuntimeError("%d of %d runs have not finished" % (len(missing), len(self.design)))
+        values = np.array([self.results[run] for run in range(len(self.design))], dtype=float)
+        dimensions = len(self.factors)
+        indices = {}
+        for k, output in enumerate(self.outputs):
+            y = values[:, k]
+            indices[output] = {}
+            if self.method == "sobol":
+                groups = y.reshape(self.samples, dimensions + 2)
+                # Centred, the first-order estimator is unbiased either way but much noisier for outputs far from zero
+                groups = groups - np.mean(groups[:, :2])
+                fA, fB = groups[:, 0], groups[:, 1]
+                variance = np.var(np.concatenate([fA, fB]))
+                for i, name in enumerate(self.factors):
+                    fABi = groups[:, 2 + i]
+                    if variance > 0:
+                        first = np.mean(fB * (fABi - fA)) / variance
+                        total = 0.5 * np.mean((fA - fABi) ** 2) / variance
+                    else:
+                        first = total = float("nan")
+                    indices[output][name] = (float(first), float(total))
+            else:
+                variance = np.var(y)
+                bins = max(int(np.sqrt(len(y))), 1)
+                x = np.array([[self.design[run][name] for name in self.factors] for run in range(len(y))], dtype=float)
+                for i, name in enumerate(self.factors):
+                    groups = np.array_split(np.argsort(x[:, i], kind="stable"), bins)
+                    explained = sum(len(g) * (np.mean(y[g]) - np.mean(y)) ** 2 for g in groups) / len(y)
+                    first = explained / variance if variance > 0 else float("nan")
+                    indices[output][name] = (float(first), float("nan"))
+        return indices
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sensitivity analysis of the Farmers to Pharaohs simulation.")
+    parser.add_argument("path", help="JSON lines file to record the analysis in, an existing file is resumed")
+    parser.add_argument("--method", choices=METHODS, default="sobol", help="Design of the analysis")
+    parser.add_argument("--samples", type=int, default=64, help="Number of base samples")
+    parser.add_argument("--factors", help="Comma separated parameters to vary (default: all sliders but timeSpan, "
+                                          "and fissionChance unless the config enables fission)")
+    parser.add_argument("--outputs", help="Comma separated reporters to analyse (default: %s)" % ", ".join(OUTPUTS))
+    parser.add_argument("--timeSpan", type=int, help="Years each model is run for")
+    parser.add_argument("--config", help="JSON file of EgyptSim parameters held fixed in every run")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--seed", type=int, help="Seed for the design and the runs")
+    args = parser.parse_args(argv)
+
+    params = {}
+    if args.config is not None:
+        with open(args.config) as f:
+            params = json.load(f)
+    if args.timeSpan is not None:
+        params["timeSpan"] = args.timeSpan
+    factors = args.factors.split(",") if args.factors else defaultFactors(params)
+    outputs = args.outputs.split(",") if args.outputs else OUTPUTS
+    unknown = set(factors) - set(SLIDERS)
+    if unknown:
+        parser.error("factors without slider bounds: " + ", ".join(sorted(unknown)))
+
+    analysis = SensitivityAnalysis(args.path, factors, args.method, args.samples, params, outputs, args.seed)
+    print("%d of %d runs to go" % (len(analysis.remaining()), len(analysis.design)))
+    analysis.run(args.workers)
+
+    for output, indices in analysis.indices().items():
+        print("\n" + output)
+        for name, (first, total) in indices.items():
+            print("  %-24s first %6.3f  total %6.3f" % (name, first, total))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,10 +1,13 @@
-from mesa.visualization.ModularVisualization import ModularServer
+import os
+
 from mesa.visualization.modules import CanvasGrid, ChartModule
 from mesa.visualization.UserParam import UserSettableParameter
+from src.asyncserver import AsyncModularServer
 from src.charts import TableChartModule
 
 from src.agents import River, Field, Settlement, Farm
 from src.model import EgyptSim
+from src.parameters import SLIDERS
 
 
 max = 1.36  # Max Fertility Value = The man, the myth, the legendary Rhett worked this out using really slow and manual machine learning
@@ -135,23 +138,25 @@ model_params = {"height": 30,
                 "infoText2": UserSettableParameter('static_text', value = "The Start Button allows the simulation to start running automatically from the starting value till your chosen end value."),
                 "infoText3": UserSettableParameter('static_text', value = "The Step Button allows you to progress the simulation forward by one year."),
                 "infoText4": UserSettableParameter('static_text', value = "The Reset Button allows you to Reset the simulation with new values and new random settlement positions."),
-                "timeSpan": UserSettableParameter('slider', 'Model Time Span', 500, 100, 500, 25),
-                "startingSettlements": UserSettableParameter('slider', 'Starting Settlements', 14, 5, 20),
-                "startingHouseholds": UserSettableParameter('slider', 'Starting Households', 7, 1, 10),
-                "startingHouseholdSize": UserSettableParameter('slider', 'Starting Household Size', 5, 1, 10),
-                "startingGrain": UserSettableParameter('slider', 'Starting Grain', 3000, 100, 8000, 100),
-                "minAmbition": UserSettableParameter('slider', 'Minimum Ambition', 0.1, 0.0, 1.0, 0.1),
-                "minCompetency": UserSettableParameter('slider', 'Minimum Competency', 0.7, 0.0, 1.0, 0.1),
-                "generationalVariation": UserSettableParameter('slider', 'Generational Variation', 0.9, 0.0, 1.0, 0.1),
-                "knowledgeRadius": UserSettableParameter('slider', 'Knowledge Radius', 20, 5, 40, 5),
-                "distanceCost": UserSettableParameter('slider', 'Distance Cost (in kg)', 10, 1, 15),
-                "fallowLimit": UserSettableParameter('slider', "Fallow Limit in Years", 4, 0, 10),
-                "popGrowthRate": UserSettableParameter('slider', 'Population Growth Rate (in %)', 0.10, 0.00, 0.50, 0.001),
+                "timeSpan": UserSettableParameter('slider', *SLIDERS["timeSpan"]),
+                "startingSettlements": UserSettableParameter('slider', *SLIDERS["startingSettlements"]),
+                "startingHouseholds": UserSettableParameter('slider', *SLIDERS["startingHouseholds"]),
+                "startingHouseholdSize": UserSettableParameter('slider', *SLIDERS["startingHouseholdSize"]),
+                "startingGrain": UserSettableParameter('slider', *SLIDERS["startingGrain"]),
+                "minAmbition": UserSettableParameter('slider', *SLIDERS["minAmbition"]),
+                "minCompetency": UserSettableParameter('slider', *SLIDERS["minCompetency"]),
+                "generationalVariation": UserSettableParameter('slider', *SLIDERS["generationalVariation"]),
+                "knowledgeRadius": UserSettableParameter('slider', *SLIDERS["knowledgeRadius"]),
+                "distanceCost": UserSettableParameter('slider', *SLIDERS["distanceCost"]),
+                "fallowLimit": UserSettableParameter('slider', *SLIDERS["fallowLimit"]),
+                "popGrowthRate": UserSettableParameter('slider', *SLIDERS["popGrowthRate"]),
                 "fission": UserSettableParameter('checkbox', 'Allow Household Fission?', value=False),
-                "fissionChance": UserSettableParameter('slider', 'Minimum Fission Chance', 0.7, 0.5, 0.9, 0.1),
+                "fissionChance": UserSettableParameter('slider', *SLIDERS["fissionChance"]),
                 "rental": UserSettableParameter('checkbox', 'Allow Land Rental?', value=True),
-                "rentalRate": UserSettableParameter('slider', 'Land Rental Rate', 0.5, 0.3, 0.6, 0.05)}
+                "rentalRate": UserSettableParameter('slider', *SLIDERS["rentalRate"])}
 
-server = ModularServer(EgyptSim, elements, "Farmers to Pharaohs Simulation", model_params)
+# Live performance metrics are only served when asked for, with python run.py --metrics or EGYPT_METRICS=1
+server = AsyncModularServer(EgyptSim, elements, "Farmers to Pharaohs Simulation", model_params,
+                            metrics=os.environ.get("EGYPT_METRICS") == "1")
 
 server.port = 8521
\ No newline at end of file
@@ -0,0 +1,190 @@
+import zlib
+
+import numpy as np
+
+from src.agents import Household
+from src.headers import readHeader
+from src.ids import HOUSEHOLD, KIND_BITS
+
+
+# Opt-in spatial output for EgyptSim. With EgyptSim(spatialStore=path) the model records, for its starting state and
+# at the end of every year, which household and which settlement own each field, the field's fertility and whether it
+# was harvested, as rasters over the whole grid indexed [x, y] like the landscape's. The rasters of a layer are buffered for
+# spatialChunkYears years, then compressed with zlib and appended to the store as one chunk, and the buffers are
+# flushed when the model stops and when EgyptSim.run returns. SpatialStore memory maps a store and only decompresses the chunks overlapping the years
+# asked for, so a region of a few years is read without loading a whole run.
+#
+#     store = SpatialStore("run.spatial")
+#     owners = store.read("settlement", 100, 200, x=slice(1, 10)) # Years 100 to 199 of columns 1 to 9, [year, x, y]
+#
+# A store starts with a 24 byte header, the magic bytes, the format version, the grid's width and height and the
+# number of years of a full chunk. Each chunk is a CHUNK record followed by its compressed rasters.
+
+MAGIC = b"EGYPTSP\0"
+VERSION = 1
+HEADER = np.dtype([("magic", "S8"), ("version", "<u4"), ("width", "<u4"), ("height", "<u4"), ("chunkYears", "<u4")])
+CHUNK = np.dtype([("layer", "u1"), ("first", "<i4"), ("years", "<u4"), ("size", "<u8")])
+
+# The layers of a store: name, type of its rasters and the value of cells that are not fields (the river) or have no
+# owner. Ids fit in 32 bits for any run with fewer than 2 ** 28 households
+LAYERS = (("household", np.dtype("<i4"), -1),
+          ("settlement", np.dtype("<i4"), -1),
+          ("fertility", np.dtype("<f4"), np.nan),
+          ("harvested", np.dtype("u1"), 0))
+LAYER_NAMES = tuple(name for name, dtype, fill in LAYERS)
+
+
+def householdSettlements(model, owners):
+    """
+    The id of the settlement of each owning household
+
+    Args:
+        model: The EgyptSim the households belong to
+        owners: Array of household ids, -1 for no household
+
+    Returns:
+        Array of settlement ids, -1 where owners is -1
+    """
+    households = model.schedule.agents_by_breed[Household]
+    settlementOf = np.full(model.ids.counts[HOUSEHOLD], -1, dtype=np.int64)
+    if households:
+        serials = np.fromiter(households.keys(), dtype=np.int64, count=len(households)) >> KIND_BITS
+        settlementOf[serials] = np.fromiter((h.settlement.unique_id for h in households.values()),
+                                            dtype=np.int64, count=len(households))
+    return np.where(owners >= 0, settlementOf[owners >> KIND_BITS], -1)
+
+
+class SpatialRecorder:
+    """
+    Records the field rasters of one model, appending them to a chunked store every chunkYears years
+    """
+
+    def __init__(self, path: str, landscape, chunkYears: int = 50, level: int = 1):
+        """
+        Create a new store, replacing any at path
+
+        Args:
+            path: The file to write
+            landscape: The model's Landscape, giving the grid's size and the position of each field
+            chunkYears: The number of years of rasters in each chunk
+            level: The zlib compression level, from 1 (fastest) to 9 (smallest)
+        """
+        if chunkYears < 1:
+            raise ValueError("chunkYears must be at least 1")
+        self.path = path
+        self.fieldX = landscape.fieldX
+        self.fieldY = landscape.fieldY
+        self.chunkYears = chunkYears
+        self.level = level
+        width, height = landscape.river.shape
+        # Cells that are not fields keep their fill value, only the fields are written each year
+        self.buffers = [np.full((chunkYears, width, height), fill, dtype=dtype) for name, dtype, fill in LAYERS]
+        self.first = 0 # The year of the first buffered rasters
+        self.size = 0 # The number of years buffered
+        with open(path, "wb") as f:
+            np.array([(MAGIC, VERSION, width, height, chunkYears)], dtype=HEADER).tofile(f)
+
+    def record(self, model):
+        """ Record the rasters of a model's current year """
+        if self.size >= self.chunkYears:
+            self.flush()
+        if self.size == 0:
+            self.first = model.currentTime
+        elif model.currentTime != self.first + self.size:
+            raise ValueError("years must be recorded in order, expected %d" % (self.first + self.size))
+        owners = np.where(model.fieldOwned, model.fieldOwner, -1)
+        values = (owners, householdSettlements(model, owners), model.fieldFertility, model.fieldHarvested)
+        for buffer, layer in zip(self.buffers, values):
+            buffer[self.size, self.fieldX, self.fieldY] = layer
+        self.size += 1
+
+    def flush(self):
+        """ Append the buffered years to the store as a chunk of each layer """
+        if self.size:
+            with open(self.path, "ab") as f:
+                for layer, buffer in enumerate(self.buffers):
+                    data = zlib.compress(buffer[:self.size].tobytes(), self.level)
+                    np.array([(layer, self.first, self.size, len(data))], dtype=CHUNK).tofile(f)
+                    f.write(data)
+            self.first += self.size
+            self.size = 0
+
+
+class SpatialStore:
+    """
+    Reads a store written by SpatialRecorder
+
+    Attributes:
+        width: The width of the grid
+        height: The height of the grid
+        years: Array of the years recorded, in order
+    """
+
+    def __init__(self, path: str):
+        """
+        Open a store, memory mapping it and reading the position of each chunk
+
+        Args:
+            path: The store file
+        """
+        header = readHeader(path, HEADER, MAGIC, VERSION, "spatial store")
+        self.width = int(header["width"])
+        self.height = int(header["height"])
+        self.chunkYears = int(header["chunkYears"])
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        self.chunks = [[] for _ in LAYERS] # The (first year, years, offset, size) of each layer's chunks
+        offset = HEADER.itemsize
+        while offset + CHUNK.itemsize <= len(self.data):
+            chunk = np.frombuffer(self.data[offset:offset + CHUNK.itemsize], dtype=CHUNK)[0]
+            offset += CHUNK.itemsize
+            size = int(chunk["size"])
+            self.chunks[chunk["layer"]].append((int(chunk["first"]), int(chunk["years"]), offset, size))
+            offset += size
+        self.years = np.array([year for first, years, _, _ in self.chunks[0] for year in range(first, first + years)],
+                              dtype=np.int64)
+
+    def read(self, layer: str, start: int = None, stop: int = None, x=slice(None), y=slice(None)):
+        """
+        Read the rasters of a layer over a range of years and a region of the grid
+
+        Args:
+            layer: One of LAYER_NAMES
+            start: The first year to read, the first recorded if not given
+            stop: The year to read up to, not included, past the last recorded if not given
+            x: Slice of the grid's columns
+            y: Slice of the grid's rows
+
+        Returns:
+            Array indexed [year - start, x, y] of the recorded years in the range
+        """
+        index = LAYER_NAMES.index(layer)
+        name, dtype, fill = LAYERS[index]
+        years = self.years
+        if start is not None:
+            years = years[years >= start]
+        if stop is not None:
+            years = years[years < stop]
+        columns = len(range(self.width)[x])
+        rows = len(range(self.height)[y])
+        out = np.empty((len(years), columns, rows), dtype=dtype)
+        if len(years) == 0:
+            return out
+        start, stop = int(years[0]), int(years[-1]) + 1
+        filled = 0
+        for first, count, offset, size in self.chunks[index]:
+            lo, hi = max(start, first), min(stop, first + count)
+            if lo >= hi:
+                continue
+            # Only the chunks overlapping the range are decompressed, one at a time
+            rasters = np.frombuffer(zlib.decompress(self.data[offset:offset + size]), dtype=dtype)
+            rasters = rasters.reshape(count, self.width, self.height)
+            out[filled:filled + hi - lo] = rasters[lo - first:hi - first, x, y]
+            filled += hi - lo
+        return out
+
+    def raster(self, layer: str, year: int):
+        """ The raster of a layer in one year, indexed [x, y] """
+        rasters = self.read(layer, year, year + 1)
+        if len(rasters) == 0:
+            raise KeyError("year %d was not recorded" % year)
+        return rasters[0]
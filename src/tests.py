@@ -1,7 +1,40 @@
 import unittest
+import asyncio
+import gc
+import importlib.util
 import math
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import urllib.request
+import weakref
+import warnings
 
+import numpy as np
+import tornado.testing
+import tornado.websocket
+from mesa.space import MultiGrid
+
+from src.asyncserver import AsyncModularServer
+from src.batch import ReplicateSummary, runAdaptive, runEnsemble, runReplicates, runSummary
+from src.run import main
+from src.ensemble import EgyptEnsemble
+from src.kernels import PYTHON_KERNELS, loopKernels
+from src.sensitivity import SensitivityAnalysis
+from src.workqueue import WorkQueue, work
+from src.landscape import CACHED_LANDSCAPES, Landscape, loadLandscape
+from src.events import FISSION, RENT, EventLog
+from src.spatial import SpatialStore
+from src.inequality import QuantileSketch
+from src.metrics import RunMetrics, serveMetrics
+from src.memory import MemoryProfiler
+from src.ids import FARM, FIELD, HOUSEHOLD, idKind, idLabel, idSerial
 from src.agents import Field, Settlement, River, Household
+from src.datacollection import HouseholdPanel
 from src.model import EgyptSim, gini, minSetPop, maxSetPop, meanSetPop, minHWealth, maxHWealth, meanHWealth, lowerThirdGrainHoldings, middleThirdGrainHoldings, upperThirdGrainHoldings
 
 
@@ -150,6 +183,24 @@ class TestSetupMethods(unittest.TestCase):
         self.assertAlmostEqual(alpha, sim.alpha)
         self.assertAlmostEqual(beta, sim.beta)
 
+    def testSettlementReach(self):
+        """Test that settlements precompute the fields in reach and the haul cost rasters their households share"""
+        sim = EgyptSim(height=12, width=12, timeSpan=10, startingSettlements=2, startingHouseholds=2,
+                       knowledgeRadius=3, distanceCost=7)
+        for s in sim.schedule.get_breed(Settlement):
+            neighbours = sim.grid.get_neighbors(s.pos, False, False, 3)
+            self.assertEqual(s.fieldsInReach.tolist(), [a.index for a in neighbours if isinstance(a, Field)])
+            for x, y in [(1, 1), (11, 0), s.pos]:
+                self.assertEqual(s.haulCost[x, y], ((abs(s.pos[0]) - x) + abs(s.pos[1] - y)) * 7)
+
+        sim.setupFlood()
+        for f in sim.schedule.get_breed(Field):
+            f.flood()
+        for h in sim.schedule.get_breed(Household):
+            h.claimFields()
+            self.assertIn(h.fields[-1], h.settlement.fieldsInReach)  # Households with no fields always claim
+            self.assertIs(sim.fieldAgents[h.fields[-1]].owner, h)
+
 
 class TestDataCollectorMethods(unittest.TestCase):
 
@@ -337,6 +388,1146 @@ class TestDataCollectorMethods(unittest.TestCase):
         self.assertAlmostEqual(lowerThirdGrainHoldings(sim), 3)
 
 
+def sequentialFarm(household, fields, rental):
+    """ The one field at a time farming loop that Household.farm replaced, kept as a reference """
+    totalHarvest = 0
+    loops = ((household.workers - household.workersWorked) // 2)
+
+    def fert(field):
+        if not field.harvested:
+            return field.fertility
+        else:
+            return -1
+
+    agents = [household.model.fieldAgents[i] for i in fields]
+    agents.sort(key=fert, reverse=True)
+    fields[:] = [f.index for f in agents]
+    for i in range(loops):
+        for f in agents:
+            if not f.harvested:
+                harvest = (int(f.fertility * 2475 * household.competency) -
+                           (((abs(household.pos[0]) - f.pos[0]) + abs(household.pos[1] - f.pos[1])) *
+                            household.model.distanceCost))
+                chance = np.random.uniform(0, 1)
+                if (household.grain > (household.workers * 160)) or (chance < household.ambition * household.competency):
+                    f.harvested = True
+                    if rental and f.owner is not None:
+                        totalHarvest += round((harvest * (1 - (household.model.rentalRate)))) - 300
+                        f.owner.grain += round(harvest * (household.model.rentalRate))
+                        household.model.totalGrain += round(harvest * (household.model.rentalRate))
+                    else:
+                        totalHarvest += harvest - 300
+                    household.workersWorked += 2
+                break
+    household.grain += totalHarvest
+    household.model.totalGrain += totalHarvest
+
+
+class TestFarming(unittest.TestCase):
+
+    def farmBoth(self, rental, **params):
+        """ Farms every household with both implementations from identically seeded models and compares the outcome """
+        sims = []
+        for farm in (Household.farm, sequentialFarm):
+            sim = EgyptSim(height=15, width=15, timeSpan=10, startingSettlements=3, seed=11, **params)
+            for i in range(3):
+                sim.step()
+            sim.setupFlood()
+            for f in sim.schedule.get_breed(Field):
+                f.flood()
+            households = sim.schedule.get_breed(Household)
+            allFields = np.concatenate([h.fields for h in households])
+            for h in households:
+                h.workersWorked = 0
+                farm(h, allFields if rental else h.fields, rental)
+            sims.append((sim, allFields, np.random.uniform(0, 1)))
+
+        (vectorised, vFields, vNext), (sequential, sFields, sNext) = sims
+        self.assertEqual([h.grain for h in vectorised.schedule.get_breed(Household)],
+                         [h.grain for h in sequential.schedule.get_breed(Household)])
+        self.assertEqual([h.workersWorked for h in vectorised.schedule.get_breed(Household)],
+                         [h.workersWorked for h in sequential.schedule.get_breed(Household)])
+        self.assertEqual(vFields.tolist(), sFields.tolist())
+        self.assertTrue((vectorised.fieldHarvested == sequential.fieldHarvested).all())
+        self.assertEqual(vectorised.totalGrain, sequential.totalGrain)
+        self.assertEqual(vNext, sNext)  # The same number of chances were drawn
+
+    def testFarmMatchesSequential(self):
+        """ Test that batched farming harvests the same fields and draws the same chances as the sequential loop """
+        self.farmBoth(False)
+        self.farmBoth(False, startingGrain=100, minAmbition=0.0)
+
+    def testRentMatchesSequential(self):
+        """ Test that batched renting, including a household renting its own fields, matches the sequential loop """
+        self.farmBoth(True)
+        self.farmBoth(True, startingGrain=100, minAmbition=0.0, distanceCost=15)
+
+
+class TestFieldChangeover(unittest.TestCase):
+
+    def testFallowAgingAndRelease(self):
+        """ Test that unharvested fields age and are released in bulk once they reach the fallow limit """
+        sim = EgyptSim(height=10, width=10, timeSpan=10, startingSettlements=1, startingHouseholds=1, fallowLimit=2)
+        household = sim.schedule.get_breed(Household)[0]
+        sim.setupFlood()
+        for f in sim.schedule.get_breed(Field):
+            f.flood()
+        household.ambition = 0.0  # Always take the chance to claim
+        household.workers = 10
+        for i in range(4):
+            household.claimFields()
+        fields = household.fields.copy()
+        self.assertEqual(len(fields), 4)
+        self.assertFalse(any(household.farms[i].farmed for i in fields)) # Not farmed until their first changeover
+
+        sim.fieldHarvested[fields[:2]] = True
+        household.fieldChangeover()
+        self.assertEqual(sim.fieldYearsFallow[fields].tolist(), [0, 0, 1, 1])
+        self.assertTrue(all(household.farms[i].farmed == (i in fields[:2]) for i in fields))
+
+        sim.fieldHarvested[fields] = False
+        sim.fieldYearsFallow[fields[0]] = 5  # Aged before the changeover, but reset by the changeover
+        sim.fieldHarvested[fields[0]] = True
+        household.fieldChangeover()
+        self.assertEqual(household.fields.tolist(), fields[:2].tolist())  # Fields 3 and 4 reached the limit
+        self.assertFalse(sim.fieldOwned[fields[2:]].any())
+        self.assertIsNone(sim.fieldAgents[fields[3]].owner)
+        self.assertEqual(sorted(household.farms), sorted(fields[:2].tolist()))
+
+
+class TestSchedule(unittest.TestCase):
+
+    def testBreedViews(self):
+        """ Test that get_breed returns a shared read only view that follows additions and removals """
+        sim = EgyptSim(height=20, width=20, timeSpan=10, startingSettlements=2, startingHouseholds=3)
+        households = sim.schedule.get_breed(Household)
+        self.assertIsInstance(households, tuple)
+        self.assertIs(sim.schedule.get_breed(Household), households)
+        self.assertEqual(list(households), list(sim.schedule.agents_by_breed[Household].values()))
+
+        sim.schedule.remove(households[1])
+        self.assertEqual(sim.schedule.get_breed(Household), households[:1] + households[2:])
+        self.assertEqual(sim.schedule.get_breed_count(Household), 5)
+        sim.schedule.add(households[1])
+        self.assertEqual(sim.schedule.get_breed(Household)[-1], households[1])
+
+    def testHouseholdOrder(self):
+        """ Test that households farm in order of wealth and rent in order of ambition, ties kept in schedule order """
+        sim = EgyptSim(height=20, width=20, timeSpan=10, startingSettlements=2, startingHouseholds=3)
+        households = sim.schedule.get_breed(Household)
+        for h, grain, ambition in zip(households, [300, 100, 200, 100, 300, 200], [0.5, 0.2, 0.5, 0.9, 0.1, 0.2]):
+            h.grain = grain
+            h.ambition = ambition
+
+        farmed, rented = [], []
+        for h in households:
+            h.stepFarm = lambda h=h: farmed.append(h)
+            h.stepRentConsumeChangeover = lambda fields, h=h: rented.append(h)
+        sim.schedule.step_households(Household)
+
+        self.assertEqual(farmed, [households[i] for i in (1, 3, 2, 5, 0, 4)])
+        self.assertEqual(rented, [households[i] for i in (4, 1, 5, 2, 0, 3)])
+
+
+    def testWealthOrderAfterSteps(self):
+        """ Test that the kept wealth order, the grain max and the holdings thresholds match a full recount """
+        sim = EgyptSim(height=30, width=30, timeSpan=20, startingSettlements=5, startingHouseholds=6,
+                       fission=True, fissionChance=0.5, startingHouseholdSize=8, seed=3)
+        for i in range(20):
+            sim.step()
+            households = sim.schedule.get_breed(Household)
+            grains = [h.grain for h in households]
+            self.assertEqual(sim.schedule.wealthOrder(), sorted(households, key=lambda h: h.grain))
+            self.assertEqual(sim.maxHouseholdGrain, max(grains, default=0))
+            self.assertEqual(lowerThirdGrainHoldings(sim), sum(g <= sim.maxHouseholdGrain / 3 for g in grains))
+            self.assertEqual(upperThirdGrainHoldings(sim), sum(g > 2 * sim.maxHouseholdGrain / 3 for g in grains))
+
+    def testGrainHoldingsAfterRent(self):
+        """
+        Test the grain max and holdings of a seeded run, the max being taken over the living households once every
+        rental fee is paid. Taken as each household finished its turn, as it was before, it is lower in years 6, 8 and 9
+        """
+        sim = EgyptSim(height=30, width=30, timeSpan=12, startingSettlements=5, startingHouseholds=6,
+                       fission=True, fissionChance=0.5, startingHouseholdSize=8, seed=3)
+        maxGrain = []
+        while sim.running:
+            sim.step()
+            maxGrain.append(sim.maxHouseholdGrain)
+        self.assertEqual(maxGrain, [4104, 6631, 9132, 9779, 13646, 21793, 23521, 30837, 34903, 37951, 44019, 48182])
+        data = sim.datacollector.model_vars
+        self.assertEqual(data["Number of households with < 33% of wealthiest grain holding"],
+                         [0, 0, 0, 0, 8, 10, 9, 8, 7, 7, 8, 10, 12])
+        self.assertEqual(data["Number of households with 33 - 66%  of wealthiest grain holding"],
+                         [0, 2, 10, 19, 12, 10, 12, 11, 12, 11, 9, 13, 13])
+        self.assertEqual(data["Number of households with > 66% of wealthiest grain holding"],
+                         [30, 28, 20, 11, 10, 10, 9, 11, 11, 12, 13, 7, 5])
+
+
+class TestSettlementLifecycle(unittest.TestCase):
+
+    def testDeadSettlementTornDown(self):
+        """ Test that a settlement is queued when its last worker dies and its territory released on its turn """
+        sim = EgyptSim(height=20, width=20, timeSpan=10, startingSettlements=2, startingHouseholds=2, startingHouseholdSize=1,
+                       seed=1)
+        dead, alive = sim.schedule.get_breed(Settlement)
+        self.assertTrue(0 < len(dead.territory) <= 9) # Fewer cells at the edge of the grid
+        self.assertTrue(all(a.settlementTerritory for a in dead.territory))
+
+        for h in sim.schedule.get_breed(Household):
+            if h.settlement is dead:
+                h.grain = 0 # Starve the households of one settlement
+                h.consumeGrain()
+        self.assertEqual(sim.schedule.teardownQueue, [dead])
+        self.assertIn(dead.unique_id, sim.schedule.agents_by_breed[Settlement]) # Not removed until the settlements' turn
+
+        sim.schedule.step_settlements()
+        self.assertEqual(sim.schedule.get_breed(Settlement), (alive,))
+        self.assertEqual(sim.schedule.teardownQueue, [])
+        self.assertFalse(any(a.settlementTerritory for a in dead.territory))
+        # Cells the two territories share were released with the dead settlement's
+        self.assertTrue(all(a.settlementTerritory for a in alive.territory if a not in dead.territory))
+
+    def testRecoveredSettlementKept(self):
+        """ Test that a queued settlement whose population recovered within the step is not torn down """
+        sim = EgyptSim(height=20, width=20, timeSpan=10, startingSettlements=1, startingHouseholds=1, startingHouseholdSize=1)
+        settlement = sim.schedule.get_breed(Settlement)[0]
+        sim.schedule.queueTeardown(settlement)
+        sim.schedule.step_settlements()
+        self.assertEqual(sim.schedule.get_breed(Settlement), (settlement,))
+
+
+class TestStopConditions(unittest.TestCase):
+
+    def testStopReasons(self):
+        """ Test that each stop condition ends the run as soon as it is met and records why """
+        model = EgyptSim(height=10, width=10, timeSpan=5, startingSettlements=2, seed=1)
+        while model.running:
+            model.step()
+        self.assertEqual((model.currentTime, model.stopReason), (5, "timeSpan"))
+
+        model = EgyptSim(height=15, width=15, timeSpan=100, startingSettlements=5, startingHouseholds=2, startingHouseholdSize=1,
+                         startingGrain=100, popGrowthRate=0, minSettlements=4, seed=3)
+        while model.running:
+            model.step()
+        self.assertEqual(model.stopReason, "settlements")
+        self.assertEqual(model.datacollector.model_vars["Settlements"][-1], 4)
+        self.assertTrue(all(s > 4 for s in model.datacollector.model_vars["Settlements"][:-1]))
+
+        model = EgyptSim(height=20, width=20, timeSpan=500, startingSettlements=6, plateauReporter="Gini-Index",
+                         plateauWindow=20, plateauTolerance=0.02, seed=2)
+        while model.running:
+            model.step()
+        window = model.datacollector.model_vars["Gini-Index"][-20:]
+        self.assertEqual(model.stopReason, "plateau")
+        self.assertLess(model.currentTime, 500)
+        self.assertLessEqual(max(window) - min(window), 0.02)
+
+        # The window is in years, collecting every other year checks half as many values over the same years
+        sparse = EgyptSim(height=20, width=20, timeSpan=500, startingSettlements=6, plateauReporter="Gini-Index",
+                          plateauWindow=20, plateauTolerance=0.02, seed=2)
+        sparse.run(collectEvery=2)
+        self.assertEqual((sparse.stopReason, sparse.currentTime), ("plateau", model.currentTime))
+
+        model = EgyptSim(height=10, width=10, timeSpan=50, startingSettlements=2, stopCondition=lambda m: m.currentTime == 7)
+        while model.running:
+            model.step()
+        self.assertEqual((model.currentTime, model.stopReason), (7, "stopCondition"))
+
+        with self.assertRaises(ValueError):
+            EgyptSim(height=10, width=10, startingSettlements=2, plateauReporter="Gini")
+
+    def testEnsembleStopReasons(self):
+        """ Test that the ensemble stops each replicate on the same conditions """
+        params = {"height": 15, "width": 15, "timeSpan": 100, "startingSettlements": 5, "startingHouseholds": 2,
+                  "startingHouseholdSize": 1, "startingGrain": 100, "popGrowthRate": 0, "minSettlements": 4}
+        ensemble = EgyptEnsemble(50, params, seed=1)
+        ensemble.run()
+        for data, reason in zip(ensemble.results(), ensemble.stopReason):
+            self.assertIn(reason, ("settlements", "timeSpan"))
+            self.assertEqual(data["Settlements"][-1] <= 4, reason == "settlements")
+        with self.assertRaises(TypeError):
+            EgyptEnsemble(2, {"stopCondition": lambda m: True})
+
+
+class TestRun(unittest.TestCase):
+
+    def testCadence(self):
+        """ Test that run collects on its cadence and in the last year, simulating exactly what stepping does """
+        stepped = EgyptSim(height=15, width=15, timeSpan=23, startingSettlements=4, seed=9)
+        while stepped.running:
+            stepped.step()
+        model = EgyptSim(height=15, width=15, timeSpan=23, startingSettlements=4, seed=9)
+        self.assertEqual(model.run(10, collectEvery=4), 10)
+        self.assertEqual(model.collectedYears, [0, 4, 8, 10])
+        self.assertEqual(model.run(collectEvery=4), 13)
+        self.assertEqual(model.collectedYears, [0, 4, 8, 10, 12, 16, 20, 23])
+        for name, values in model.datacollector.model_vars.items():
+            self.assertEqual(values, [stepped.datacollector.model_vars[name][year] for year in model.collectedYears])
+        self.assertEqual(model.run(5), 0)
+        self.assertRaises(ValueError, model.run, 5, 0)
+
+    def testStopConditions(self):
+        """ Test that run stops on the same year as stepping, whether or not the year is collected """
+        params = {"height": 15, "width": 15, "timeSpan": 100, "startingSettlements": 5, "startingHouseholds": 2,
+                  "startingHouseholdSize": 1, "startingGrain": 100, "popGrowthRate": 0, "minSettlements": 4, "seed": 3}
+        stepped = EgyptSim(**params)
+        while stepped.running:
+            stepped.step()
+        model = EgyptSim(**params)
+        model.run(collectEvery=50)
+        self.assertEqual((model.currentTime, model.stopReason), (stepped.currentTime, "settlements"))
+        self.assertEqual(model.collectedYears[-1], model.currentTime)
+
+        model = EgyptSim(height=10, width=10, timeSpan=50, startingSettlements=2, stopCondition=lambda m: m.currentTime == 7)
+        model.run(collectEvery=5)
+        self.assertEqual((model.collectedYears, model.stopReason), ([0, 5, 7], "stopCondition"))
+
+        data, years, elapsed = runReplicates({"height": 10, "width": 10, "timeSpan": 12, "startingSettlements": 2}, 2,
+                                             seed=1, collectEvery=5)
+        self.assertEqual(data["Step"].tolist(), [0, 5, 10, 12] * 2)
+
+    def testLowGenerationalVariation(self):
+        """ Test that a generational variation too small for every household to redraw its traits still finishes """
+        model = EgyptSim(height=15, width=15, generationalVariation=0.2, timeSpan=30, seed=1)
+        self.assertEqual(model.run(), 30)
+        household = model.schedule.get_breed(Household)[0]
+        model.generationalVariation = 0.1
+        household.ambition, household.competency, household.generationCountdown = 0.55, 0.85, 1
+        household.genChangeover()
+        self.assertEqual((household.ambition, household.competency), (0.55, 0.85)) # No draw gets out, kept
+
+
+class TestIds(unittest.TestCase):
+
+    def testTypedRanges(self):
+        """ Test that agents get integer ids in their kind's range, leading to their state, and labels for display """
+        sim = EgyptSim(height=10, width=10, timeSpan=5, startingSettlements=3, startingHouseholds=2)
+        for field in sim.fieldAgents:
+            self.assertEqual((idKind(field.unique_id), idSerial(field.unique_id)), (FIELD, field.index))
+        settlements = sim.schedule.get_breed(Settlement)
+        self.assertEqual([s.label for s in settlements], ["s1", "s2", "s3"])
+        self.assertEqual([s.color for s in settlements], [sim.SETDICT[s.label] for s in settlements])
+        self.assertEqual([h.label for h in sim.schedule.get_breed(Household)], ["h1", "h2", "h3", "h4", "h5", "h6"])
+        self.assertEqual(list(sim.datacollector.tables["Settlement Population"]), ["s1_Population", "s2_Population", "s3_Population"])
+
+        while sim.running:
+            sim.step()
+        ids = [a.unique_id for a in sim.schedule.agents] + [a.unique_id for row in sim.grid.grid for cell in row for a in cell]
+        self.assertTrue(all(type(i) is int for i in ids))
+        farms = [a for row in sim.grid.grid for cell in row for a in cell if idKind(a.unique_id) == FARM]
+        self.assertTrue(all(type(f).__name__ == "Farm" for f in farms))
+        self.assertEqual(idLabel(farms[0].unique_id)[:4], "farm")
+
+    def testFissionIdsDoNotCollide(self):
+        """ Test that a household split off by fission never takes the id of a live household """
+        sim = EgyptSim(height=10, width=10, startingSettlements=1, startingHouseholds=2, fission=True, fissionChance=0)
+        first, second = sim.schedule.get_breed(Household)
+        sim.schedule.remove(first) # Ids used to be derived from the number of households, which is now 1
+        second.workers = 20
+        second.grain = 100000
+        second.fission()
+
+        households = sim.schedule.get_breed(Household)
+        self.assertEqual(len(households), 2)
+        self.assertIs(households[0], second)
+        self.assertEqual(idKind(households[1].unique_id), HOUSEHOLD)
+        self.assertEqual(households[1].label, "h3")
+
+
+class TestLandscape(unittest.TestCase):
+
+    def testMatchesGrid(self):
+        """ Test that the landscape lists the same neighbourhoods, distances and flood fertility the grid and fields give """
+        for width, height, radius in ((6, 5, 2), (5, 7, 10)):
+            landscape = Landscape.build(width, height, radius)
+            grid = MultiGrid(height=height, width=width, torus=False)
+            index = 0
+            for agent, x, y in grid.coord_iter():
+                self.assertEqual(landscape.river[x, y], x == 0)
+                if x != 0:
+                    self.assertEqual((landscape.fieldIndex[x, y], landscape.fieldX[index], landscape.fieldY[index]), (index, x, y))
+                    index += 1
+            for x in range(width):
+                for y in range(height):
+                    cells = grid.get_neighborhood((x, y), moore=False, include_center=False, radius=radius)
+                    self.assertEqual(landscape.fieldsInReach((x, y)).tolist(), [landscape.fieldIndex[c] for c in cells if c[0] != 0])
+                    self.assertEqual(landscape.haulDistance((x, y))[3, 1], (x - 3) + abs(y - 1))
+            self.assertFalse(any(getattr(landscape, name).flags.writeable for name in Landscape.ARRAYS))
+
+        sim = EgyptSim(height=10, width=10, startingSettlements=2)
+        sim.setupFlood()
+        for f in sim.fieldAgents:
+            f.flood()
+        expected = sim.fieldFertility.copy()
+        sim.floodFields()
+        self.assertEqual(sim.fieldFertility.tolist(), expected.tolist())
+
+    def testSharedDirectory(self):
+        """ Test that models attach to a landscape saved in a directory and run exactly as with a private one """
+        with tempfile.TemporaryDirectory() as d:
+            runs = []
+            for landscapeDir in (None, d, d):
+                model = EgyptSim(height=13, width=11, timeSpan=10, startingSettlements=3, landscapeDir=landscapeDir, seed=6)
+                while model.running:
+                    model.step()
+                runs.append(model.datacollector.model_vars)
+            self.assertEqual(runs[0], runs[1])
+            self.assertEqual(runs[0], runs[2])
+            self.assertEqual(len(os.listdir(d)), 1)
+
+            landscape = loadLandscape(11, 13, 20, d)
+            self.assertIs(model.landscape, landscape) # Attached once per process
+            self.assertFalse(landscape.reachFields.flags.writeable)
+            self.assertIsInstance(landscape.reachFields.base, np.memmap)
+
+    def testCacheBounded(self):
+        """ Test that loading more geometries than are cached drops the least recently used """
+        loadLandscape.cache_clear()
+        first = loadLandscape(4, 4, 1)
+        for radius in range(2, CACHED_LANDSCAPES + 2):
+            loadLandscape(4, 4, radius)
+        self.assertEqual(loadLandscape.cache_info().currsize, CACHED_LANDSCAPES)
+        self.assertIsNot(loadLandscape(4, 4, 1), first)
+        loadLandscape.cache_clear()
+
+
+class TestEvents(unittest.TestCase):
+
+    def snapshot(self, model):
+        """ The field owners, households and settlements of a model, as ReplayState holds them """
+        owners = np.where(model.fieldOwned, model.fieldOwner, -1).tolist()
+        households = {h.unique_id: [h.settlement.unique_id, h.workers] for h in model.schedule.get_breed(Household)}
+        settlements = {s.unique_id for s in model.schedule.get_breed(Settlement)}
+        return owners, households, settlements
+
+    def testReplay(self):
+        """ Test that replaying the log rebuilds the state of the model at the end of each year """
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "events.bin")
+            model = EgyptSim(timeSpan=60, fission=True, eventLog=path, seed=3)
+            model.events.flush()
+            model.events.buffer = model.events.buffer[:64] # Flush many times over the run
+            snapshots = {0: self.snapshot(model)}
+            while model.running:
+                model.step()
+                if model.currentTime % 20 == 0:
+                    snapshots[model.currentTime] = self.snapshot(model)
+
+            log = EventLog(path)
+            self.assertEqual(len(log.records), model.events.written)
+            for year, (owners, households, settlements) in snapshots.items():
+                state = log.stateAt(year)
+                self.assertEqual(state.fieldOwner.tolist(), owners)
+                self.assertEqual(state.households, households)
+                self.assertEqual(state.settlements, settlements)
+
+            rentals = log.events(kind=RENT)
+            self.assertGreater(len(rentals), 0)
+            self.assertTrue((rentals["household"] != rentals["other"]).any())
+            self.assertTrue((log.events(year=30)["year"] == 30).all())
+            self.assertGreater(len(log.events(kind=FISSION)), 0)
+
+    def testLogDoesNotChangeRun(self):
+        """ Test that keeping a log leaves a seeded run unchanged, and that other files are rejected """
+        with tempfile.TemporaryDirectory() as d:
+            runs = []
+            for path in (None, os.path.join(d, "events.bin")):
+                model = EgyptSim(timeSpan=20, fission=True, eventLog=path, seed=8)
+                while model.running:
+                    model.step()
+                runs.append(model.datacollector.model_vars)
+            self.assertEqual(runs[0], runs[1])
+
+            other = os.path.join(d, "other.bin")
+            with open(other, "wb") as f:
+                f.write(b"not an event log")
+            self.assertRaises(ValueError, EventLog, other)
+
+    def testRunFlushes(self):
+        """ Test that the log of a model run for fewer years than it would run is complete when run returns """
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "events.bin")
+            model = EgyptSim(timeSpan=60, eventLog=path, seed=4)
+            model.run(10)
+            self.assertTrue(model.running)
+            log = EventLog(path)
+            self.assertEqual(len(log.records), model.events.written)
+            self.assertEqual(model.events.size, 0)
+            self.assertEqual(int(log.records["year"].max()), 10)
+
+
+class TestSpatial(unittest.TestCase):
+
+    def testRasters(self):
+        """ Test that the store holds the state of every field in each year, read back by year range and region """
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, "fields.spatial")
+            model = EgyptSim(height=20, width=20, timeSpan=45, spatialStore=path, spatialChunkYears=10, seed=3)
+            x, y = model.landscape.fieldX, model.landscape.fieldY
+            expected = {}
+            while model.running:
+                model.step()
+                if model.currentTime in (9, 10, 31):
+                    owners = np.where(model.fieldOwned, model.fieldOwner, -1)
+                    settlements = [-1 if o < 0 else model.schedule.household(o).settlement.unique_id for o in owners]
+                    expected[model.currentTime] = (owners, settlements, model.fieldFertility.astype(np.float32),
+                                                   model.fieldHarvested.astype(int))
+
+            store = SpatialStore(path)
+            self.assertEqual(store.years.tolist(), list(range(46)))
+            self.assertEqual([len(chunks) for chunks in store.chunks], [5] * 4)
+            for year, (owners, settlements, fertility, harvested) in expected.items():
+                self.assertEqual(store.raster("household", year)[x, y].tolist(), owners.tolist())
+                self.assertEqual(store.raster("settlement", year)[x, y].tolist(), settlements)
+                self.assertEqual(store.raster("fertility", year)[x, y].tolist(), fertility.tolist())
+                self.assertEqual(store.raster("harvested", year)[x, y].tolist(), harvested.tolist())
+            self.assertTrue(np.isnan(store.raster("fertility", 10)[0]).all()) # The river
+
+            # A range spanning chunks, and a region of it
+            rasters = store.read("household", 5, 25)
+            self.assertEqual(rasters.shape, (20, 20, 20))
+            self.assertEqual(rasters[4].tolist(), store.raster("household", 9).tolist())
+            region = store.read("household", 5, 25, x=slice(3, 8), y=slice(10, 12))
+            self.assertEqual(region.shape, (20, 5, 2))
+            self.assertEqual(region.tolist(), rasters[:, 3:8, 10:12].tolist())
+            self.assertEqual(store.read("harvested", 40).shape, (6, 20, 20))
+            self.assertEqual(store.read("harvested", 50).shape, (0, 20, 20))
+            self.assertRaises(KeyError, store.raster, "harvested", 50)
+
+    def testStoreDoesNotChangeRun(self):
+        """ Test that recording rasters leaves a seeded run unchanged, and that the store is complete when run returns """
+        with tempfile.TemporaryDirectory() as d:
+            runs = []
+            for path in (None, os.path.join(d, "fields.spatial")):
+                model = EgyptSim(timeSpan=20, fission=True, spatialStore=path, seed=8)
+                model.run(12)
+                self.assertTrue(model.running)
+                if path is not None:
+                    self.assertEqual(SpatialStore(path).years.tolist(), list(range(13)))
+                model.run()
+                runs.append(model.datacollector.model_vars)
+            self.assertEqual(runs[0], runs[1])
+            self.assertEqual(SpatialStore(path).years.tolist(), list(range(21)))
+
+    def testRejectsOtherFiles(self):
+        """ Test that event logs and spatial stores are each rejected as the other """
+        with tempfile.TemporaryDirectory() as d:
+            log, store = os.path.join(d, "events.bin"), os.path.join(d, "fields.spatial")
+            EgyptSim(height=10, width=10, timeSpan=3, eventLog=log, spatialStore=store, seed=1).run()
+            EventLog(log), SpatialStore(store)
+            self.assertRaises(ValueError, SpatialStore, log)
+            self.assertRaises(ValueError, EventLog, store)
+
+
+class TestInequality(unittest.TestCase):
+
+    def testExact(self):
+        """ Test that an exact sketch gives the model's Gini-Index and grain holdings """
+        model = EgyptSim(timeSpan=40, fission=True, seed=5)
+        for _ in range(3):
+            model.run(10)
+            sketch = QuantileSketch(None)
+            grain = [h.grain for h in model.schedule.get_breed(Household)]
+            sketch.update(grain[:7])
+            sketch.update(grain[7:])
+            self.assertEqual(round(sketch.gini(), 2), gini(model))
+            third = model.maxHouseholdGrain / 3
+            lower, upper = sketch.rank(third), sketch.rank(2 * third)
+            self.assertEqual((lower, upper - lower, sketch.count - upper),
+                             (lowerThirdGrainHoldings(model), middleThirdGrainHoldings(model), upperThirdGrainHoldings(model)))
+            grain.sort()
+            self.assertEqual(sketch.quantile(0.5), grain[math.ceil(len(grain) / 2) - 1])
+            self.assertEqual(sketch.topShare(2 / len(grain)), sum(grain[-2:]) / sum(grain))
+
+    def testApproximate(self):
+        """ Test the error bounds of an approximate sketch and that merged sketches summarise all of the values """
+        rng = np.random.default_rng(2)
+        grain = (rng.pareto(1.5, 100000) * 1000).astype(np.int64)
+        grain[::10] = 0
+        exact = QuantileSketch(None)
+        exact.update(grain)
+        parts = []
+        for part in np.array_split(grain, 5):
+            sketch = QuantileSketch(0.01)
+            sketch.update(part)
+            parts.append(sketch)
+        sketch = parts[0]
+        for part in parts[1:]:
+            sketch.merge(part)
+        whole = QuantileSketch(0.01)
+        whole.update(grain)
+        self.assertEqual(sketch.counts.tolist(), whole.counts.tolist())
+        self.assertLess(sketch.size, 1000)
+        self.assertEqual((sketch.count, sketch.total, sketch.minimum, sketch.maximum),
+                         (len(grain), int(grain.sum()), 0, int(grain.max())))
+
+        for q in (0.05, 0.5, 0.9, 0.99, 0.999):
+            self.assertLessEqual(abs(sketch.quantile(q) - exact.quantile(q)), 0.01 * exact.quantile(q))
+        self.assertLessEqual(exact.gini() - sketch.gini(), 0.01 / 0.99)
+        self.assertGreaterEqual(exact.gini() - sketch.gini(), 0)
+        for fraction in (0.001, 0.01, 0.1):
+            self.assertAlmostEqual(sketch.topShare(fraction), exact.topShare(fraction), 2)
+        self.assertRaises(ValueError, sketch.merge, exact)
+
+        # Negative values are kept exactly
+        for s in (sketch, exact):
+            s.update([-5, -40])
+        self.assertEqual([sketch.quantile(0), sketch.quantile(2 / sketch.count), sketch.rank(-1), sketch.rank(0)],
+                         [-40, -5, 2, exact.rank(0)])
+        self.assertLessEqual(exact.gini() - sketch.gini(), 0.01 / 0.99)
+
+    def testModelReporters(self):
+        """ Test that a model's reporters computed from a sketch stay close to the exact ones """
+        runs = []
+        for accuracy in (0.0, 0.001):
+            model = EgyptSim(timeSpan=40, fission=True, inequalityAccuracy=accuracy, seed=6)
+            model.run()
+            runs.append(model.datacollector.model_vars)
+        self.assertEqual(runs[0]["Total Grain"], runs[1]["Total Grain"])
+        for exact, approximate in zip(runs[0]["Gini-Index"], runs[1]["Gini-Index"]):
+            self.assertLessEqual(abs(exact - approximate), 0.01)
+        self.assertEqual(model.inequality.count, runs[1]["Households"][-1])
+
+
+class TestPanel(unittest.TestCase):
+
+    def testRows(self):
+        """ Test that the panel holds the state of every household in each collected year """
+        model = EgyptSim(timeSpan=30, panelEvery=3, fission=True, seed=4)
+        expected = {}
+        while model.running:
+            model.step()
+            if model.currentTime % 3 == 0:
+                for h in model.schedule.get_breed(Household):
+                    expected[(model.currentTime, h.unique_id)] = (h.settlement.unique_id, h.grain, h.workers, h.ambition,
+                                                                  h.competency, len(h.fields))
+        data = model.panel.data()
+        self.assertEqual(sorted(set(data["Year"].tolist())), list(range(0, 31, 3)))
+        rows = {(y, h): (s, g, w, a, c, f) for y, h, s, g, w, a, c, f in zip(*(data[name].tolist() for name in HouseholdPanel.COLUMNS))}
+        self.assertEqual({k: v for k, v in rows.items() if k[0] > 0}, expected)
+
+        # Allocated for a collection at a time, not for the whole time span up front
+        started = EgyptSim(timeSpan=500, panelEvery=1, seed=4).panel
+        self.assertGreater(started.size, 0)
+        self.assertLessEqual(len(started.columns["Year"]), 2 * started.size)
+
+        # Columns grow past their starting capacity
+        panel = HouseholdPanel(capacity=1)
+        for year in range(3):
+            model.currentTime = year
+            panel.collect(model, model.schedule.get_breed(Household))
+        self.assertEqual(panel.size, 3 * model.schedule.get_breed_count(Household))
+        self.assertEqual(len(panel.get_dataframe()), panel.size)
+
+    def testSampling(self):
+        """ Test that a fraction or a cohort of households is followed for their whole lives """
+        model = EgyptSim(timeSpan=40, panelEvery=1, panelFraction=0.4, fission=True, seed=5)
+        households = model.schedule.get_breed(Household)
+        sampled = HouseholdPanel(fraction=0.4).sampled(np.array([h.unique_id for h in households]))
+        self.assertTrue(0.2 < sampled.mean() < 0.6)
+        while model.running:
+            model.step()
+        data = model.panel.data()
+        for household in set(data["Household"].tolist()):
+            years = data["Year"][data["Household"] == household]
+            self.assertEqual(years.tolist(), list(range(years[0], years[-1] + 1)))
+        self.assertTrue(set(data["Household"][data["Year"] == 0].tolist()) ==
+                        {h.unique_id for h, s in zip(households, sampled) if s})
+
+        model = EgyptSim(timeSpan=40, panelEvery=10, panelCohort=True, fission=True, seed=5)
+        cohort = {h.unique_id for h in model.schedule.get_breed(Household)}
+        while model.running:
+            model.step()
+        self.assertTrue(set(model.panel.data()["Household"].tolist()) <= cohort)
+        self.assertRaises(ValueError, HouseholdPanel, 0)
+
+
+class TestMemory(unittest.TestCase):
+
+    def testProfile(self):
+        """ Test that the profiler accounts for every phase and counts the live agents in the sampled years """
+        model = EgyptSim(height=15, width=15, timeSpan=12, startingSettlements=3, fission=True, seed=2)
+        profiler = MemoryProfiler(every=5)
+        profiler.attach(model)
+        model.run(collectEvery=4)
+        profiler.detach()
+        self.assertFalse(tracemalloc.is_tracing())
+
+        report = profiler.report()
+        self.assertEqual(report["years"], 12)
+        self.assertEqual(set(report["phaseBytes"]), {"flood", "farm", "rent", "settlements", "collect"})
+        self.assertEqual(list(report["counts"]), [0, 5, 10])
+        self.assertEqual(report["counts"][10]["Field"], 14 * 15)
+        self.assertEqual(report["counts"][10]["Household"], model.schedule.get_breed_count(Household))
+        self.assertEqual(report["unscheduled"][10], {"Field": 0, "Settlement": 0, "Household": 0})
+        self.assertEqual(report["growthPer100Years"]["Field"], 0)
+        self.assertGreater(report["traced"], 0)
+        self.assertTrue(all(diff.size >= 0 for diff in profiler.topGrowth("rent")))
+
+    def testModelsAreFreed(self):
+        """ Test that nothing keeps a finished model alive, households included """
+        model = EgyptSim(height=15, width=15, timeSpan=30, startingSettlements=3, fission=True, seed=2)
+        model.run()
+        self.assertTrue(model.fieldOwned.any())
+        ref = weakref.ref(model)
+        del model
+        gc.collect()
+        self.assertIsNone(ref())
+
+
+class TestBackends(unittest.TestCase):
+
+    def testLoopKernels(self):
+        """ Test that the loop versions of the kernels compiled by the numba backend match the NumPy versions """
+        loops = loopKernels()
+        rng = np.random.default_rng(3)
+        for trial in range(50):
+            n = 40
+            fertility = np.round(rng.uniform(-0.2, 1, n), 1) # Rounded to give ties
+            owned = rng.uniform(size=n) < 0.3
+            territory = rng.uniform(size=n) < 0.2
+            harvested = rng.uniform(size=n) < 0.4
+            reach = rng.permutation(n)[:rng.integers(0, n)]
+            self.assertEqual(loops.bestClaim(reach, fertility, owned, territory),
+                             PYTHON_KERNELS.bestClaim(reach, fertility, owned, territory))
+
+            fields = rng.permutation(n)[:rng.integers(0, n)]
+            ordered = fields.copy()
+            self.assertEqual(loops.farmingOrder(fields, fertility, harvested),
+                             PYTHON_KERNELS.farmingOrder(ordered, fertility, harvested))
+            self.assertEqual(fields.tolist(), ordered.tolist())
+
+            fieldX = rng.integers(0, 5, n)
+            fieldY = rng.integers(0, 8, n)
+            haulCost = rng.integers(0, 100, (5, 8))
+            self.assertEqual(loops.harvestYields(fields, fertility, fieldX, fieldY, haulCost, 0.7, 2475).tolist(),
+                             PYTHON_KERNELS.harvestYields(fields, fertility, fieldX, fieldY, haulCost, 0.7, 2475).tolist())
+
+    def runModel(self, backend, kernels=None, **params):
+        """ Run a seeded model on the given backend, or with the given kernels, and return its collected data """
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore") # Numba may not be installed
+            model = EgyptSim(height=15, width=15, timeSpan=30, startingSettlements=4, backend=backend, seed=8, **params)
+        if kernels is not None:
+            model.kernels = kernels
+        while model.running:
+            model.step()
+        return model.datacollector.model_vars, model.datacollector.tables
+
+    def testSeededEquivalence(self):
+        """ Test that seeded runs are the same with the NumPy kernels and the uncompiled loop kernels """
+        for params in ({}, {"fission": True, "fissionChance": 0.5, "startingHouseholdSize": 8}):
+            expected = self.runModel("python", **params)
+            self.assertEqual(self.runModel("python", loopKernels(), **params), expected)
+
+    @unittest.skipUnless(importlib.util.find_spec("numba"), "Numba is not installed")
+    def testCompiledEquivalence(self):
+        """ Test that seeded runs on the kernels compiled by Numba are the same as on the python backend """
+        self.assertEqual(EgyptSim(height=10, width=10, startingSettlements=2, backend="numba").kernels.name, "numba")
+        for params in ({}, {"fission": True, "fissionChance": 0.5, "startingHouseholdSize": 8}):
+            self.assertEqual(self.runModel("numba", **params), self.runModel("python", **params))
+
+    def testBackendSelection(self):
+        """ Test that the numba backend falls back to python without Numba and that unknown backends are rejected """
+        if importlib.util.find_spec("numba") is None:
+            with self.assertWarns(UserWarning):
+                model = EgyptSim(height=10, width=10, startingSettlements=2, backend="numba")
+            self.assertEqual(model.backend, "python")
+        else:
+            self.assertEqual(EgyptSim(height=10, width=10, startingSettlements=2, backend="numba").backend, "numba")
+        with self.assertRaises(ValueError):
+            EgyptSim(height=10, width=10, startingSettlements=2, backend="cuda")
+
+
+class TestSensitivity(unittest.TestCase):
+
+    def testIndices(self):
+        """ Test the indices of each design on an output of known sensitivities, y = 2a + b """
+        factors = {"minAmbition": (0, 1), "rentalRate": (0, 1), "fissionChance": (0, 1)}
+        with tempfile.TemporaryDirectory() as d, warnings.catch_warnings():
+            warnings.simplefilter("ignore") # SciPy may not be installed
+            for method, samples in (("sobol", 512), ("lhs", 2000)):
+                analysis = SensitivityAnalysis(os.path.join(d, method + ".jsonl"), factors, method, samples, outputs=["y"], seed=3)
+                for run, params in enumerate(analysis.design):
+                    analysis.results[run] = [100 + 2 * params["minAmbition"] + params["rentalRate"]]
+                indices = analysis.indices()["y"]
+                self.assertAlmostEqual(indices["minAmbition"][0], 0.8, delta=0.1)
+                self.assertAlmostEqual(indices["rentalRate"][0], 0.2, delta=0.1)
+                self.assertAlmostEqual(indices["fissionChance"][0], 0, delta=0.1)
+                if method == "sobol":
+                    self.assertAlmostEqual(indices["minAmbition"][1], 0.8, delta=0.1)
+                    self.assertAlmostEqual(indices["fissionChance"][1], 0, delta=0.1)
+
+    def testResume(self):
+        """ Test that an interrupted analysis resumes from its file and finishes with the same results """
+        params = {"height": 10, "width": 10, "timeSpan": 3, "startingSettlements": 2}
+        factors = ["knowledgeRadius", "distanceCost"]
+        with tempfile.TemporaryDirectory() as d, warnings.catch_warnings():
+            warnings.simplefilter("ignore")
+            path = os.path.join(d, "analysis.jsonl")
+            complete = SensitivityAnalysis(path, factors, "sobol", 3, params, seed=4)
+            self.assertEqual(len(complete.design), 3 * 4)
+            self.assertTrue(all(5 <= p["knowledgeRadius"] <= 40 and type(p["knowledgeRadius"]) is int for p in complete.design))
+            self.assertTrue(all(p["knowledgeRadius"] % 5 == 0 for p in complete.design)) # On the slider's steps
+            complete.run()
+
+            # Cut the file short part way through a line, as if the analysis was killed while writing it
+            with open(path) as f:
+                lines = f.readlines()
+            with open(path, "w") as f:
+                f.writelines(lines[:6])
+                f.write(lines[6][:10])
+
+            resumed = SensitivityAnalysis(path, factors, "sobol", 3, params)
+            self.assertEqual(resumed.remaining(), list(range(5, 12)))
+            resumed.run()
+            self.assertEqual(resumed.results, complete.results)
+            self.assertEqual(SensitivityAnalysis(path, factors, "sobol", 3, params).remaining(), [])
+            with self.assertRaises(ValueError):
+                SensitivityAnalysis(path, factors, "lhs", 3, params)
+
+    def testDefaultDesignFinishes(self):
+        """ Test that every run of a small default design finishes, generationalVariation kept to values that do """
+        params = {"height": 15, "width": 15, "timeSpan": 30}
+        with tempfile.TemporaryDirectory() as d:
+            analysis = SensitivityAnalysis(os.path.join(d, "default.jsonl"), method="lhs", samples=8, params=params, seed=1)
+            self.assertTrue(all(p["generationalVariation"] >= 0.6 for p in analysis.design))
+            analysis.run()
+            self.assertEqual(analysis.remaining(), [])
+
+    def testDefaultFactors(self):
+        """ Test that fissionChance is only varied by default when fission is enabled """
+        with tempfile.TemporaryDirectory() as d:
+            analysis = SensitivityAnalysis(os.path.join(d, "off.jsonl"), method="lhs", samples=2)
+            self.assertNotIn("fissionChance", analysis.factors)
+            self.assertIn("rentalRate", analysis.factors)
+            analysis = SensitivityAnalysis(os.path.join(d, "on.jsonl"), method="lhs", samples=2, params={"fission": True})
+            self.assertIn("fissionChance", analysis.factors)
+
+
+class TestWorkQueue(unittest.TestCase):
+
+    def testClaims(self):
+        """ Test that each job is claimed once, and that stale claims are requeued """
+        with tempfile.TemporaryDirectory() as d:
+            driver = WorkQueue(d)
+            names = driver.submitSweep([{"timeSpan": 3}, {"timeSpan": 4}, {"timeSpan": 5}], replicates=2, seed=10)
+            self.assertEqual(names, ["job-000000", "job-000001", "job-000002"])
+            self.assertEqual([driver.readJob("pending", name)["seed"] for name in names], [10, 12, 14])
+
+            first, second = WorkQueue(d), WorkQueue(d)
+            claims = [first.claim(), second.claim(), first.claim()]
+            self.assertEqual([name for name, job in claims], names)
+            self.assertIsNone(second.claim())
+            self.assertEqual(driver.status(), {"pending": 0, "claimed": 3, "done": 0, "failed": 0})
+
+            # A worker that has stopped touching its claim is taken to have died
+            stale = driver.jobPath("claimed", names[1])
+            os.utime(stale, (time.time() - 100, time.time() - 100))
+            self.assertTrue(first.heartbeat(names[0]))
+            self.assertEqual(driver.requeueStale(60), [names[1]])
+            self.assertFalse(second.heartbeat(names[1]))
+            self.assertEqual(driver.claim()[0], names[1])
+            self.assertEqual(driver.submit({"timeSpan": 6}), "job-000003")
+
+    def testWork(self):
+        """ Test that workers run every job and write results that combine into one frame """
+        with tempfile.TemporaryDirectory() as d:
+            params = {"height": 10, "width": 10, "startingSettlements": 2, "startingHouseholds": 2}
+            WorkQueue(d).submitSweep([dict(params, timeSpan=3), dict(params, timeSpan=5)], replicates=2, seed=1)
+            self.assertEqual(work(d, heartbeatInterval=0.01), ["job-000000", "job-000001"])
+            self.assertEqual(work(d), [])
+
+            queue = WorkQueue(d)
+            self.assertEqual(queue.status(), {"pending": 0, "claimed": 0, "done": 2, "failed": 0})
+            results = queue.results()
+            self.assertEqual(len(results), 2 * 4 + 2 * 6)
+            self.assertEqual(results.groupby("Job").timeSpan.first().tolist(), [3, 5])
+            expected, _, _ = runReplicates(dict(params, timeSpan=5), 2, seed=3)
+            job = results[results.Job == "job-000001"].reset_index(drop=True)
+            self.assertEqual(job["Total Grain"].tolist(), expected["Total Grain"].tolist())
+
+    def testFailedJob(self):
+        """ Test that a job that raises is failed with its traceback and the worker goes on to the next """
+        with tempfile.TemporaryDirectory() as d:
+            params = {"height": 10, "width": 10, "timeSpan": 3, "startingSettlements": 2, "startingHouseholds": 2}
+            WorkQueue(d).submitSweep([dict(params, noSuchParameter=1), params], seed=1)
+            self.assertEqual(work(d), ["job-000001"])
+
+            queue = WorkQueue(d)
+            self.assertEqual(queue.status(), {"pending": 0, "claimed": 0, "done": 1, "failed": 1})
+            with open(queue.jobPath("failed", "job-000000", ".txt")) as f:
+                self.assertIn("noSuchParameter", f.read())
+            self.assertEqual(queue.submit(params), "job-000002")
+
+
+class TestEnsemble(unittest.TestCase):
+
+    params = {"height": 10, "width": 10, "timeSpan": 5, "startingSettlements": 2, "startingHouseholds": 3}
+
+    def testLayout(self):
+        """ Test that the ensemble collects the same columns as EgyptSim and starts from the same state """
+        ensemble, years, _ = runEnsemble(self.params, replicates=3, seed=2)
+        objects, _, _ = runReplicates(self.params, replicates=1, seed=2)
+
+        self.assertEqual(ensemble.columns.tolist(), objects.columns.tolist())
+        self.assertEqual(years, 15)
+        self.assertEqual(len(ensemble), 3 * 6)
+        for replicate in range(3):
+            first = ensemble[(ensemble.Replicate == replicate) & (ensemble.Step == 0)]
+            for column in ("Total Grain", "Total Population", "Gini-Index", "Maximum Household Wealth"):
+                self.assertEqual(first[column].tolist(), objects[objects.Step == 0][column].tolist())
+
+    def testReproducible(self):
+        """ Test that a seeded ensemble is reproducible and that its replicates differ """
+        first, _, _ = runEnsemble(self.params, replicates=2, seed=9)
+        second, _, _ = runEnsemble(self.params, replicates=2, seed=9)
+        self.assertTrue(first.equals(second))
+        self.assertNotEqual(first[first.Replicate == 0]["Total Grain"].tolist(),
+                            first[first.Replicate == 1]["Total Grain"].tolist())
+
+    def testDistribution(self):
+        """ Test that the ensemble's replicates are distributed like EgyptSim runs """
+        ensemble = EgyptEnsemble(2000, self.params, seed=4)
+        ensemble.run()
+        objects = []
+        for seed in range(200):
+            model = EgyptSim(**self.params, seed=seed)
+            while model.running:
+                model.step()
+            objects.append((model.totalGrain, model.maxHouseholdGrain))
+        objects = np.array(objects, dtype=float)
+
+        for values, expected in ((ensemble.totalGrain, objects[:, 0]), (ensemble.maxHouseholdGrain, objects[:, 1])):
+            error = math.sqrt(np.var(values) / len(values) + np.var(expected) / len(expected))
+            self.assertLess(abs(np.mean(values) - np.mean(expected)), 4 * error)
+
+    def testLowGenerationalVariation(self):
+        """ Test that households whose traits no redraw can move do not hold up the ensemble """
+        ensemble = EgyptEnsemble(4, dict(self.params, timeSpan=30, generationalVariation=0.2), seed=1)
+        ensemble.run()
+        self.assertEqual(ensemble.currentTime, 30)
+
+    def testUnknownParameter(self):
+        """ Test that parameters EgyptSim does not take are rejected """
+        with self.assertRaises(TypeError):
+            EgyptEnsemble(2, {"rivers": 2})
+
+
+class SlowEgyptSim(EgyptSim):
+    """EgyptSim with an artificially slow step, standing in for a model on a large grid"""
+
+    def step(self):
+        time.sleep(0.5)
+        super().step()
+
+
+class TestAsyncServer(tornado.testing.AsyncHTTPTestCase):
+
+    def get_httpserver_options(self):
+        return {"xheaders": True} # So that requests can claim to come from another machine
+
+    def get_app(self):
+        AsyncModularServer.verbose = False
+        return AsyncModularServer(SlowEgyptSim, [], "Test", {"height": 10, "width": 10, "timeSpan": 10,
+                                                             "startingSettlements": 2, "startingHouseholds": 2}, metrics=True)
+
+    @tornado.testing.gen_test
+    async def testControlDuringStep(self):
+        """ Test that control messages are answered while a step is still running """
+        ws = await tornado.websocket.websocket_connect("ws://127.0.0.1:%d/ws" % self.get_http_port())
+        ws.write_message(json.dumps({"type": "get_step", "step": 1}))
+        ws.write_message(json.dumps({"type": "get_params"}))
+
+        self.assertEqual(json.loads(await ws.read_message())["type"], "model_params")  # Answered before the step finishes
+        self.assertEqual(json.loads(await ws.read_message())["type"], "viz_state")
+        self.assertEqual(self._app.model.currentTime, 1)
+
+    @tornado.testing.gen_test(timeout=10)
+    async def testStepBackpressure(self):
+        """ Test that step requests beyond the one running and the one queued are dropped """
+        ws = await tornado.websocket.websocket_connect("ws://127.0.0.1:%d/ws" % self.get_http_port())
+        for i in range(5):
+            ws.write_message(json.dumps({"type": "get_step", "step": i + 1}))
+        ws.write_message(json.dumps({"type": "reset"}))
+
+        # Two steps (running and queued) are accepted, the queued one is superseded by the reset
+        self.assertEqual(json.loads(await ws.read_message())["type"], "viz_state")
+        self.assertEqual(json.loads(await ws.read_message())["type"], "viz_state")
+        self.assertEqual(self._app.model.currentTime, 0)
+
+    @tornado.testing.gen_test(timeout=10)
+    async def testResetCopiesParameters(self):
+        """ Test that a reset queued behind a step builds the model from the parameters as they were when it was asked for """
+        step = asyncio.ensure_future(self._app.step_model())
+        reset = asyncio.ensure_future(self._app.reset_model_async())
+        await asyncio.sleep(0) # Both handed to the worker thread, which is still stepping
+        self._app.model_kwargs["timeSpan"] = 20
+        await step
+        await reset
+        self.assertEqual(self._app.model.timeSpan, 10)
+
+    @tornado.testing.gen_test
+    async def testMetrics(self):
+        """ Test that the server serves the metrics of its model as JSON and Prometheus text """
+        ws = await tornado.websocket.websocket_connect("ws://127.0.0.1:%d/ws" % self.get_http_port())
+        ws.write_message(json.dumps({"type": "get_step", "step": 1}))
+        await ws.read_message()
+
+        response = await self.http_client.fetch(self.get_url("/metrics.json"))
+        metrics = json.loads(response.body)
+        self.assertEqual((metrics["step"], metrics["years_simulated"], metrics["settlements"]), (1, 1, 2))
+        self.assertEqual(metrics["households"], self._app.model.schedule.get_breed_count(Household))
+        self.assertGreater(metrics["phase_seconds"]["farm"], 0)
+
+        response = await self.http_client.fetch(self.get_url("/metrics"))
+        self.assertIn('egypt_phase_seconds_total{phase="rent"}', response.body.decode())
+        self.assertIn("egypt_step 1.0", response.body.decode())
+
+        response = await self.http_client.fetch(self.get_url("/metrics"), headers={"X-Real-Ip": "192.0.2.1"},
+                                                raise_error=False)
+        self.assertEqual(response.code, 403) # Not served to other machines
+
+    def testMetricsOptIn(self):
+        """ Test that the browser interface only serves metrics when EGYPT_METRICS is set """
+        code = "from src.server import server; print(server.metrics is not None)"
+        for value, expected in ((None, "False"), ("1", "True")):
+            env = {k: v for k, v in os.environ.items() if k != "EGYPT_METRICS"}
+            if value is not None:
+                env["EGYPT_METRICS"] = value
+            out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env,
+                                 cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            self.assertEqual(out.stdout.strip().splitlines()[-1], expected)
+
+
+class TestHeadlessRunner(unittest.TestCase):
+
+    def testMetrics(self):
+        """ Test that the runner's metrics endpoint follows its runs """
+        metrics = RunMetrics()
+        server = serveMetrics(metrics, 0)
+        try:
+            params = {"height": 10, "width": 10, "timeSpan": 5, "startingSettlements": 2, "startingHouseholds": 2}
+            runReplicates(params, replicates=2, seed=1, metrics=metrics)
+            model = EgyptSim(**params)
+            metrics.watch(model)
+            model.run(3)
+
+            url = "http://%s:%d/metrics" % server.server_address
+            with urllib.request.urlopen(url + ".json") as response:
+                snapshot = json.loads(response.read())
+            self.assertEqual((snapshot["replicates_finished"], snapshot["years_simulated"], snapshot["step"]), (2, 13, 3))
+            self.assertEqual(snapshot["datacollector_rows"], 4)
+            self.assertEqual(set(snapshot["phase_seconds_total"]), {"flood", "farm", "rent", "settlements", "collect"})
+            with urllib.request.urlopen(url) as response:
+                text = response.read().decode()
+            self.assertIn("egypt_replicates_finished 2.0", text)
+            self.assertIn('egypt_phase_seconds{phase="flood"}', text)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def testSeededReplicates(self):
+        """ Test that seeded replicates are reproducible and independent of the number of workers """
+        params = {"height": 10, "width": 10, "timeSpan": 5, "startingSettlements": 2, "startingHouseholds": 2}
+        serial, years, elapsed = runReplicates(params, replicates=2, workers=1, seed=5)
+        parallel, _, _ = runReplicates(params, replicates=2, workers=2, seed=5)
+
+        self.assertEqual(years, 10)
+        self.assertEqual(len(serial), 2 * 6)  # Initial collection plus one per year
+        self.assertTrue(serial.equals(parallel))
+        self.assertNotEqual(serial[serial.Replicate == 0]["Total Grain"].tolist(),
+                            serial[serial.Replicate == 1]["Total Grain"].tolist())
+
+    def testAdaptiveReplicates(self):
+        """ Test that replicates are added until the confidence interval is narrow enough or the budget is spent """
+        points = [{"height": 10, "width": 10, "timeSpan": 5, "startingSettlements": 2, "startingHouseholds": 2},
+                  {"height": 10, "width": 10, "timeSpan": 5, "startingSettlements": 2, "startingHouseholds": 4, "knowledgeRadius": 2}]
+        summary, runs, _ = runAdaptive(points, "Gini-Index", tolerance=0.04, minReplicates=4, maxReplicates=40, seed=1)
+        self.assertEqual(len(runs), summary.Replicates.sum())
+        for point in summary.to_dict("records"):
+            self.assertTrue(4 <= point["Replicates"] < 40)
+            self.assertTrue(point["Converged"])
+            self.assertLessEqual(point["Half Width"], 0.04)
+
+        # Out of budget before converging, the same replicates whether run serially or on a pool
+        serial, serialRuns, _ = runAdaptive(points, "Gini-Index", tolerance=0, minReplicates=2, maxReplicates=5, seed=1)
+        parallel, parallelRuns, _ = runAdaptive(points, "Gini-Index", tolerance=0, minReplicates=2, maxReplicates=5, workers=2, seed=1)
+        self.assertEqual(serial.Replicates.tolist(), [5, 5])
+        self.assertFalse(serial.Converged.any())
+        self.assertTrue(serialRuns.equals(parallelRuns))
+
+        # Points would share seeds, or have no interval to check
+        for minReplicates, maxReplicates in ((6, 5), (1, 5)):
+            with self.assertRaises(ValueError):
+                runAdaptive(points, minReplicates=minReplicates, maxReplicates=maxReplicates, seed=1)
+
+    def testSummary(self):
+        """ Test that summaries folded one run at a time, and merged across workers, match the reduced replicates """
+        params = {"height": 10, "width": 10, "timeSpan": 12, "startingSettlements": 2, "startingHouseholds": 3}
+        data, _, _ = runReplicates(params, replicates=9, seed=3, collectEvery=5)
+        summary, years, _ = runSummary(params, replicates=9, seed=3, collectEvery=5, accuracy=None)
+        parallel, parallelYears, _ = runSummary(params, replicates=9, workers=2, seed=3, collectEvery=5, accuracy=None)
+        self.assertEqual((summary.replicates, years), (9, parallelYears))
+
+        for frame in (summary.get_dataframe(), parallel.get_dataframe()):
+            self.assertEqual(sorted(set(frame.Step)), [0, 5, 10, 12])
+            for series in ("Gini-Index", "Total Grain", "s1_Population"):
+                values = data.groupby("Step")[series]
+                rows = frame[frame.Series == series].set_index("Step")
+                self.assertEqual(rows.Replicates.tolist(), values.count().tolist())
+                self.assertTrue(np.allclose(rows.Mean, values.mean()))
+                self.assertTrue(np.allclose(rows.Variance, values.var(), equal_nan=True))
+                self.assertEqual(rows.Max.tolist(), values.max().tolist())
+                self.assertEqual(rows["Q0.5"].tolist(), values.quantile(0.5, interpolation="lower").tolist())
+
+        # Sketched quantiles are within the accuracy of the exact ones, and memory does not grow with the replicates
+        sketched = ReplicateSummary(accuracy=0.01, bufferRuns=4)
+        sizes = []
+        for repeat in range(3):
+            for _, run in data.groupby("Replicate"):
+                sketched.add({"Total Grain": run["Total Grain"].tolist()}, run.Step.tolist())
+            exact = summary.get_dataframe().set_index(["Series", "Step"]).loc["Total Grain"]
+            frame = sketched.get_dataframe().set_index("Step")
+            for q in ("Q0.05", "Q0.5", "Q0.95"):
+                self.assertTrue(np.allclose(frame[q], exact[q], rtol=0.01))
+            self.assertTrue(np.allclose(frame.Mean, exact.Mean))
+            sizes.append([sketch.size for sketch in sketched.sketches["Total Grain"] if sketch is not None])
+        self.assertEqual(sketched.replicates, 27)
+        self.assertEqual(sizes[0], sizes[2])
+
+    def testOutput(self):
+        """ Test that the command line runner writes the collected data in the requested format """
+        with tempfile.TemporaryDirectory() as d:
+            config = os.path.join(d, "config.json")
+            with open(config, "w") as f:
+                json.dump({"height": 10, "width": 10, "timeSpan": 50, "startingSettlements": 2}, f)
+            csv = os.path.join(d, "out.csv")
+            npz = os.path.join(d, "out.npz")
+
+            self.assertEqual(main(["--config", config, "--timeSpan", "3", "--no-rental", "--seed", "1", "-o", csv]), 0)
+            self.assertEqual(main(["--config", config, "--timeSpan", "3", "--no-rental", "--seed", "1", "-o", npz]), 0)
+
+            with open(csv) as f:
+                self.assertEqual(len(f.readlines()), 1 + 4)  # Header, initial collection and 3 years
+            data = np.load(npz, allow_pickle=True)
+            self.assertEqual(data["Step"].tolist(), [0, 1, 2, 3])
+            self.assertIn("s1_Population", data)
+
+            summary = os.path.join(d, "summary.csv")
+            self.assertEqual(main(["--config", config, "--timeSpan", "3", "--seed", "1", "--replicates", "3",
+                                   "--summary", "--quantiles", "0.1", "0.9", "-o", summary]), 0)
+            with open(summary) as f:
+                self.assertEqual(f.readline().strip(), "Series,Step,Replicates,Mean,Variance,Min,Max,Q0.1,Q0.9")
+
+    def testNoVisualisationImports(self):
+        """ Test that the headless runner does not import the visualisation stack """
+        code = "import sys, src.run; print(any(m.startswith(('mesa.visualization', 'tornado')) for m in sys.modules))"
+        out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True,
+                             cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        self.assertEqual(out.stdout.strip(), "False")
+
+
 def suite():
     """
     Gather all tests from this module into a test suite
@@ -344,5 +1535,24 @@ def suite():
     testSuite = unittest.TestSuite()
     testSuite.addTest(unittest.makeSuite(TestSetupMethods))
     testSuite.addTest(unittest.makeSuite(TestDataCollectorMethods))
+    testSuite.addTest(unittest.makeSuite(TestFarming))
+    testSuite.addTest(unittest.makeSuite(TestFieldChangeover))
+    testSuite.addTest(unittest.makeSuite(TestSchedule))
+    testSuite.addTest(unittest.makeSuite(TestSettlementLifecycle))
+    testSuite.addTest(unittest.makeSuite(TestStopConditions))
+    testSuite.addTest(unittest.makeSuite(TestRun))
+    testSuite.addTest(unittest.makeSuite(TestLandscape))
+    testSuite.addTest(unittest.makeSuite(TestEvents))
+    testSuite.addTest(unittest.makeSuite(TestPanel))
+    testSuite.addTest(unittest.makeSuite(TestSpatial))
+    testSuite.addTest(unittest.makeSuite(TestInequality))
+    testSuite.addTest(unittest.makeSuite(TestMemory))
+    testSuite.addTest(unittest.makeSuite(TestIds))
+    testSuite.addTest(unittest.makeSuite(TestBackends))
+    testSuite.addTest(unittest.makeSuite(TestEnsemble))
+    testSuite.addTest(unittest.makeSuite(TestSensitivity))
+    testSuite.addTest(unittest.makeSuite(TestWorkQueue))
+    testSuite.addTest(unittest.makeSuite(TestAsyncServer))
+    testSuite.addTest(unittest.makeSuite(TestHeadlessRunner))
 
     return testSuite
@@ -0,0 +1,327 @@
+import argparse
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+from src.batch import replicateSeeds, runReplicates
+
+
+# Parameter sweeps spread over several machines with nothing but a shared directory. The driver writes each parameter
+# set as a job file, and workers on any machine claim jobs, run them headless on their own process pool and write the
+# results next to the job. A sweep directory holds:
+#
+#     pending/job-000003.json    Jobs waiting for a worker
+#     claimed/job-000001.json    Jobs being run. A worker claims a job by renaming it here from pending, which succeeds
+#                                for exactly one worker, and touches it while it runs
+#     done/job-000000.json       Finished jobs, next to their results in done/job-000000.csv
+#     failed/job-000002.json     Jobs that raised an exception, next to its traceback in failed/job-000002.txt
+#
+# A claim whose file has not been touched for longer than the stale timeout belongs to a worker that has died, and is
+# renamed back to pending by requeueStale. Jobs are seeded, so a job run twice writes the same results. A job that
+# raises is failed rather than requeued, it would only take down the next worker to claim it.
+#
+#     python -m src.workqueue submit sweep --points points.json --replicates 8 --seed 1
+#     python -m src.workqueue work sweep --workers 8            (on each machine)
+#     python -m src.workqueue status sweep --requeue 600
+
+STATES = ("pending", "claimed", "done", "failed")
+
+
+class WorkQueue:
+    """
+    A sweep's job files in a shared directory
+    """
+
+    def __init__(self, path: str):
+        """
+        Open a sweep directory, creating it if it does not exist
+
+        Args:
+            path: The sweep directory
+        """
+        self.path = path
+        for state in STATES:
+            os.makedirs(os.path.join(path, state), exist_ok=True)
+
+    def jobPath(self, state: str, name: str, extension: str = ".json"):
+        """ The path of a job's file in one of STATES """
+        return os.path.join(self.path, state, name + extension)
+
+    def jobs(self, state: str):
+        """ The names of the jobs in one of STATES, in order """
+        return sorted(f[:-5] for f in os.listdir(os.path.join(self.path, state)) if f.endswith(".json"))
+
+    def stagingPath(self, path: str):
+        """ A temporary name for a file being written, unique to this process """
+        return "%s.%s-%d.tmp" % (path, socket.gethostname(), os.getpid())
+
+    def writeAtomic(self, path: str, write):
+        """ Write a file under a temporary name and rename it into place, so it is never seen half written """
+        staging = self.stagingPath(path)
+        write(staging)
+        os.replace(staging, path)
+
+    def submit(self, params: dict, replicates: int = 1, seed: int = None, collectEvery: int = 1):
+        """
+        Add a job to the sweep
+
+        Args:
+            params: Keyword arguments for the EgyptSim constructor
+            replicates: The number of replicates to run
+            seed: Base seed of the replicates, drawn at random if not given
+            collectEvery: Collect data every this many years, and in the last year
+
+        Returns:
+            The job's name
+        """
+        job = {"params": params, "replicates": replicates, "seed": replicateSeeds(1, seed)[0],
+               "collectEvery": collectEvery}
+        number = max((int(name.split("-")[1]) for state in STATES for name in self.jobs(state)), default=-1) + 1
+        staging = self.stagingPath(self.jobPath("pending", "job"))
+        self.writeJob(staging, job)
+        try:
+            while True:
+                name = "job-%06d" % number
+                try:
+                    # Unlike a rename, linking fails if the name is taken, by a driver submitting at the same time
+                    os.link(staging, self.jobPath("pending", name))
+                    return name
+                except FileExistsError:
+                    number += 1
+        finally:
+            os.unlink(staging)
+
+    def submitSweep(self, points: list, replicates: int = 1, seed: int = None, collectEvery: int = 1):
+        """
+        Add a job for each parameter set of a sweep. Point p's replicates are seeded from seed + p * replicates, so no
+        two jobs share a seed.
+
+        Args:
+            points: List of EgyptSim parameter dictionaries
+            replicates: The number of replicates of each
+            seed: Base seed, drawn at random if not given
+            collectEvery: Collect data every this many years, and in the last year
+
+        Returns:
+            The names of the jobs
+        """
+        seed = replicateSeeds(1, seed)[0]
+        return [self.submit(params, replicates, seed + p * replicates, collectEvery) for p, params in enumerate(points)]
+
+    def writeJob(self, path: str, job: dict):
+        """ Write a job's dictionary to a file """
+        with open(path, "w") as f:
+            json.dump(job, f)
+
+    def readJob(self, state: str, name: str):
+        """ Read the dictionary of a job in one of STATES """
+        with open(self.jobPath(state, name)) as f:
+            return json.load(f)
+
+    def claim(self):
+        """
+        Claim the first pending job that no other worker claims first
+
+        Returns:
+            A tuple of the job's name and its dictionary, None if no job is pending
+        """
+        for name in self.jobs("pending"):
+            try:
+                # Touched first, a job that waited longer than the stale timeout is not requeued as soon as it is claimed
+                os.utime(self.jobPath("pending", name))
+                os.rename(self.jobPath("pending", name), self.jobPath("claimed", name))
+            except FileNotFoundError: # Claimed by another worker
+                continue
+            return name, self.readJob("claimed", name)
+        return None
+
+    def heartbeat(self, name: str):
+        """
+        Mark a claimed job as still running
+
+        Returns:
+            False if the job is no longer claimed, it was requeued as stale
+        """
+        try:
+            os.utime(self.jobPath("claimed", name))
+            return True
+        except FileNotFoundError:
+            return False
+
+    def complete(self, name: str, data):
+        """
+        Write a claimed job's results and mark it done. The results are written even if the claim was requeued in the
+        meantime, the job will then be marked done by whichever worker runs it again.
+
+        Args:
+            name: The job
+            data: DataFrame of its results, as runReplicates returns
+        """
+        self.writeAtomic(self.jobPath("done", name, ".csv"), lambda path: data.to_csv(path, index=False))
+        try:
+            os.rename(self.jobPath("claimed", name), self.jobPath("done", name))
+        except FileNotFoundError: # Requeued as stale while it ran
+            pass
+
+    def fail(self, name: str, error: str):
+        """
+        Mark a claimed job as failed, writing the error that ended it next to it
+
+        Args:
+            name: The job
+            error: The traceback of the exception it raised
+        """
+        def write(path):
+            with open(path, "w") as f:
+                f.write(error)
+        self.writeAtomic(self.jobPath("failed", name, ".txt"), write)
+        try:
+            os.rename(self.jobPath("claimed", name), self.jobPath("failed", name))
+        except FileNotFoundError: # Requeued as stale while it ran
+            pass
+
+    def requeueStale(self, timeout: float):
+        """
+        Return to pending the claimed jobs that have not been touched for longer than a timeout
+
+        Args:
+            timeout: Seconds without a heartbeat after which a claim's worker is taken to have died
+
+        Returns:
+            The names of the jobs requeued
+        """
+        requeued = []
+        now = time.time()
+        for name in self.jobs("claimed"):
+            path = self.jobPath("claimed", name)
+            try:
+                if now - os.path.getmtime(path) <= timeout:
+                    continue
+                if os.path.exists(self.jobPath("done", name, ".csv")): # Finished as we looked
+                    continue
+                os.rename(path, self.jobPath("pending", name))
+            except FileNotFoundError: # Finished or requeued by someone else
+                continue
+            requeued.append(name)
+        return requeued
+
+    def status(self):
+        """ The number of jobs in each of STATES """
+        return {state: len(self.jobs(state)) for state in STATES}
+
+    def results(self):
+        """
+        Combines the results of the finished jobs into one DataFrame, with "Job" prepended to runReplicates' columns
+        and a column for each parameter set by any job
+        """
+        import pandas as pd
+        frames = []
+        for name in self.jobs("done"):
+            job = self.readJob("done", name)
+            data = pd.read_csv(self.jobPath("done", name, ".csv"))
+            for param, value in job["params"].items():
+                data[param] = value
+            data.insert(0, "Job", name)
+            frames.append(data)
+        return pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+
+
+def work(path: str, workers: int = 1, heartbeatInterval: float = 30.0, wait: bool = False, poll: float = 10.0):
+    """
+    Run a sweep's jobs until none are pending, each on a local process pool. A job that raises an exception is moved
+    to failed with its traceback and the worker carries on with the next
+
+    Args:
+        path: The sweep directory
+        workers: The number of worker processes each job's replicates are run on
+        heartbeatInterval: Seconds between touches of the claimed job, well under the driver's stale timeout
+        wait: Keep polling for new jobs rather than returning once none are pending
+        poll: Seconds between polls when waiting
+
+    Returns:
+        The names of the jobs run successfully
+    """
+    queue = WorkQueue(path)
+    done = []
+    while True:
+        claimed = queue.claim()
+        if claimed is None:
+            if not wait:
+                return done
+            time.sleep(poll)
+            continue
+        name, job = claimed
+
+        stop = threading.Event()
+        def beat():
+            while not stop.wait(heartbeatInterval) and queue.heartbeat(name):
+                pass
+        beating = threading.Thread(target=beat, daemon=True)
+        beating.start()
+        try:
+            data, years, elapsed = runReplicates(job["params"], job["replicates"], workers, job["seed"],
+                                                 job.get("collectEvery", 1))
+        except Exception:
+            error = traceback.format_exc()
+            queue.fail(name, error)
+            print("%s failed: %s" % (name, error.strip().splitlines()[-1]))
+            continue
+        finally:
+            stop.set()
+            beating.join()
+        queue.complete(name, data)
+        done.append(name)
+        print("%s: %d years over %d replicates in %.2fs" % (name, years, job["replicates"], elapsed))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parameter sweeps of the Farmers to Pharaohs simulation over a shared directory.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    submit = commands.add_parser("submit", help="Add jobs to a sweep")
+    submit.add_argument("path", help="The sweep directory")
+    submit.add_argument("--points", required=True, help="JSON file of a list of EgyptSim parameter sets, one job each")
+    submit.add_argument("--replicates", type=int, default=1, help="Number of replicates of each parameter set")
+    submit.add_argument("--seed", type=int, help="Base seed of the sweep")
+    submit.add_argument("--collectEvery", type=int, default=1, help="Collect data every this many years, and in the last year")
+
+    worker = commands.add_parser("work", help="Run a sweep's pending jobs")
+    worker.add_argument("path", help="The sweep directory")
+    worker.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    worker.add_argument("--heartbeat", type=float, default=30.0, help="Seconds between heartbeats of a running job")
+    worker.add_argument("--wait", action="store_true", help="Keep waiting for new jobs once none are pending")
+
+    status = commands.add_parser("status", help="Count a sweep's jobs, requeueing stale claims and listing failed jobs")
+    status.add_argument("path", help="The sweep directory")
+    status.add_argument("--requeue", type=float, metavar="SECONDS",
+                        help="Requeue claims without a heartbeat for this many seconds")
+    status.add_argument("--output", "-o", help="CSV file to write the combined results of the finished jobs to")
+    args = parser.parse_args(argv)
+
+    queue = WorkQueue(args.path)
+    if args.command == "submit":
+        with open(args.points) as f:
+            points = json.load(f)
+        names = queue.submitSweep(points, args.replicates, args.seed, args.collectEvery)
+        print("Submitted %d jobs" % len(names))
+    elif args.command == "work":
+        work(args.path, args.workers, args.heartbeat, args.wait)
+    else:
+        if args.requeue is not None:
+            for name in queue.requeueStale(args.requeue):
+                print("Requeued stale claim %s" % name)
+        print(", ".join("%d %s" % (count, state) for state, count in queue.status().items()))
+        for name in queue.jobs("failed"):
+            print("Failed %s, see %s" % (name, queue.jobPath("failed", name, ".txt")))
+        if args.output is not None:
+            queue.results().to_csv(args.output, index=False)
+            print("Wrote %s" % args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())